@@ -1,19 +1,79 @@
-import os as _os, inspect as _in, sys as _sys
+'''
+Submodules, and the heavy dependencies they import (openstack, boto3, dask, distributed),
+are loaded on first access of one of their names, e.g. cloud.JetStreamCluster, so that
+`import cloud` stays cheap in worker preload scripts and batch job runners. The names are
+those each submodule defines (tests/test_init.py checks them), in the order of the star
+imports this package used to do, so a name defined by several submodules resolves to the
+last one. cloud.bake and cloud.teardown are the submodules; their functions of the same
+name are cloud.bake.bake and cloud.teardown.teardown.
+'''
+import sys as _sys, importlib as _importlib
 
-from .ostack import *
-from .cluster import *
-from .k8s import *
-from .fks import *
-from .script import *
-from .cloudwatch import *
+# Public names defined by each submodule
+_SUBMODULES = dict(
+    cache=('TTLCache', 'LOOKUPS', 'invalidate_lookups'),
+    backoff=('full_jitter', 'CircuitOpen', 'CircuitBreaker', 'BREAKERS', 'get_breaker', 'breaker_name', 'RetryPolicy',
+             'TokenBucket', 'LIMITS', 'BUCKETS', 'get_bucket', 'set_rate_limit', 'limit_session'),
+    inventory=('PENDING', 'server_addresses', 'Inventory'),
+    timeline=('PHASES', 'percentile', 'guest_marks', 'Timeline'),
+    ippool=('FloatingIPPool', 'as_ip_pool', 'IPPools'),
+    quota=('get_compute_limits', 'get_network_quota', 'available', 'flavor_capacity', 'floating_ip_capacity',
+           'QuotaExceeded', 'Preflight', 'preflight', 'combine', 'apply_quota', 'check_quota'),
+    flavors=('Demand', 'Flavor', 'FlavorMix', 'flavor_catalog', 'available_quota', 'slots', 'makespan', 'optimize_mix'),
+    resources=('VOLUME', 'task_resources', 'demand_resources', 'annotate', 'worker_resources', 'matching_workers'),
+    datamap=('data_columns', 'DataTable', 'data_table', 'Skew', 'memory_skew', 'Balance', 'balance'),
+    environment=('CACHE', 'SYSTEM_PREFIXES', 'Environment', 'file_digest', 'fingerprint', 'pack_environment', 'as_environment',
+                 'environment_versions', 'publish_environment'),
+    placement=('PlacementError', 'ConnectionStats', 'Placement'),
+    ostack=('DEFAULT_OS_KEY', 'DEFAULT_OS_GROUPS', 'DEFAULT_CONNECTION', 'SERVER_TIMEOUT', 'connection',
+            'limit_connection', 'lookup', 'close_openstack', 'INVENTORIES', 'get_inventory', 'EXCEPTIONS', 'retry',
+            'get_flavor', 'get_image', 'get_network', 'warm_lookups', 'get_server_ip', 'create_ip', 'create_ips',
+            'attach_ip', 'get_server', 'attach_volume', 'spill_volume', 'submit_server', 'submit_servers',
+            'close_server', 'activate_server', 'create_server', 'create_image'),
+    teardown=('TeardownReport', 'log_progress', 'Teardown', 'teardown'),
+    cluster=('JetStreamCluster',),
+    adaptive=('scheduler_load', 'JetStreamAdaptive'),
+    k8s=('CONFIGURE', 'FRONT_CMD', 'K8sInstance', 'K8sCluster'),
+    fks=('SCRIPT', 'FksInstance', 'FksCluster'),
+    batch=('BatchSystem', 'SLURM', 'PBS', 'SYSTEMS', 'detect', 'Line', 'submission_script', 'BatchCluster'),
+    bake=('BOOT_PROPERTY', 'RECIPE_PROPERTY', 'Recipe', 'bake_script', 'BakeError', 'BootMeasurement', 'Regression',
+          'BakeResult', 'bake_status', 'wait_for_image', 'bake_image', 'measure_boot', 'boot_history',
+          'check_regression', 'bake'),
+    script=('retry', 'mount_volume', 'spill_script', 'config_diff', 'configure', 'preload_cloudwatch',
+            'preload_telemetry', 'shebang', 'environment_script', 'scheduler_script', 'spill_info', 'worker_script',
+            'worker_payload', 'payload_digest', 'bootstrap_script'),
+    cloudwatch=('CloudWatchWarning', 'ip', 'AwsSession', 'retry_log', 'CloudWatchHandler'),
+    telemetry=('UNITS', 'FIELDS', 'Sampler', 'SAMPLER', 'worker_metric', 'install_worker_metric', 'CloudWatchMetrics',
+               'CSVSink', 'ParquetSink', 'Telemetry', 'watch_scheduler', 'install_telemetry', 'telemetry_rows',
+               'collect_telemetry'),
+)
 
-import psutil
+_LAZY = {name: module for module, names in _SUBMODULES.items() for name in names if name not in _SUBMODULES}
+
+def _load(name):
+    module = _importlib.import_module('.' + _LAZY[name], __name__)
+    value = globals()[name] = getattr(module, name)
+    return value
+
+def __getattr__(name):
+    if name in _LAZY:
+        return _load(name)
+    if name in _SUBMODULES or name in ('future', 'templates', 'openstack2'):
+        return _importlib.import_module('.' + name, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY) | set(_SUBMODULES))
+
+################################################################################
 
 def mem_percent():
+    import psutil
     return psutil.virtual_memory().percent
 
 
 def task_distribution(who_has):
+    '''Dict of worker -> keys from client.who_has(). See data_table() for large clusters'''
     out = {}
     for k, v in who_has.items():
         for ip in v:
@@ -25,3 +85,5 @@ def task_distribution(who_has):
 def module_versions():
     ver = lambda v: getattr(v, 'version', None) or getattr(v, '__version__', None)
     return {k: ver(v) for k, v in sorted(_sys.modules.items()) if isinstance(ver(v), str)}
+
+__all__ = sorted(set(_LAZY) | set(_SUBMODULES) | {'mem_percent', 'task_distribution', 'module_versions'})
@@ -0,0 +1,109 @@
+'''
+Adaptive scaling policy for clusters whose workers are VMs with a long boot time
+'''
+import math, time, logging, distributed
+import fn
+from distributed.deploy import Adaptive
+
+log = logging.getLogger(__name__)
+
+################################################################################
+
+def scheduler_load(dask_scheduler):
+    '''Summarize the backlog and the per-worker occupancy (run on the scheduler)'''
+    s = dask_scheduler
+    backlog = sum(1 for t in s.tasks.values() if t.state in ('waiting', 'no-worker', 'queued'))
+    workers = {a: dict(nthreads=getattr(w, 'nthreads', getattr(w, 'ncores', 1)),
+                       occupancy=w.occupancy, processing=len(w.processing)) for a, w in s.workers.items()}
+    return dict(backlog=backlog, occupancy=s.total_occupancy, workers=workers)
+
+################################################################################
+
+class JetStreamAdaptive(Adaptive):
+    '''
+    Grows the cluster so that the outstanding work (occupancy of processing tasks plus
+    the estimated duration of the backlog) would be done within the measured VM boot
+    latency, since workers booted later than that would arrive to find nothing to do.
+    Only workers without processing tasks are removed.
+    - `scale_up_cooldown`: seconds after a scale up before the next one
+    - `scale_down_cooldown`: seconds after a scale up before any scale down
+    - `options`: keywords for `cluster.add_workers` such as flavor or image
+    '''
+    def __init__(self, cluster, *, minimum=0, maximum=math.inf, interval='30s', wait_count=3,
+                 target_duration='5s', scale_up_cooldown=60, scale_down_cooldown=300, options=None, **kwargs):
+        self.scale_up_cooldown = float(scale_up_cooldown)
+        self.scale_down_cooldown = float(scale_down_cooldown)
+        self.options = dict(options or {})
+        self.last_up = -math.inf
+        self.client = None
+        self.load = None
+        super().__init__(cluster, interval=interval, minimum=minimum, maximum=maximum,
+            wait_count=wait_count, target_duration=target_duration, **kwargs)
+
+    async def get_client(self):
+        if self.client is None:
+            self.client = await distributed.Client(self.cluster.scheduler_address, asynchronous=True)
+        return self.client
+
+    async def fetch_load(self):
+        client = await self.get_client()
+        self.load = await client.run_on_scheduler(scheduler_load)
+        self.cluster.observe(self.load['workers'])
+        return self.load
+
+    async def target(self):
+        load = await self.fetch_load()
+        workers = load['workers'].values()
+        threads = max(1, sum(w['nthreads'] for w in workers) / len(workers)) if workers else 1
+        processing = sum(w['processing'] for w in workers)
+        duration = load['occupancy'] / processing if processing else self.target_duration
+        work = load['occupancy'] + load['backlog'] * duration
+        horizon = max(self.target_duration, self.cluster.boot_latency())
+        busy = sum(1 for w in workers if w['processing'])
+        target = max(busy, math.ceil(work / (threads * horizon)))
+        return int(min(max(target, self.minimum), self.maximum))
+
+    async def workers_to_close(self, target):
+        '''Idle worker processes to close, taking whole VMs whose processes are all idle'''
+        workers = self.load['workers'] if self.load else {}
+        hosts = {}
+        for a, w in workers.items():
+            hosts.setdefault(a.rsplit(':', 1)[0], []).append((a, w))
+        idle = sorted((sum(w['occupancy'] for _, w in v), sorted(a for a, _ in v))
+                      for v in hosts.values() if not any(w['processing'] for _, w in v))
+        out, n = [], len(workers) - target
+        for _, addresses in idle:
+            if len(out) + len(addresses) <= n:
+                out += addresses
+        return out
+
+    async def recommendations(self, target):
+        out = await super().recommendations(target)
+        now = time.time()
+        if out['status'] == 'up' and now < self.last_up + self.scale_up_cooldown:
+            return {'status': 'same'}
+        if out['status'] == 'down' and now < self.last_up + self.scale_down_cooldown:
+            return {'status': 'same'}
+        return out
+
+    async def scale_up(self, n):
+        log.info(fn.message('Adaptive scale up', target=n))
+        self.last_up = time.time()
+        await self.cluster.runner.execute(self.cluster.scale_up, n, **self.options)
+
+    async def scale_down(self, workers):
+        if workers:
+            log.info(fn.message('Adaptive scale down', workers=list(workers)))
+            # idle workers may still hold results: move them to the remaining workers before deleting the VMs.
+            # Workers on VMs to be parked keep running (without a nanny nothing would restart them after a
+            # resume), and reconnect to the scheduler once resumed.
+            client = await self.get_client()
+            parked = set(self.cluster.parked_workers(workers)).intersection(workers)
+            closed = [w for w in workers if w not in parked]
+            if closed:
+                await client.retire_workers(workers=closed, close_workers=True)
+            if parked:
+                await client.retire_workers(workers=list(parked), close_workers=False)
+            await self.cluster.runner.execute(self.cluster.scale_down, workers)
+
+################################################################################
@@ -0,0 +1,270 @@
+'''
+One retry policy and rate limiter for every API call in the process
+
+- Retries sleep with full jitter, uniform(0, min(cap, base * 2**attempt)), so callers
+  which fail together do not retry in lockstep
+- Each policy has a deadline, and may share a CircuitBreaker with other callers of the
+  same endpoint: after `threshold` consecutive failures everyone waits `reset` seconds
+  before a single probe call is let through. Each connection has its own breaker (see
+  breaker_name), so that one failing cloud does not hold up calls to the others
+- limit_session() puts every request of a keystoneauth session (openstacksdk, novaclient
+  and neutronclient all use one) behind a process-wide TokenBucket for its service type
+'''
+import time, random, asyncio, threading, logging, functools, itertools
+
+import fn
+
+log = logging.getLogger(__name__)
+
+################################################################################
+
+def full_jitter(attempt, base=0.5, cap=60):
+    '''Seconds to sleep before retry number `attempt` (from 0)'''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+################################################################################
+
+class CircuitOpen(RuntimeError):
+    pass
+
+class CircuitBreaker:
+    '''
+    Shared failure counter for one endpoint
+    Closed: calls go through. Open (after `threshold` consecutive failures): calls wait
+    until `reset` seconds have passed, then one probe is let through (half open) and its
+    outcome closes or reopens the circuit.
+    '''
+    def __init__(self, name, threshold=5, reset=30):
+        self.name = name
+        self.threshold = int(threshold)
+        self.reset = float(reset)
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None # time the circuit opened, or None if closed
+        self.probing = False
+
+    def delay(self):
+        '''Seconds until a call may go through (0 to go now), reserving the probe if half open'''
+        with self.lock:
+            if self.opened is None:
+                return 0
+            wait = self.opened + self.reset - time.monotonic()
+            if wait <= 0 and not self.probing:
+                self.probing = True
+                return 0
+            return max(wait, 0.1)
+
+    def abandon(self):
+        with self.lock:
+            self.probing = False
+
+    def success(self):
+        with self.lock:
+            self.failures, self.opened, self.probing = 0, None, False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.opened is None and self.failures >= self.threshold):
+                if self.opened is None:
+                    log.warning(fn.message('Opening circuit breaker', name=self.name, failures=self.failures))
+                self.opened, self.probing = time.monotonic(), False
+
+    def __str__(self):
+        return 'CircuitBreaker({!r}, {})'.format(self.name, 'closed' if self.opened is None else 'open')
+
+    __repr__ = __str__
+
+BREAKERS = {}
+_BREAKER_LOCK = threading.Lock()
+
+def get_breaker(name, threshold=5, reset=30):
+    '''Process-wide CircuitBreaker for a name, created on first use'''
+    with _BREAKER_LOCK:
+        if name not in BREAKERS:
+            BREAKERS[name] = CircuitBreaker(name, threshold, reset)
+        return BREAKERS[name]
+
+def breaker_name(client=None, prefix='openstack'):
+    '''Name of the CircuitBreaker of a connection or API client, e.g. openstack:RegionOne:7f3a2c1d'''
+    if client is None:
+        return prefix
+    region = getattr(getattr(client, 'config', None), 'region_name', None)
+    return '{}:{}{:x}'.format(prefix, region + ':' if isinstance(region, str) else '', id(client))
+
+################################################################################
+
+class RetryPolicy:
+    '''
+    Retry calls raising one of `exceptions` with full-jitter backoff until `deadline`
+    seconds have passed since the first attempt (None for no deadline) or `attempts`
+    attempts have been made (None for no limit), then reraise the last exception
+    `breaker` is a CircuitBreaker or a name for get_breaker(), or None
+    '''
+    def __init__(self, exceptions=(Exception,), *, deadline=3600, attempts=None, base=0.5, cap=60, breaker=None):
+        self.exceptions = tuple(exceptions)
+        self.deadline = deadline
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.breaker = get_breaker(breaker) if isinstance(breaker, str) else breaker
+
+    def delays(self, end):
+        '''Generator of (attempt, seconds to sleep before it) which stops when the budget is spent'''
+        for attempt in itertools.count():
+            wait = 0 if attempt == 0 else full_jitter(attempt - 1, self.base, self.cap)
+            if attempt and self.attempts is not None and attempt >= self.attempts:
+                return
+            if attempt and end is not None and time.monotonic() + wait > end:
+                return
+            yield attempt, wait
+
+    def gate(self, end):
+        '''Generator of seconds to sleep while the circuit is open. Raises CircuitOpen past the deadline'''
+        while self.breaker is not None:
+            wait = self.breaker.delay()
+            if not wait:
+                return
+            if end is not None and time.monotonic() + wait > end:
+                raise CircuitOpen('Circuit {} is open'.format(self.breaker.name))
+            yield wait
+
+    def _end(self):
+        return None if self.deadline is None else time.monotonic() + self.deadline
+
+    def _failed(self, function, attempt, exception):
+        if self.breaker is not None:
+            self.breaker.failure()
+        log.info(fn.message('Retrying after exception', function=getattr(function, '__name__', function),
+            attempt=attempt, exception=exception))
+
+    def _succeeded(self):
+        if self.breaker is not None:
+            self.breaker.success()
+
+    def _abandoned(self, exception):
+        if self.breaker is None:
+            pass
+        elif isinstance(exception, Exception):
+            self.breaker.success() # the endpoint answered, just not with something retryable
+        else:
+            self.breaker.abandon() # e.g. cancelled: let someone else probe
+
+    def call(self, function, *args, **kwargs):
+        end = self._end()
+        for attempt, wait in self.delays(end):
+            time.sleep(wait)
+            for wait in self.gate(end):
+                time.sleep(wait)
+            try:
+                out = function(*args, **kwargs)
+            except self.exceptions as e:
+                self._failed(function, attempt, e)
+                last = e
+                continue
+            except BaseException as e:
+                self._abandoned(e)
+                raise
+            self._succeeded()
+            return out
+        raise last
+
+    async def call_async(self, function, *args, timeout=None, **kwargs):
+        '''Retry a coroutine function, also retrying attempts which take longer than `timeout`'''
+        end = self._end()
+        for attempt, wait in self.delays(end):
+            await asyncio.sleep(wait)
+            for wait in self.gate(end):
+                await asyncio.sleep(wait)
+            try:
+                out = await asyncio.wait_for(function(*args, **kwargs), timeout=timeout)
+            except (asyncio.TimeoutError,) + self.exceptions as e:
+                self._failed(function, attempt, e)
+                last = e
+                continue
+            except BaseException as e:
+                self._abandoned(e)
+                raise
+            self._succeeded()
+            return out
+        raise last
+
+    def __call__(self, function):
+        '''Decorate a function to call it through this policy'''
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def retry_async(*args, **kwargs):
+                return await self.call_async(function, *args, **kwargs)
+            return retry_async
+        @functools.wraps(function)
+        def retryable(*args, **kwargs):
+            return self.call(function, *args, **kwargs)
+        return retryable
+
+################################################################################
+
+class TokenBucket:
+    '''Thread-safe token bucket allowing `rate` calls per second with bursts of up to `burst`'''
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(self.rate if burst is None else burst)
+        self.tokens = self.burst
+        self.time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self, tokens):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+            self.tokens -= tokens # may go negative: later callers queue behind this one
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self, tokens=1):
+        '''Take tokens, sleeping until they are available. Returns the seconds slept'''
+        wait = self._reserve(tokens)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def __str__(self):
+        return 'TokenBucket(rate={}, burst={})'.format(self.rate, self.burst)
+
+    __repr__ = __str__
+
+# Requests per second and burst for each service type, with None as the default
+LIMITS = {None: (20, 40), 'compute': (10, 20), 'network': (10, 20), 'image': (5, 10)}
+BUCKETS = {}
+_BUCKET_LOCK = threading.Lock()
+
+def get_bucket(endpoint):
+    '''Process-wide TokenBucket for a service type, using LIMITS'''
+    with _BUCKET_LOCK:
+        if endpoint not in BUCKETS:
+            BUCKETS[endpoint] = TokenBucket(*LIMITS.get(endpoint, LIMITS[None]))
+        return BUCKETS[endpoint]
+
+def set_rate_limit(endpoint, rate, burst=None):
+    '''Set the requests per second (and burst) for a service type, or the default if endpoint is None'''
+    with _BUCKET_LOCK:
+        LIMITS[endpoint] = (rate, burst)
+        BUCKETS.clear()
+
+def limit_session(session):
+    '''
+    Put every request of a keystoneauth Session through the shared bucket for its service type
+    Idempotent; returns the session
+    '''
+    if session is None or getattr(session, '_rate_limited', False):
+        return session
+    request = session.request
+    @functools.wraps(request)
+    def limited(url, method, **kwargs):
+        service = (kwargs.get('endpoint_filter') or {}).get('service_type') or kwargs.get('service_type')
+        get_bucket(service).acquire()
+        return request(url, method, **kwargs)
+    session.request = limited
+    session._rate_limited = True
+    return session
+
+################################################################################
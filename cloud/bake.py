@@ -0,0 +1,212 @@
+'''
+Bake worker images from a base image and a declarative Recipe, and catch boot-time regressions
+
+bake_image() boots a builder server whose user data (templates.bake) installs the recipe,
+compiles bytecode, prewarms imports and powers off, reporting on its console log. The
+server is then snapshotted and deleted. measure_boot() times new workers from request to
+registration with a running JetStreamCluster, and bake() records that time on the image
+and compares it with earlier images of the same recipe.
+'''
+import re, time, json, hashlib, logging, typing
+
+import fn, yaml
+
+from . import templates
+from .ostack import create_server, close_server, create_image, get_inventory
+from .script import shebang
+from .timeline import percentile
+from .future import block
+
+log = logging.getLogger(__name__)
+
+BOOT_PROPERTY = 'boot_seconds'   # image property holding the measured median boot time
+RECIPE_PROPERTY = 'recipe'       # image property holding the digest of its recipe
+
+################################################################################
+
+class Recipe(typing.NamedTuple):
+    '''What to install on `base` with which `flavor`; images are named {name}-{date}-{time}'''
+    name: str
+    base: str
+    flavor: str
+    apt: tuple = ()
+    conda: tuple = ()
+    channels: tuple = ()
+    pip: tuple = ()
+    commands: tuple = ()   # shell commands run as root after the packages
+    prewarm: tuple = ('dask', 'distributed')   # modules which are not installed are skipped
+    python: str = 'python3'
+
+    @classmethod
+    def load(cls, spec):
+        '''Recipe from a dict or the path of a YAML file of one'''
+        if not isinstance(spec, dict):
+            with open(spec) as f:
+                spec = yaml.safe_load(f)
+        return cls(**{k: tuple(v) if isinstance(v, list) else v for k, v in spec.items()})
+
+    def digest(self):
+        return hashlib.sha256(json.dumps(self._asdict(), sort_keys=True).encode()).hexdigest()[:16]
+
+def bake_script(recipe):
+    '''User data for a builder server of a Recipe'''
+    return shebang(recipe.python if recipe.python.startswith('/') else None) + templates.bake.substitute(
+        python=repr(recipe.python), apt=repr(list(recipe.apt)), conda=repr(list(recipe.conda)),
+        channels=repr(list(recipe.channels)), pip=repr(list(recipe.pip)), commands=repr(list(recipe.commands)),
+        prewarm=repr(list(recipe.prewarm)))
+
+################################################################################
+
+class BakeError(RuntimeError):
+    pass
+
+class BootMeasurement(typing.NamedTuple):
+    image: str
+    seconds: list    # request to registration of each worker
+    phases: dict     # median seconds spent on each phase (see Timeline)
+
+    @property
+    def median(self):
+        return percentile(self.seconds, 50)
+
+class Regression(typing.NamedTuple):
+    seconds: float
+    baseline: float  # median boot time of the previous images, or None
+    ratio: float     # seconds / baseline
+    regressed: bool
+
+class BakeResult(typing.NamedTuple):
+    image: str       # id
+    name: str
+    status: dict     # BAKE-STATUS reported by the builder: seconds per step and per prewarmed import
+    seconds: float   # from builder request to active image
+    boot: BootMeasurement
+    regression: Regression
+
+################################################################################
+
+def bake_status(conn, server):
+    '''The last BAKE-STATUS a builder printed to its console log, or None'''
+    output = conn.compute.get_server_console_output(server).get('output', '')
+    lines = [l for l in output.splitlines() if l.startswith('BAKE-STATUS ')]
+    return json.loads(lines[-1][len('BAKE-STATUS '):]) if lines else None
+
+def wait_for_image(conn, image, timeout=3600, interval=10):
+    '''Wait for an image (id) to become active. Raises BakeError if it fails'''
+    end = time.time() + timeout
+    while True:
+        status = conn.image.get_image(image).status
+        if status == 'active':
+            return image
+        if status in ('killed', 'deleted', 'deactivated'):
+            raise BakeError('Image {} is {}'.format(image, status))
+        if time.time() > end:
+            raise TimeoutError('Image {} is still {} after {} seconds'.format(image, status, timeout))
+        time.sleep(interval)
+
+def bake_image(conn, recipe, network, *, timeout=7200, interval=15, keep=False):
+    '''
+    Build and snapshot an image of a Recipe. Returns (image id, image name, builder status, seconds)
+    The builder is deleted afterwards unless `keep`. Raises BakeError if a step fails.
+    '''
+    start = time.time()
+    name = '{}-{}'.format(recipe.name, time.strftime('%Y%m%d-%H%M%S'))
+    server = create_server(conn, name=name + '-builder', image=recipe.base, flavor=recipe.flavor,
+        network=network, user_data=bake_script(recipe))
+    try:
+        end = time.time() + timeout
+        while True:
+            status = bake_status(conn, server)
+            if status is not None:
+                break
+            s = get_inventory(conn).server(server.id)
+            if s is None or s.status.upper() in ('SHUTOFF', 'ERROR'):
+                raise BakeError('Builder {} stopped without reporting a status'.format(name))
+            if time.time() > end:
+                raise TimeoutError('Builder {} did not finish within {} seconds'.format(name, timeout))
+            time.sleep(interval)
+        log.info(fn.message('Builder finished', name=name, status=status))
+        if not status.get('ok'):
+            raise BakeError('Builder {} failed: {}'.format(name, status))
+        get_inventory(conn).wait(server, ('SHUTOFF',), timeout=600)
+        image = create_image(conn, server, name, suspend=False,
+            metadata={RECIPE_PROPERTY: recipe.digest(), 'base_image': recipe.base})
+        image = wait_for_image(conn, getattr(image, 'id', image), timeout=timeout)
+    finally:
+        if not keep:
+            close_server(conn, server, graceful=False)
+    return image, name, status, time.time() - start
+
+################################################################################
+
+def measure_boot(cluster, image, flavor=None, n=2, *, client=None, timeout=1800, interval=1):
+    '''
+    Boot n workers of an image on a JetStreamCluster, time each from request to registration
+    with the scheduler, then close them. Returns a BootMeasurement.
+    '''
+    client = cluster.client() if client is None else client
+    futures = cluster.add_workers(n, flavor or cluster.worker_flavor, image=image)
+    ips = [i[0] for i in cluster.instances[len(cluster.instances) - len(futures):]]
+    try:
+        end, waiting = time.time() + timeout, set(ips)
+        while waiting and time.time() < end:
+            for address in client.scheduler_info()['workers']:
+                ip = address.split('://')[-1].rsplit(':', 1)[0]
+                if ip in waiting:
+                    cluster.timeline.mark(ip, 'registered')
+                    waiting.discard(ip)
+            time.sleep(interval)
+        if waiting:
+            log.warning(fn.message('Workers did not register in time', image=image, ips=sorted(waiting)))
+        cluster.collect_timeline(client) # in-guest booted and started marks
+        marks = {ip: cluster.timeline.marks(ip) for ip in ips}
+    finally:
+        block(cluster.close(instances=ips))
+    seconds = [m['registered'] - m['requested'] for m in marks.values() if 'registered' in m and 'requested' in m]
+    phases = {}
+    for phase in ('submitted', 'active', 'attached', 'booted', 'started', 'registered'):
+        values = [s[phase] for s in map(cluster.timeline.steps, marks.values()) if phase in s]
+        if values:
+            phases[phase] = percentile(values, 50)
+    return BootMeasurement(image, seconds, phases)
+
+def boot_history(conn, name):
+    '''(created time, image name, median boot seconds) of the images of a recipe name with a measurement'''
+    pattern = re.compile(r'^{}-\d{{8}}-\d{{6}}$'.format(re.escape(name))) # see bake_image, not e.g. {name}-gpu-...
+    out = []
+    for image in conn.image.images():
+        props = dict(getattr(image, 'properties', None) or {})
+        seconds = props.get(BOOT_PROPERTY, getattr(image, BOOT_PROPERTY, None))
+        if image.name and pattern.match(image.name) and seconds is not None:
+            out.append((image.created_at, image.name, float(seconds)))
+    return sorted(out)
+
+def check_regression(conn, name, seconds, *, tolerance=0.2, window=5, exclude=()):
+    '''Compare a boot time with the median of the last `window` measured images of a recipe name'''
+    previous = [s for _, n, s in boot_history(conn, name) if n not in exclude][-window:]
+    baseline = percentile(previous, 50)
+    if baseline is None or seconds is None:
+        return Regression(seconds, baseline, None, False)
+    ratio = seconds / baseline
+    regression = Regression(seconds, baseline, ratio, ratio > 1 + tolerance)
+    if regression.regressed:
+        log.warning(fn.message('Boot time regression', name=name, seconds=seconds, baseline=baseline, ratio=ratio))
+    return regression
+
+def bake(conn, recipe, network, *, cluster=None, n=2, tolerance=0.2, **kwargs):
+    '''
+    Bake an image of a Recipe (see bake_image) and, given a running JetStreamCluster, measure its
+    boot-to-registered time with n workers, store the median on the image, and compare it with
+    earlier images of the recipe. Returns a BakeResult.
+    '''
+    recipe = recipe if isinstance(recipe, Recipe) else Recipe.load(recipe)
+    image, name, status, seconds = bake_image(conn, recipe, network, **kwargs)
+    boot = regression = None
+    if cluster is not None:
+        boot = measure_boot(cluster, image, recipe.flavor, n)
+        if boot.median is not None:
+            conn.image.update_image(image, **{BOOT_PROPERTY: '%.1f' % boot.median})
+        regression = check_regression(conn, recipe.name, boot.median, tolerance=tolerance, exclude=(name,))
+    return BakeResult(image, name, status, seconds, boot, regression)
+
+################################################################################
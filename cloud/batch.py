@@ -0,0 +1,341 @@
+'''
+Dask workers as batch jobs on a Slurm or PBS (Torque) allocation
+
+BatchCluster submits workers as one job array per scale up, polls the state of all of
+its jobs with a single squeue/qstat call per interval, and cancels array tasks to scale
+down. The submission scripts are those of scripts/pbs.py (see submission_script), and
+the batch system is detected the same way: Slurm if sbatch is on the PATH, else PBS.
+'''
+import os, re, sys, json, time, shlex, getpass, logging, shutil, subprocess, threading, typing
+
+import fn
+
+log = logging.getLogger(__name__)
+
+################################################################################
+
+def _slurm_status(output):
+    '''{task id: state} from squeue --array --format="%i %t", task ids like 1234_5'''
+    lines = (l.split() for l in output.splitlines())
+    return {l[0]: l[1] for l in lines if len(l) >= 2 and l[0][:1].isdigit()}
+
+def _pbs_status(output):
+    '''{task id: state} from qstat -t, task ids like 1234[5] without the server suffix'''
+    lines = (l.split() for l in output.splitlines())
+    return {l[0].split('.')[0]: l[-2] for l in lines if len(l) >= 5 and l[0][:1].isdigit()}
+
+class BatchSystem(typing.NamedTuple):
+    name: str
+    submit: tuple     # argv of the submit command, before the script
+    status: tuple     # argv listing the state of the user's array tasks, formatted with user=
+    cancel: tuple     # argv of the cancel command, before the task ids
+    header: str       # first lines of a submission script
+    commands: dict    # option -> directive
+    directives: tuple # options in the order they are written
+    ext: str          # script file name from the job name
+    output: str       # output file name of array tasks from the job name
+    task: str         # shell expression of the task id of a running array task
+    index: str        # task id of index i of array job j
+    pending: tuple    # states of queued tasks; other listed states besides running mean finished
+    running: tuple
+    parse: object     # status output -> {task id: state}
+
+    def with_commands(self, **commands):
+        '''Same system with other program names for submit, status or cancel, e.g. wrappers'''
+        return self._replace(**{k: (v,) + getattr(self, k)[1:] for k, v in commands.items()})
+
+    def state(self, code):
+        return 'pending' if code in self.pending else 'running' if code in self.running else 'done'
+
+SLURM = BatchSystem('slurm',
+    submit=('sbatch', '--parsable'),
+    status=('squeue', '--noheader', '--array', '--format=%i %t', '--user={user}'),
+    cancel=('scancel',),
+    header='#SBATCH --export=ALL\n',
+    commands={
+        'name':      '#SBATCH --job-name="{}"',
+        'output':    '#SBATCH --output="{}"',
+        'error':     '#SBATCH --error="{}"',
+        'queue':     '#SBATCH --partition={}',
+        'timeout':   '#SBATCH --time={}',
+        'nodes':     '#SBATCH --nodes={}',
+        'cpus':      '#SBATCH --ntasks-per-node={}',
+        'gpus':      '#SBATCH --gres=gpu:{}',
+        'gpu-flags': '#SBATCH --gres-flags={}',
+        'path':      '#SBATCH --workdir={}',
+        'account':   '#SBATCH --account={}',
+        'memory':    '#SBATCH --mem={}',
+        'array':     '#SBATCH --array={}',
+    },
+    directives=('name', 'output', 'queue', 'nodes', 'cpus', 'timeout', 'gpus', 'account', 'memory', 'array'),
+    ext='{}.sh',
+    output='{}-%A_%a.out',
+    task='${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}',
+    index='{}_{}',
+    pending=('PD', 'CF', 'RQ', 'RF', 'RH'),
+    running=('R', 'S', 'ST'),
+    parse=_slurm_status)
+
+PBS = BatchSystem('pbs',
+    submit=('qsub',),
+    status=('qstat', '-t'),
+    cancel=('qdel',),
+    header='#PBS -S /bin/bash\n#PBS -V\n',
+    commands={
+        'name':     '#PBS -N {}',
+        'output':   '#PBS -o {}',
+        'queue':    '#PBS -q {}',
+        'timeout':  '#PBS -l walltime={}',
+        'nppn':     '#PBS -l nodes={}:ppn={}',
+        'memory':   '#PBS -l mem={}',
+        'path':     '#PBS -d {}',
+        'error':    '#PBS -e {}',
+        'array':    '#PBS -t {}',
+    },
+    directives=('timeout', 'nppn', 'memory', 'queue', 'path', 'output', 'error', 'name', 'array'),
+    ext='{}.pbs',
+    output='{}.out', # PBS appends the array index
+    task='${PBS_JOBID%%.*}',
+    index='{}[{}]',
+    pending=('Q', 'H', 'W', 'T'),
+    running=('R', 'S'),
+    parse=_pbs_status)
+
+SYSTEMS = dict(slurm=SLURM, pbs=PBS)
+
+def detect(system=None):
+    '''BatchSystem of a name, or Slurm if sbatch is on the PATH and else PBS'''
+    if isinstance(system, BatchSystem):
+        return system
+    if system is not None:
+        return SYSTEMS[system]
+    return PBS if shutil.which('sbatch') is None else SLURM
+
+################################################################################
+
+class Line:
+    def __init__(self, value, ln):
+        self.value = value
+        if value is None:
+            self.ln = ''
+        elif isinstance(value, (tuple, list)):
+            self.ln = ln.format(*value) + '\n'
+        else:
+            self.ln = ln.format(value) + '\n'
+
+    def __str__(self):
+        return str(self.value)
+
+def submission_script(script_inputs, command=None, system=None):
+    '''
+    Submission script with a directive for each of `script_inputs` known to the batch system
+    `command` is what the job runs (default: `remote.py` of scripts/pbs.py)
+    '''
+    system = detect(system)
+    if command is None:
+        command = '{} remote.py {}'.format(sys.executable, fn.unix_time())
+    lines = ''.join(Line(script_inputs.get(k), system.commands[k]).ln for k in system.directives)
+    return '#!/bin/bash\n{}{}\nsource ~/.bash_profile\n{}\n\n'.format(system.header, lines, command)
+
+################################################################################
+
+class BatchCluster(fn.ClosingContext):
+    def __init__(self, name=None, *, system=None, commands=None, directory='.', scheduler=None, port=8786,
+                 nodes=1, cpus=1, nthreads=None, memory=None, timeout=3600, queue=None, account=None, gpus=None,
+                 python=None, worker_options=(), interval=10, grace=120):
+        '''
+        `system` is 'slurm', 'pbs' or a BatchSystem (default: see detect), and `commands` a dict
+        to rename its submit, status or cancel programs, e.g. dict(status='/opt/slurm/bin/squeue')
+        `directory` is where scripts, job output and the scheduler file go; it should be on a
+        filesystem shared with the compute nodes. `scheduler` is the address of a running
+        scheduler, or None to start one on this machine on `port`.
+        `nodes`, `cpus`, `memory`, `timeout` (seconds or a walltime string), `queue`, `account`
+        and `gpus` are requested for each worker job, which runs one worker with `nthreads`
+        (default: cpus) threads and the extra dask-worker arguments `worker_options`.
+        Job states are polled every `interval` seconds. Tasks which have not been listed
+        `grace` seconds after their submission are presumed to have finished.
+        '''
+        self.name = 'dask-{}'.format(os.getpid()) if name is None else name
+        assert re.fullmatch(r'[\w.-]+', self.name), 'Cluster names are letters, digits, _, . and -'
+        self.system = detect(system).with_commands(**(commands or {}))
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        os.makedirs(self.directory, exist_ok=True)
+        self.python = sys.executable if python is None else python
+        self.inputs = dict(nodes=nodes, cpus=cpus, nppn=(nodes, cpus), memory=memory, queue=queue, account=account,
+            gpus=gpus, timeout=timeout if isinstance(timeout, str) else fn.duration_string(timeout))
+        self.nthreads = cpus if nthreads is None else nthreads
+        self.worker_options = tuple(worker_options)
+        self.interval = float(interval)
+        self.grace = float(grace)
+        self.lock = threading.RLock()
+        self.tasks = {}     # task id -> 'pending' or 'running'
+        self.jobs = {}      # array job id -> time of submission
+        self.listed = set() # array job ids which the status command has listed
+        self.count = 0      # number of submitted arrays
+        self.process = None
+        if scheduler is None:
+            scheduler = self._start_scheduler(port)
+        self.address = scheduler
+        self.closed = threading.Event()
+        self.poller = threading.Thread(target=self._poll_loop, name='batch-poll', daemon=True)
+        self.poller.start()
+
+    def _start_scheduler(self, port, timeout=60):
+        path = os.path.join(self.directory, self.name + '-scheduler.json')
+        if os.path.exists(path):
+            os.remove(path)
+        self.process = subprocess.Popen([self.python, '-m', 'distributed.cli.dask_scheduler', '--port', str(port),
+            '--scheduler-file', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        end = time.time() + timeout
+        while not os.path.exists(path):
+            if self.process.poll() is not None or time.time() > end:
+                self.process.kill()
+                raise RuntimeError('Scheduler did not start (exit code {})'.format(self.process.poll()))
+            time.sleep(0.1)
+        time.sleep(0.1) # the file may still be being written
+        with open(path) as f:
+            address = json.load(f)['address']
+        log.info(fn.message('Started scheduler', address=address, pid=self.process.pid))
+        return address
+
+    @property
+    def scheduler_address(self):
+        return self.address
+
+    def client(self, **kwargs):
+        import distributed
+        return distributed.Client(self.address, **kwargs)
+
+    def __str__(self):
+        return 'BatchCluster({}, {}, {})'.format(repr(self.name), self.system.name, len(self.tasks))
+
+    ############################################################################
+
+    def _run(self, argv):
+        return subprocess.run(argv, cwd=self.directory, check=True, capture_output=True, text=True).stdout
+
+    def worker_command(self):
+        '''Command of a worker job, named {cluster name}-{task id}'''
+        args = [self.python, '-m', 'distributed.cli.dask_worker', self.address, '--nthreads', str(self.nthreads),
+            '--local-directory', self.directory, '--death-timeout', '60'] + list(self.worker_options)
+        # double quotes so that the task id expands but a PBS id like 1234[5] is not globbed
+        return ' '.join(map(shlex.quote, args)) + ' --name "{}-{}"'.format(self.name, self.system.task)
+
+    def submit(self, n):
+        '''Submit n workers as one job array. Returns its job id'''
+        self.count += 1
+        name = '{}-{}'.format(self.name, self.count)
+        script = submission_script(dict(self.inputs, name=self.name, array='0-{}'.format(n - 1),
+            output=os.path.join(self.directory, self.system.output.format(name)), path=self.directory),
+            self.worker_command(), self.system)
+        path = os.path.join(self.directory, self.system.ext.format(name))
+        with open(path, 'w') as f:
+            f.write(script)
+        output = self._run(self.system.submit + (path,))
+        match = re.match(r'\s*(\d+)', output)
+        if match is None:
+            raise RuntimeError('Unexpected output of {}: {!r}'.format(self.system.submit[0], output))
+        job = match.group(1)
+        with self.lock:
+            self.jobs[job] = time.time()
+            self.tasks.update((self.system.index.format(job, i), 'pending') for i in range(n))
+        log.info(fn.message('Submitted job array', job=job, workers=n, script=path))
+        return job
+
+    def _job(self, task):
+        return re.match(r'\d+', task).group(0)
+
+    def poll(self):
+        '''Update the state of all tasks with one call of the status command. Returns the tasks'''
+        try:
+            listed = self.system.parse(self._run([a.format(user=getpass.getuser()) for a in self.system.status]))
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning('{} failed: {}'.format(self.system.status[0], getattr(e, 'stderr', None) or e))
+            return self.workers
+        now = time.time()
+        with self.lock:
+            listed = {t: self.system.state(s) for t, s in listed.items() if self._job(t) in self.jobs}
+            self.listed.update(map(self._job, listed))
+            for task in list(self.tasks):
+                job = self._job(task)
+                state = listed.get(task)
+                if state in ('pending', 'running'):
+                    self.tasks[task] = state
+                elif job in self.listed or now - self.jobs[job] > self.grace:
+                    del self.tasks[task]
+            for job in [j for j in self.jobs if not any(self._job(t) == j for t in self.tasks)]:
+                del self.jobs[job]
+                self.listed.discard(job)
+        return self.workers
+
+    def _poll_loop(self):
+        while not self.closed.wait(self.interval):
+            self.poll()
+
+    @property
+    def workers(self):
+        '''Dict of task id -> 'pending' or 'running', as of the last poll'''
+        with self.lock:
+            return dict(self.tasks)
+
+    def counts(self):
+        '''Number of pending and running workers'''
+        states = list(self.workers.values())
+        return dict(pending=states.count('pending'), running=states.count('running'))
+
+    ############################################################################
+
+    def cancel(self, tasks):
+        '''Cancel array tasks with one call of the cancel command'''
+        tasks = list(tasks)
+        if tasks:
+            with self.lock:
+                for t in tasks:
+                    self.tasks.pop(t, None)
+            try:
+                self._run(self.system.cancel + tuple(tasks))
+            except subprocess.CalledProcessError as e:
+                log.warning(fn.message('Cancelling tasks failed', tasks=tasks, error=e.stderr))
+        return tasks
+
+    def _task_of(self, workers):
+        '''Task ids of workers given as task ids, worker names or worker addresses'''
+        workers = set(workers)
+        prefix = self.name + '-'
+        out = {w for w in workers if w in self.tasks}
+        out.update(w[len(prefix):] for w in workers if w.startswith(prefix))
+        addresses = workers - out - {w for w in workers if w.startswith(prefix)}
+        if addresses:
+            with self.client(timeout=10) as client:
+                info = client.scheduler_info()['workers']
+            names = [str(info[a]['name']) for a in addresses if a in info]
+            out.update(n[len(prefix):] for n in names if n.startswith(prefix)) # others are not this cluster's
+        return out
+
+    def scale_up(self, n):
+        '''Submit workers to bring the number of pending and running ones up to n. Returns the job id or None'''
+        missing = n - len(self.workers)
+        return self.submit(missing) if missing > 0 else None
+
+    def scale_down(self, workers):
+        '''Cancel the workers with the given task ids, names or addresses'''
+        return self.cancel(self._task_of(workers) & set(self.workers))
+
+    def scale(self, n):
+        '''Scale to n workers, cancelling pending workers before running ones and newer before older'''
+        tasks = self.workers
+        if n >= len(tasks):
+            return self.scale_up(n)
+        order = sorted(tasks, key=lambda t: (tasks[t] == 'running', [-int(i) for i in re.findall(r'\d+', t)]))
+        return self.cancel(order[:len(tasks) - n])
+
+    def close(self):
+        '''Stop polling, cancel all workers and stop the scheduler if it was started here'''
+        self.closed.set()
+        self.cancel(self.workers)
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+################################################################################
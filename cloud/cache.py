@@ -0,0 +1,60 @@
+'''
+Process-wide cache for OpenStack lookups which rarely change (flavors, images, networks)
+'''
+import time, threading
+from concurrent.futures import Future
+
+################################################################################
+
+class TTLCache:
+    '''
+    Thread-safe cache whose entries expire after `ttl` seconds
+    Concurrent misses on the same key share a single fetch, and failed fetches are not cached.
+    '''
+    def __init__(self, ttl=600):
+        self.ttl = float(ttl)
+        self.lock = threading.Lock()
+        self.entries = {} # key -> (expiry, Future)
+
+    def get(self, key, fetch, ttl=None):
+        '''Return the cached value for key, calling fetch() if it is missing or expired'''
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            owner = entry is None or entry[0] < now
+            if owner:
+                entry = (now + (self.ttl if ttl is None else ttl), Future())
+                self.entries[key] = entry
+        if owner:
+            try:
+                entry[1].set_result(fetch())
+            except BaseException as e: # e.g. KeyboardInterrupt: waiters must not hang on the future
+                with self.lock:
+                    if self.entries.get(key) is entry:
+                        del self.entries[key]
+                entry[1].set_exception(e)
+                raise
+        return entry[1].result()
+
+    def invalidate(self, *prefix):
+        '''Remove entries whose key starts with the given prefix, or all entries if none is given'''
+        with self.lock:
+            for k in [k for k in self.entries if k[:len(prefix)] == prefix]:
+                del self.entries[k]
+
+    def __len__(self):
+        return len(self.entries)
+
+################################################################################
+
+LOOKUPS = TTLCache(ttl=600)
+
+def invalidate_lookups(*prefix):
+    '''
+    Invalidate cached lookups. Keys are (kind, client, name) where kind is
+    'flavor', 'image' or 'network', or ('limits', client) for quota usage,
+    e.g. invalidate_lookups('image')
+    '''
+    LOOKUPS.invalidate(*prefix)
+
+################################################################################
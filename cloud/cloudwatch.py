@@ -1,7 +1,7 @@
 '''
 A partial rewrite of the watchtower package with specialized functionality
 '''
-import queue, logging, warnings, time, random, collections, json, threading
+import queue, logging, warnings, time, random, collections, collections.abc, json, threading
 
 import boto3, distributed, dask
 from botocore.exceptions import ClientError
@@ -48,9 +48,14 @@ class AwsSession:
 
 ################################################################################
 
-def retry_log(function, *args, **kwargs):
-    '''Retry an AWS logging operation, forever, until it succeeds'''
-    t = 1
+def retry_log(function, *args, deadline=None, base=1, cap=300, **kwargs):
+    '''
+    Retry an AWS logging or metrics operation until it succeeds, or until `deadline` seconds have passed
+    Throttled calls sleep uniform(0, min(cap, base * 2**n)) (full jitter, as in cloud.backoff,
+    which this self-contained module cannot import)
+    '''
+    end = None if deadline is None else time.time() + deadline
+    throttled = 0
     while True:
         try:
             return kwargs.get('sequenceToken'), function(*args, **kwargs)
@@ -58,10 +63,13 @@ def retry_log(function, *args, **kwargs):
             err = e.response.get('Error', {}).get('Code')
             if err in ("DataAlreadyAcceptedException", "InvalidSequenceTokenException"):
                 kwargs['sequenceToken'] = e.response['Error']['Message'].rsplit(' ', 1)[-1]
-            elif err == 'ThrottlingException':
-                warnings.warn('Retrying AWS CloudWatch log operation: {}\n'.format(e), CloudWatchWarning)
-                time.sleep(t)
-                t *= random.random() + int(t < 500)
+            elif err in ('ThrottlingException', 'Throttling'):
+                wait = random.uniform(0, min(cap, base * 2 ** throttled))
+                if end is not None and time.time() + wait > end:
+                    raise
+                warnings.warn('Retrying AWS CloudWatch operation: {}\n'.format(e), CloudWatchWarning)
+                time.sleep(wait)
+                throttled += 1
             else:
                 raise
 
@@ -74,17 +82,32 @@ class CloudWatchHandler(logging.Handler):
     one uses daemon threads, which didn't work, didn't have our desired retrying
     functionality in the case of ThrottlingException, and we wanted some special
     case functionality to set the default stream to the current public facing IP.
+
+    emit() only appends the record to a buffer of at most `capacity` records.
+    When the buffer is full, `policy` decides what is lost: the 'oldest' or
+    'newest' records, or with 'sample' an increasing fraction of new records
+    is dropped once the buffer is half full. A builder thread formats records
+    into batches and hands up to `pipeline` of them to a sender thread, so the
+    next batch is built while the previous one is being sent. stats() returns
+    counts of queued, dropped, sent and failed records.
     '''
     END = 1
     FLUSH = 2
     EXTRA_MSG_PAYLOAD_SIZE = 26
+    POLICIES = ('oldest', 'newest', 'sample')
+    RETRY_DEADLINE = 600 # seconds to keep retrying a throttled batch before counting it as failed
 
     def setup(self, level):
         self.shutting_down = False
         self.client = self.session.boto.client('logs')
         self.stream = self.stream_init or ip() or 'localhost'
-        self.queue = queue.Queue()
+        self.buffer = collections.deque()
+        self.control = []
+        self.condition = threading.Condition()
+        self.batches = queue.Queue(maxsize=self.pipeline)
+        self.counters = dict(queued=0, dropped=0, sent=0, failed=0)
         self.thread = None
+        self.sender = None
         try:
             retry_log(self.client.create_log_stream, logGroupName=self.group, logStreamName=self.stream)
         except ClientError as e:
@@ -92,15 +115,41 @@ class CloudWatchHandler(logging.Handler):
                 raise
         super().__init__(level=level)
 
-    def put(self, msg):
-        '''Thread may appear stopped if the process is forked; restart if so'''
+    def start(self):
+        '''Threads may appear stopped if the process is forked; restart if so (call with the condition held)'''
         if self.thread is None or not self.thread.is_alive():
-            self.thread = threading.Thread(target=self.batch_sender)
+            self.thread = threading.Thread(target=self.batch_builder)
             self.thread.start()
-        self.queue.put(msg)
+        if self.sender is None or not self.sender.is_alive():
+            self.sender = threading.Thread(target=self.batch_sender)
+            self.sender.start()
+
+    def put(self, record):
+        '''Add a record to the buffer, dropping records according to the policy if it is full'''
+        with self.condition:
+            if not self.shutting_down:
+                self.start()
+            n, half = len(self.buffer), self.capacity // 2
+            if n >= self.capacity:
+                self.counters['dropped'] += 1
+                if self.policy != 'oldest':
+                    return
+                self.buffer.popleft()
+            elif self.policy == 'sample' and n > half and random.random() * (self.capacity - half) < n - half:
+                self.counters['dropped'] += 1
+                return
+            self.buffer.append(record)
+            self.counters['queued'] += 1
+            self.condition.notify()
+
+    def _control(self, msg):
+        with self.condition:
+            self.start()
+            self.control.append(msg)
+            self.condition.notify()
 
     def __init__(self, group, stream=None, level=0, interval=60, session=None,
-                 max_size=1024**2, max_count=10000, default=None):
+                 max_size=1024**2, max_count=10000, default=None, capacity=100000, policy='oldest', pipeline=2):
         self.session = AwsSession(session)
         self.group = str(group)
         self.stream_init = stream
@@ -109,43 +158,64 @@ class CloudWatchHandler(logging.Handler):
         self.max_size = float(max_size)
         self.interval = float(interval)
         self.default = default
+        self.capacity = int(capacity)
+        assert self.capacity > 0, 'Buffer capacity must be positive'
+        self.policy = policy
+        assert self.policy in self.POLICIES, 'Unknown drop policy {}'.format(policy)
+        self.pipeline = int(pipeline)
         self.token = None
         self.setup(level)
 
     def emit(self, record):
-        '''Add some keys and dump dict to JSON'''
-        if isinstance(record.msg, collections.Mapping):
-            msg = dict(scope=record.name, level=record.levelname)
-            msg.update(record.msg)
-            record.msg = json.dumps(msg, default=self.default)
-        record = dict(timestamp=int(record.created * 1000), message=self.format(record))
-
+        '''Buffer the record; it is formatted later on the batch builder thread'''
         if self.shutting_down:
             warnings.warn("Received message after logging system shutdown", CloudWatchWarning)
         self.put(record)
 
+    def render(self, record):
+        '''Add some keys and dump dict to JSON, returning the CloudWatch event or None on failure'''
+        try:
+            if isinstance(record.msg, collections.abc.Mapping):
+                msg = dict(scope=record.name, level=record.levelname)
+                msg.update(record.msg)
+                record.msg = json.dumps(msg, default=self.default)
+            return dict(timestamp=int(record.created * 1000), message=self.format(record))
+        except Exception:
+            self.handleError(record)
+
     def _submit_batch(self, batch):
         if not batch:
             return
-        sorted_batch = sorted(batch, key=lambda x: x['timestamp'])
-        kwargs = dict(logGroupName=self.group, logStreamName=self.stream, logEvents=sorted_batch)
+        if any(a['timestamp'] > b['timestamp'] for a, b in zip(batch, batch[1:])):
+            batch = sorted(batch, key=lambda x: x['timestamp'])
+        kwargs = dict(logGroupName=self.group, logStreamName=self.stream, logEvents=batch)
         try:
-            token, response = retry_log(self.client.put_log_events, **kwargs)
+            token, response = retry_log(self.client.put_log_events, deadline=self.RETRY_DEADLINE, **kwargs)
             if "rejectedLogEventsInfo" in response:
                 warnings.warn("Failed to deliver logs: {}".format(response), CloudWatchWarning)
             if token is not None:
                 self.token = token
+            sent = True
         except Exception as e:
             warnings.warn("Failed to deliver logs: {}".format(e), CloudWatchWarning)
+            sent = False
+        with self.condition:
+            self.counters['sent' if sent else 'failed'] += len(batch)
+
+    def stats(self):
+        '''Counts of queued, dropped, sent and failed records, and the number currently buffered'''
+        with self.condition:
+            return dict(self.counters, buffered=len(self.buffer))
 
     def flush(self):
         if self.shutting_down:
             return
-        self.put(self.FLUSH)
+        self._control(self.FLUSH)
 
     def __getstate__(self):
         self.flush()
-        out = {k: v for k, v in self.__dict__.items() if k not in ('client', 'queue', 'thread', 'lock')}
+        skip = ('client', 'buffer', 'control', 'condition', 'batches', 'counters', 'thread', 'sender', 'lock')
+        out = {k: v for k, v in self.__dict__.items() if k not in skip}
         return out
 
     def __setstate__(self, state):
@@ -153,39 +223,57 @@ class CloudWatchHandler(logging.Handler):
         self.__dict__.update(state)
         self.setup(level)
 
-    def batch_sender(self):
+    def batch_builder(self):
+        '''Format buffered records into batches and pass them to the sender'''
         batch, size, deadline = [], 0, None
         while True:
-            try:
-                msg = self.queue.get(block=True, timeout=max(0, deadline-time.time()) if deadline else None)
-            except queue.Empty:
-                msg = self.FLUSH
+            with self.condition:
+                timeout = None if deadline is None else max(0, deadline - time.time())
+                self.condition.wait_for(lambda: self.buffer or self.control, timeout)
+                records = list(self.buffer)
+                self.buffer.clear()
+                control, self.control = self.control, []
 
-            if isinstance(msg, dict):
+            for record in records:
+                msg = self.render(record)
+                if msg is None:
+                    continue
                 msg_size = len(msg['message']) + self.EXTRA_MSG_PAYLOAD_SIZE
                 if msg_size > self.max_size:
                     warnings.warn('Truncated CloudWatch message', CloudWatchWarning)
-                    msg['message'] = msg['message'][:self.max_size - msg_size]
+                    msg['message'] = msg['message'][:int(self.max_size) - msg_size]
+                    msg_size = int(self.max_size)
+                if batch and (size + msg_size > self.max_size or len(batch) >= self.max_count):
+                    self.batches.put(batch)
+                    batch, size, deadline = [], 0, None
                 batch.append(msg)
                 size += msg_size
-                if size > self.max_size or len(batch) > self.max_count:
-                    self._submit_batch(batch[:-1])
-                    batch, size, deadline = [msg], msg_size, None
                 if deadline is None:
                     deadline = time.time() + self.interval
-            else:
-                assert msg in (self.END, self.FLUSH), 'Unhandled message type {}'.format(type(msg))
-                self._submit_batch(batch)
-                if msg == self.END:
-                    return
+
+            if control or (deadline is not None and time.time() >= deadline):
+                if batch:
+                    self.batches.put(batch)
                 batch, size, deadline = [], 0, None
+            if self.END in control:
+                self.batches.put(self.END)
+                return
+
+    def batch_sender(self):
+        '''Send batches one at a time in the order they were built'''
+        while True:
+            batch = self.batches.get()
+            if batch == self.END:
+                return
+            self._submit_batch(batch)
 
     def close(self):
         if self.shutting_down:
             return
         self.shutting_down = True
-        self.put(self.END)
+        self._control(self.END)
         self.thread.join()
+        self.sender.join()
         super().close()
 
 ################################################################################
@@ -1,9 +1,19 @@
-import asyncio, uuid, distributed, logging, time
+import asyncio, collections, uuid, distributed, logging, time, pathlib, secrets, threading, urllib.request
 import fn
+from tornado.ioloop import IOLoop
 
-from .ostack import create_server, close_server, create_ip
-from .future import AsyncThread, failed, result, block
-from .script import scheduler_script, worker_script
+from .ostack import submit_server, close_server, submit_servers, activate_server, warm_lookups, get_inventory, limit_connection, \
+    attach_volume, spill_volume, SERVER_TIMEOUT
+from .ippool import FloatingIPPool, as_ip_pool
+from .future import AsyncThread, failed, result, block, on_done
+from .script import scheduler_script, worker_script, worker_payload, payload_digest, bootstrap_script, spill_info
+from .adaptive import JetStreamAdaptive
+from .timeline import Timeline, guest_marks
+from .teardown import Teardown, log_progress
+from .quota import check_quota
+from .cache import invalidate_lookups
+from .flavors import flavor_catalog, available_quota, optimize_mix
+from .environment import Environment, as_environment, environment_versions, publish_environment
 
 log = logging.getLogger(__name__)
 
@@ -11,56 +21,388 @@ log = logging.getLogger(__name__)
 
 class JetStreamCluster(fn.ClosingContext):
     async def _scheduler(self, ip, port, flavor, volume):
-        script = scheduler_script(ip, port, volume, python=self.python, preload=self.preload)
+        script = scheduler_script(ip, port, volume, python=self.python, preload=self.preload,
+            payload_port=self.payload_port if self.payloads == 'scheduler' else None, payload_token=self.payload_token)
         log.debug(fn.message('Submitting scheduler script', contents=script))
-        return await create_server(self.conn, name=self.name, network=self.network,
-            image=self.image, flavor=flavor, ip=ip, user_data=script)
+        server = await self._submitted(ip, self.runner.execute(submit_server, self.conn, name=self.name,
+            network=self.network, image=self.image, flavor=flavor, user_data=script))
+        server = await self.runner.execute(activate_server, self.conn, server, ip,
+            self._release(asyncio.current_task(), ip), self.timeline.marker(ip))
+        if volume is not None:
+            await self.runner.execute(attach_volume, self.conn, server, volume)
+        return server
 
-    def __init__(self, conn, name, flavor, image, network, port=8786, *, preload=None, python=None, volume=None):
+    def __init__(self, conn, name, flavor, image, network, port=8786, *, preload=None, python=None, volume=None,
+                 worker_flavor=None, ip_pool=None, standby=0, standby_mode='suspend', payloads=None, payload_port=8789,
+                 quota='clamp', environment=None, versions=None):
+        '''
+        `ip_pool` may be a FloatingIPPool (possibly shared with other clusters), or an
+        integer reserve for a recycling pool owned by this cluster and swept on close()
+        `standby` is the most workers to suspend or shelve (`standby_mode`) on scale
+        down instead of deleting them; scale up resumes these before booting new ones
+        `payloads` is where workers fetch the shared part of their script from, so that
+        each worker's user data is only a small bootstrap stub: 'scheduler' for a store
+        served by the scheduler on `payload_port`, or a directory which is at the same path
+        on this machine and the workers (e.g. a shared volume). None inlines the full script.
+        `quota` is what add_worker(s) do when the compute or floating IP quota is too small:
+        'clamp' (the default) to as many workers as fit (with a warning), 'reject' to raise
+        QuotaExceeded, or None to not check
+        `environment` is a packed environment for workers to run in, stored with the payloads:
+        True to pack this Python's environment, an archive path or an Environment (see
+        pack_environment). `versions` is 'warn' or 'raise' to have each worker compare its
+        module versions with this process's before it starts (see environment_versions).
+        The scheduler runs in the image's Python, whose versions must match these too.
+        '''
+        assert standby_mode in ('suspend', 'shelve'), standby_mode
+        assert environment is None or payloads is not None, 'A packed environment is shipped with the payloads'
+        assert versions in (None, 'warn', 'raise'), versions
         self.name = str(uuid.uuid4()) if name is None else name
         self.python = python
-        self.conn = conn
+        self.conn = limit_connection(conn)
         self.runner = AsyncThread()
         self.image = image
         self.network = network
         self.preload = preload
-        ip = create_ip(conn)
+        self.worker_flavor = flavor if worker_flavor is None else worker_flavor
+        self.launched = {}     # worker address -> (time of submission, list to record latency in)
+        self.boot_times = []   # seconds from submission to registration with the scheduler
+        self.resume_times = [] # seconds from resuming a standby worker to its registration
+        self.max_standby = int(standby)
+        self.standby_mode = standby_mode
+        self.standby = []      # suspended or shelved workers
+        self.processes = {}    # worker IP -> number of worker processes on it
+        self.registered = set()
+        self.timeline = Timeline()
+        self.adaptive = None
+        self.payloads = payloads
+        self.quota = quota
+        self.payload_port = int(payload_port)
+        self.payload_token = secrets.token_hex(16) # authenticates requests to the scheduler's payload store
+        self.published = {}    # payload digest -> future for its publication
+        self.environment = None if environment is None else as_environment(environment)
+        self.versions = versions
+        self.pools = {}        # pool label -> dict(flavor=, image=, **add_workers options)
+        self.labels = {}       # worker IP -> pool label
+        self.servers = {}      # launch task -> its server, as soon as it is submitted
+        self.closing = set()   # launch tasks closed before they submitted their server
+        self.releases = {}     # launch task -> release of its IP (see _release)
+        self.unsubmitted = collections.Counter() # flavor -> worker launches whose server is not submitted yet
+        self.quota_lock = threading.Lock()
+        warm_lookups(conn, flavors=[flavor, self.worker_flavor], images=[image], networks=[network])
+        self.owns_ips = not isinstance(ip_pool, FloatingIPPool)
+        self.ips = as_ip_pool(conn, ip_pool)
+        ip = self.ips.acquire()
+        self.timeline.start(ip)
         self.instances = [(ip, port, self.runner.put(self._scheduler(ip, port, flavor, volume)))]
 
+    def _release(self, task, ip):
+        '''
+        Release of the IP of an instance (keyed by its task) which only acts once, since both
+        a failed launch and close() may call it and the IP may meanwhile belong to another worker
+        The instance is forgotten first, so that it is gone when the pool hands out its IP again.
+        '''
+        if task not in self.releases:
+            lock, done = threading.Lock(), []
+            def release(_=None):
+                with lock:
+                    if done:
+                        return
+                    done.append(ip)
+                self._forget(task)
+                self.ips.release(ip)
+            self.releases[task] = release
+        return self.releases[task]
+
+    def _forget(self, task):
+        '''Remove the worker instance of a launch task, e.g. because the launch failed'''
+        for i in [i for i in self.instances[1:] if i[2] is task]:
+            for a in self._addresses(i):
+                self.launched.pop(a, None)
+            try:
+                self.instances.remove(i)
+            except ValueError: # closed meanwhile
+                continue
+            self.processes.pop(i[0], None)
+            self.labels.pop(i[0], None)
+
+    def _forget_failed(self, task):
+        if failed(task):
+            self._forget(task)
+
+    def _handover(self, old, new):
+        '''Move the server and IP release of an instance to the task which now stands for it (park or resume)'''
+        if old in self.servers:
+            self.servers[new] = self.servers.pop(old)
+        if old in self.releases:
+            self.releases[new] = self.releases.pop(old)
+
+    def _check_quota(self, flavor, n):
+        '''How many of n workers of a flavor to launch according to self.quota, counting those not submitted yet'''
+        with self.quota_lock:
+            pending = dict(+self.unsubmitted)
+        return check_quota(self.conn, flavor, n, policy=self.quota, free_ips=len(self.ips), pending=pending, ttl=5)
+
+    def _pending(self, flavor, count):
+        '''Count worker launches which are not in the quota usage yet (see _check_quota and _submitted)'''
+        with self.quota_lock:
+            self.unsubmitted[flavor] += count
+
+    async def _submitted(self, ip, submission, flavor=None):
+        '''
+        Await the submission of a server and record it, so that close() can delete it while it boots
+        If the instance was closed meanwhile, delete the server instead. The IP is released on failure.
+        A worker `flavor` is no longer counted as pending (see _pending) once the usage includes the server.
+        '''
+        task = asyncio.current_task()
+        release = self._release(task, ip)
+        try:
+            if task in self.closing:
+                raise RuntimeError('Instance {} was closed before its server was submitted'.format(ip))
+            server = await submission
+            if task in self.closing:
+                await self.runner.execute(close_server, self.conn, server, graceful=False)
+                raise RuntimeError('Instance {} was closed while its server was submitted'.format(ip))
+        except BaseException:
+            self.closing.discard(task)
+            if flavor is not None:
+                self._pending(flavor, -1)
+            await self.runner.execute(release)
+            raise
+        if flavor is not None:
+            invalidate_lookups('limits', self.conn) # before the server stops counting as pending
+            self._pending(flavor, -1)
+        self.servers[task] = server
+        self.timeline.mark(ip, 'submitted')
+        return server
+
+    def _claim(self, instances):
+        '''
+        Servers of instances to close, without waiting for them to become active. Instances
+        which have not submitted their server yet are marked to delete it (see _submitted).
+        '''
+        servers = []
+        for ip, _, task in instances:
+            server = self.servers.pop(task, None)
+            if server is not None:
+                servers.append(server)
+            elif not task.done():
+                self.closing.add(task)
+        return servers
+
     async def _close(self, instance):
-        await self.runner.execute(close_server, self.conn, await instance[2])
-        self.conn.delete_floating_ip(instance[0])
+        for server in self._claim([instance]):
+            await self.runner.execute(close_server, self.conn, server)
+        await self.runner.execute(self._release(instance[2], instance[0]))
+        self.releases.pop(instance[2], None)
 
-    def close(self, *, instances=None):
-        '''Stop a set of workers which defaults to all workers'''
-        instances = self.instances if instances is None else instances
-        return [self.runner.put(self._close(i)) for i in self.instances]
+    async def _teardown(self, instances, sweep, **kwargs):
+        servers = self._claim(instances)
+        releases = {i[0]: self._release(i[2], i[0]) for i in instances} # no-ops for failed launches
+        report = await self.runner.execute(Teardown(self.conn, **kwargs).run, servers,
+            list(releases), lambda ip: releases[ip]())
+        for i in instances:
+            self.releases.pop(i[2], None)
+        if sweep:
+            await self.runner.execute(self.ips.close)
+        return report
 
-    async def _worker(self, name, ip, script, *, image, flavor):
-        log.debug(fn.message('Submitting worker script', contents=script))
+    def close(self, *, instances=None, graceful=True, concurrency=16, progress=log_progress, timeout=300):
+        '''
+        Delete a set of instances (tuples, IPs or worker addresses) which defaults to all of them,
+        including standby workers, with at most `concurrency` API calls at once (see Teardown).
+        IPs go back to the pool, which is swept if everything is closed and the cluster owns it.
+        Returns a future for the TeardownReport.
+        '''
+        every = self.instances + self.standby
+        if instances is None:
+            closing, sweep = every, self.owns_ips
+        else:
+            given = set(i if isinstance(i, str) else tuple(i[:2]) for i in instances)
+            closing = [i for i in every if i[0] in given or tuple(i[:2]) in given or given.intersection(self._addresses(i))]
+            sweep = False
+        self.instances = [i for i in self.instances if i not in closing]
+        self.standby = [i for i in self.standby if i not in closing]
+        for i in closing:
+            for a in self._addresses(i):
+                self.launched.pop(a, None)
+        return self.runner.put(self._teardown(closing, sweep, graceful=graceful,
+            concurrency=concurrency, progress=progress, timeout=timeout))
+
+    @property
+    def payload_sources(self):
+        '''Where workers look for their payload'''
+        if self.payloads == 'scheduler':
+            return ['http://%s:%d' % (self.instances[0][0], self.payload_port)]
+        return [str(self.payloads)]
+
+    async def _publish(self, digest, payload, timeout=SERVER_TIMEOUT, interval=5):
+        '''Store a payload (str or packed Environment) under its digest where workers fetch it'''
+        if self.payloads != 'scheduler':
+            if isinstance(payload, Environment):
+                return await self.runner.execute(publish_environment, payload, self.payloads)
+            path = pathlib.Path(self.payloads) / digest
+            path.parent.mkdir(parents=True, exist_ok=True)
+            return await self.runner.execute(path.write_bytes, payload.encode())
         await self.instances[0][2]
-        return await create_server(self.conn, name=name, image=image,
-            flavor=flavor, ip=ip, network=self.network, user_data=script)
+        url = self.payload_sources[0] + '/' + digest
+        headers = {'Authorization': 'Bearer ' + self.payload_token}
+        def put():
+            if not isinstance(payload, Environment):
+                request = urllib.request.Request(url, data=payload.encode(), method='PUT', headers=headers)
+                return urllib.request.urlopen(request, timeout=30).read()
+            with open(payload.path, 'rb') as f:
+                request = urllib.request.Request(url, data=f, method='PUT', headers=dict(headers, **{'Content-Length': str(payload.size)}))
+                return urllib.request.urlopen(request, timeout=600).read()
+        end = time.time() + timeout
+        while True: # the store is up only once the scheduler has booted
+            try:
+                return await self.runner.execute(put)
+            except urllib.error.HTTPError: # the store is up, but refused the payload
+                raise
+            except OSError as e:
+                if time.time() > end:
+                    raise
+                log.debug(fn.message('Waiting for scheduler payload store', exception=e))
+            await asyncio.sleep(interval)
+
+    def _worker_script(self, host, port, **kwargs):
+        '''Full worker script, or a bootstrap stub if payloads are shared (publishing the payload once)'''
+        if self.versions is not None:
+            kwargs.update(versions=environment_versions(), check=self.versions)
+        if self.payloads is None:
+            return worker_script((host, port), scheduler=self.instances[0][:2], python=self.python,
+                persist=self.persist, **kwargs)
+        payload = worker_payload(persist=self.persist, **kwargs)
+        digest = payload_digest(payload)
+        if digest not in self.published:
+            log.debug(fn.message('Publishing worker payload', digest=digest, contents=payload))
+            self.published[digest] = self.runner.put(self._publish(digest, payload))
+        env = self.environment
+        if env is not None and env.digest not in self.published:
+            log.info(fn.message('Publishing packed environment', digest=env.digest, size=env.size))
+            self.published[env.digest] = self.runner.put(self._publish(env.digest, env))
+        return bootstrap_script((host, port), self.instances[0][:2], digest, self.payload_sources, python=self.python,
+            environment=None if env is None else env.digest, token=self.payload_token if self.payloads == 'scheduler' else None)
+
+    async def _published(self):
+        await self.instances[0][2]
+        for future in list(self.published.values()):
+            await future
+
+    async def _worker(self, name, ip, script, *, image, flavor, block_devices=None):
+        log.debug(fn.message('Submitting worker script', contents=script))
+        async def submit():
+            await self._published()
+            if asyncio.current_task() in self.closing:
+                raise RuntimeError('Instance {} was closed before its server was submitted'.format(ip))
+            return await self.runner.execute(submit_server, self.conn, name=name, image=image,
+                flavor=flavor, network=self.network, user_data=script, block_devices=block_devices)
+        server = await self._submitted(ip, submit(), flavor)
+        return await self.runner.execute(activate_server, self.conn, server, ip,
+            self._release(asyncio.current_task(), ip), self.timeline.marker(ip))
+
+    async def _submit(self, name, count, script, *, image, flavor, block_devices=None):
+        log.debug(fn.message('Submitting worker batch script', count=count, contents=script))
+        await self._published()
+        return await self.runner.execute(submit_servers, self.conn, name=name, image=image,
+            flavor=flavor, network=self.network, count=count, user_data=script, block_devices=block_devices)
 
-    def add_worker(self, flavor, image=None, port=8785, preload=None):
+    @staticmethod
+    def _spill(spill, thresholds):
+        '''Worker script keywords and block devices for a spill option (see add_worker)'''
+        assert not isinstance(spill, bool), 'spill is None, a spill target or a volume size in GB, not {}'.format(spill)
+        if isinstance(spill, int):
+            return dict(spill='volume', thresholds=thresholds), spill_volume(spill)
+        return dict(spill=spill, thresholds=thresholds), None
+
+    @staticmethod
+    async def _index(submitted, index):
+        return (await submitted)[index]
+
+    async def _activate(self, submitted, index, ip, flavor):
+        server = await self._submitted(ip, self._index(submitted, index), flavor)
+        return await self.runner.execute(activate_server, self.conn, server, ip,
+            self._release(asyncio.current_task(), ip), self.timeline.marker(ip))
+
+    def add_worker(self, flavor, image=None, port=8785, preload=None, nprocs=1, nthreads=None, pool=None, resources=None,
+                   spill=None, thresholds=None):
         '''
         wait for instance.status() to be active
         and wait for instance.ip()
         dask-worker {SCHEDULERIP}:8786 --nthreads 0 --nprocs 1
             --listen-address tcp://{WORKERETH}:8001
             --contact-address tcp://{WORKERIP}:8001
+        nprocs worker processes use ports port, port+1, ... on the same VM
+        If `pool` is given, the worker is labeled with it and named {pool}-{IP}-{port}
+        `resources` are custom dask resources of each process, on top of the detected ones
+        `spill` is None, 'ephemeral' to spill to the flavor's ephemeral disk, or a size in GB
+        for a new volume which is deleted with the worker. `thresholds` are the memory fractions
+        (target, spill, pause) of each worker process (see spill_script).
         '''
         name = '{}-{}'.format(self.name, len(self.instances))
         image = self.image if image is None else image
-        ip = create_ip(self.conn)
-        assert not any(ip == i[0] for i in self.instances)
+        self._check_quota(flavor, 1)
+        ip = self.ips.acquire()
+        try:
+            assert not any(ip == i[0] for i in self.instances)
+            self.timeline.start(ip)
+            options, devices = self._spill(spill, thresholds)
+            script = self._worker_script(ip, port, preload=preload, nprocs=nprocs, nthreads=nthreads, name=pool,
+                resources=resources, **options)
+            self._pending(flavor, 1)
+            inst = self.runner.put(self._worker(name, ip, script, image=image, flavor=flavor, block_devices=devices))
+        except Exception:
+            self.ips.release(ip)
+            raise
+        self.instances.append((ip, port, inst))
+        self.processes[ip] = nprocs
+        if pool is not None:
+            self.labels[ip] = pool
+        self._launch(self.instances[-1], self.boot_times)
+        on_done(inst, self._forget_failed)
+        return inst
+
+    def add_workers(self, n, flavor, image=None, port=8785, preload=None, batch=50, nprocs=1, nthreads=None, pool=None,
+                    resources=None, spill=None, thresholds=None):
+        '''
+        Add n workers using Nova multi-create requests of up to `batch` servers each
+        Floating IPs are allocated in bulk and each one is attached as soon as its
+        server is active, while the rest of the batch is still booting.
+        Returns one future per worker which resolves to its active server.
+        Each worker VM runs nprocs worker processes, labeled with `pool` and
+        advertising `resources` and spilling to `spill` (see add_worker).
+        n is first clamped to the quota, or rejected, according to self.quota.
+        '''
+        image = self.image if image is None else image
+        n = self._check_quota(flavor, n)
+        ips = self.ips.acquire_many(n)
+        futures = []
         try:
-            script = worker_script((ip, port), scheduler=self.instances[0][:2], python=self.python, preload=preload)
-            inst = self.runner.put(self._worker(name, ip, script, image=image, flavor=flavor))
-            self.instances.append((ip, port, inst))
+            assert not any(ip == i[0] for ip in ips for i in self.instances)
+            options, devices = self._spill(spill, thresholds)
+            script = self._worker_script(None, port, preload=preload, nprocs=nprocs, nthreads=nthreads, name=pool,
+                resources=resources, **options)
+            for start in range(0, n, batch):
+                chunk = ips[start:start + batch]
+                name = '{}-{}'.format(self.name, len(self.instances))
+                submitted = self.runner.put(self._submit(name, len(chunk), script, image=image, flavor=flavor,
+                    block_devices=devices))
+                for index, ip in enumerate(chunk):
+                    self.timeline.start(ip)
+                    self._pending(flavor, 1)
+                    inst = self.runner.put(self._activate(submitted, index, ip, flavor))
+                    self.instances.append((ip, port, inst))
+                    self.processes[ip] = nprocs
+                    if pool is not None:
+                        self.labels[ip] = pool
+                    self._launch(self.instances[-1], self.boot_times)
+                    on_done(inst, self._forget_failed)
+                    futures.append(inst)
         except Exception:
-            self.conn.delete_floating_ip(ip)
+            for ip in ips[len(futures):]:
+                self.ips.release(ip)
             raise
+        return futures
 
     @property
     def scheduler_address(self):
@@ -80,44 +422,207 @@ class JetStreamCluster(fn.ClosingContext):
 
     __repr__ = __str__
 
-    #def __getstate__(self):
-    #    out = dict(self.__dict__)
-    #    out.pop('runner')
-    #    out['workers'] = [() for w in self.workers]
-
-    # async def scale_up(self, n, **kwargs):
-    #     """ Bring the total count of tasks up to ``n``
-    #     This can be implemented either as a function or as a Tornado coroutine.
-    #     """
-    #     with error.context('Failed to scale_up workers'):
-    #         #kwargs2 = toolz.merge(self.worker_kwargs, kwargs)
-    #         self.add_worker()
-    #         #yield [self._start_worker(**kwargs2) for i in range(n - len(self.scheduler.tasks))]
-
-    #         # clean up any closed worker
-    #         #self.tasks = [w for w in self.tasks if w.status != 'closed']
-
-    # async def scale_down(self, tasks):
-    #     """ Remove ``workers`` from the cluster
-
-    #     Given a list of worker addresses this function should remove those
-    #     workers from the cluster.  This may require tracking which jobs are
-    #     associated to which worker address.
-
-    #     This can be implemented either as a function or as a Tornado coroutine.
-    #     """
-    #     with error.context('Failed to scale_down workers'):
-    #         self.stop_worker()
-    #         # clean up any closed worker
-    #         #self.workers = [w for w in self.workers if w.status != 'closed']
-    #         #workers = set(workers)
-
-    #         # we might be given addresses
-    #         #if all(isinstance(w, str) for w in workers):
-    #         #    workers = {w for w in self.workers if w.worker_address in workers}
-
-    #         # stop the provided workers
-    #         #yield [self._stop_worker(w) for w in workers]
+    @property
+    def persist(self):
+        '''Whether workers must restart dask on every boot, because they may be shelved'''
+        return self.max_standby > 0 and self.standby_mode == 'shelve'
+
+    def _addresses(self, instance):
+        '''Addresses of each worker process on an instance'''
+        ip, port = instance[:2]
+        return ['tcp://%s:%d' % (ip, port + i) for i in range(self.processes.get(ip, 1))]
+
+    def _launch(self, instance, times):
+        now = time.time()
+        addresses = self._addresses(instance)
+        self.registered.difference_update(addresses) # until observe() sees them again
+        self.launched.update((a, (now, times)) for a in addresses)
+
+    @property
+    def plan(self):
+        '''Addresses of all requested worker processes, except those whose launch failed'''
+        return {a for i in self.instances[1:] if not failed(i[2]) for a in self._addresses(i)}
+
+    requested = plan
+
+    @property
+    def observed(self):
+        '''Addresses of requested workers which have registered with the scheduler'''
+        return self.plan & self.registered
+
+    def observe(self, addresses):
+        '''Record the workers currently registered with the scheduler and their boot latencies'''
+        now = time.time()
+        self.registered = set(addresses)
+        for a in self.registered:
+            start, times = self.launched.pop(a, (None, None))
+            if start is not None:
+                times.append(now - start)
+                self.timeline.mark(a.split('://')[-1].rsplit(':', 1)[0], 'registered', now)
+
+    def collect_timeline(self, client=None):
+        '''
+        Add the in-guest boot and script start marks of the scheduler and workers to the timeline,
+        and mark workers registered if observe() has not already. Returns the Timeline.
+        '''
+        client = self.client() if client is None else client
+        info = client.scheduler_info()['workers']
+        now = time.time()
+        for a in info:
+            self.timeline.mark(a.split('://')[-1].rsplit(':', 1)[0], 'registered', now)
+        marks = list(client.run(guest_marks).values()) + [client.run_on_scheduler(guest_marks)]
+        for m in marks:
+            if 'ip' in m:
+                self.timeline.update(m.pop('ip'), m)
+        return self.timeline
+
+    def spill_report(self, client=None):
+        '''Spill directory and measured write and read throughput (MB/s) of each worker which spills'''
+        client = self.client() if client is None else client
+        return {a: s for a, s in client.run(spill_info).items() if s}
+
+    def boot_latency(self, default=300, window=20):
+        '''
+        Median of recent times from server submission (or standby resume, if any
+        workers are on standby) to worker registration
+        '''
+        times = self.resume_times if self.standby and self.resume_times else self.boot_times
+        times = sorted(times[-window:])
+        return times[len(times) // 2] if times else default
+
+    def latency_report(self):
+        '''Median and count of measured cold boot and standby resume latencies'''
+        median = lambda t: sorted(t)[len(t) // 2] if t else None
+        return {k: dict(median=median(t), count=len(t)) for k, t in
+                (('boot', self.boot_times), ('resume', self.resume_times))}
+
+    async def _park(self, instance):
+        task = asyncio.current_task()
+        self._handover(instance[2], task)
+        server = await instance[2]
+        try:
+            park = getattr(self.conn.compute, self.standby_mode + '_server')
+            await self.runner.execute(park, server)
+            return server
+        except Exception:
+            for s in [s for s in self.standby if s[2] is task]: # unless resume_workers took it already
+                self.standby.remove(s)
+            await self._close(instance[:2] + (task,))
+            raise
+
+    async def _resume(self, instance):
+        self._handover(instance[2], asyncio.current_task())
+        server = await instance[2]
+        resume = self.conn.compute.resume_server if self.standby_mode == 'suspend' else self.conn.compute.unshelve_server
+        await self.runner.execute(resume, server)
+        self.timeline.mark(instance[0], 'submitted')
+        out = await self.runner.execute(get_inventory(self.conn).wait, server, timeout=SERVER_TIMEOUT)
+        self.timeline.mark(instance[0], 'active')
+        return out
+
+    def resume_workers(self, n):
+        '''Resume up to n standby workers, returning one future per worker'''
+        futures = []
+        for _ in range(min(n, len(self.standby))):
+            ip, port, parked = self.standby.pop()
+            self.timeline.start(ip)
+            self.instances.append((ip, port, self.runner.put(self._resume((ip, port, parked)))))
+            self._launch(self.instances[-1], self.resume_times)
+            futures.append(self.instances[-1][2])
+        return futures
+
+    def scale_up(self, n, **kwargs):
+        '''
+        Add worker VMs to bring the total number of worker processes up to n,
+        resuming standby workers first
+        '''
+        kwargs.setdefault('flavor', self.worker_flavor)
+        missing, futures = n - len(self.plan), []
+        while missing > 0 and self.standby: # each resumed VM brings back the processes it had
+            missing -= self.processes.get(self.standby[-1][0], 1)
+            futures += self.resume_workers(1)
+        vms = -(-missing // kwargs.get('nprocs', 1))
+        return futures + (self.add_workers(vms, **kwargs) if vms > 0 else [])
+
+    def _closing(self, workers):
+        '''Worker instances with the given addresses or IPs, split into those to park and those to delete'''
+        workers = set(workers)
+        closing = [i for i in self.instances[1:] if i[0] in workers or workers.intersection(self._addresses(i))]
+        n = max(0, self.max_standby - len(self.standby))
+        return closing[:n], closing[n:]
+
+    def parked_workers(self, workers):
+        '''Addresses of the worker processes which scale_down(workers) would park rather than delete'''
+        return [a for i in self._closing(workers)[0] for a in self._addresses(i)]
+
+    def scale_down(self, workers):
+        '''Close the workers with the given addresses or IPs, keeping up to `standby` of them suspended or shelved'''
+        park, delete = self._closing(workers)
+        closing = park + delete
+        self.instances = [i for i in self.instances if i not in closing]
+        for i in closing:
+            self.labels.pop(i[0], None)
+            for a in self._addresses(i):
+                self.launched.pop(a, None)
+                self.registered.discard(a)
+        parked = [(i[0], i[1], self.runner.put(self._park(i))) for i in park]
+        self.standby.extend(parked)
+        return [i[2] for i in parked] + [self.runner.put(self._close(i)) for i in delete]
+
+    def add_pool(self, label, flavor, image=None, **options):
+        '''
+        Declare a labeled pool of workers with one flavor and image (default: the cluster's)
+        `options` are passed to add_workers when the pool is scaled, e.g. nprocs, nthreads or
+        custom `resources` which only this pool's workers advertise
+        '''
+        self.pools[label] = dict(options, flavor=flavor, image=self.image if image is None else image)
+        return self.pools[label]
+
+    def pool_instances(self, label):
+        '''Worker instances of a pool'''
+        return [i for i in self.instances[1:] if self.labels.get(i[0]) == label]
+
+    def scale_pool(self, label, n):
+        '''Add or close workers of a pool so it has n worker VMs. Returns futures of the added or closed workers'''
+        current = self.pool_instances(label)
+        if n > len(current):
+            return self.add_workers(n - len(current), pool=label, **self.pools[label])
+        return self.scale_down([i[0] for i in current[n:]])
+
+    def propose_mix(self, demands, flavors=None, quota=None, **kwargs):
+        '''
+        Propose a FlavorMix for `demands` (see optimize_mix) from all flavors of the connection
+        and its remaining quota, unless `flavors` (names or Flavor tuples) or `quota` are given
+        '''
+        catalog = flavor_catalog(self.conn)
+        if flavors is not None:
+            names = {getattr(f, 'name', f) for f in flavors}
+            catalog = [f for f in catalog if f.name in names]
+        return optimize_mix(demands, catalog, available_quota(self.conn) if quota is None else quota, **kwargs)
+
+    def launch_mix(self, mix, image=None, **options):
+        '''
+        Scale one pool per flavor of a FlavorMix (or dict of flavor -> count), labeled by the
+        flavor name, to its count. Returns a dict of label -> futures (see scale_pool)
+        '''
+        counts = getattr(mix, 'counts', mix)
+        out = {}
+        for flavor, n in counts.items():
+            if flavor not in self.pools:
+                self.add_pool(flavor, flavor, image, **options)
+            out[flavor] = self.scale_pool(flavor, n)
+        return out
+
+    async def _adapt(self, **kwargs):
+        self.loop = IOLoop.current()
+        return JetStreamAdaptive(self, **kwargs)
+
+    def adapt(self, **kwargs):
+        '''Start adaptive scaling, replacing any previous policy. See JetStreamAdaptive for keywords'''
+        if self.adaptive is not None:
+            self.runner.loop.call_soon_threadsafe(self.adaptive.stop)
+        self.adaptive = block(self.runner.put(self._adapt(**kwargs)))
+        return self.adaptive
 
 
 ################################################################################
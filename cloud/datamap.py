@@ -0,0 +1,143 @@
+'''
+Columnar view of where the cluster's data is, to find and fix memory skew between workers
+
+data_table() runs on the scheduler and returns one row per (key, worker holding it) as
+NumPy columns, which is much faster than task_distribution() over client.who_has() for
+millions of keys and includes byte counts. NumPy is only needed where tables are used,
+and pandas only for DataTable.to_pandas().
+'''
+import logging, typing
+
+import fn, distributed
+
+log = logging.getLogger(__name__)
+
+################################################################################
+
+def data_columns(dask_scheduler=None):
+    '''Columns of a DataTable for the scheduler's tasks (run this with client.run_on_scheduler)'''
+    import numpy as np
+    workers = getattr(dask_scheduler, 'workers', None)
+    workers = list(dask_scheduler.ncores if workers is None else workers)
+    index = {w: i for i, w in enumerate(workers)}
+    keys, holders, nbytes, states = [], [], [], []
+    if hasattr(dask_scheduler, 'tasks'):
+        for k, ts in dask_scheduler.tasks.items():
+            for ws in ts.who_has or (None,):
+                keys.append(k)
+                holders.append(-1 if ws is None else index.get(ws.address, -1))
+                nbytes.append(ts.nbytes or 0)
+                states.append(ts.state)
+    else: # older schedulers keep dicts of key -> value
+        for k, state in dask_scheduler.task_state.items():
+            for w in dask_scheduler.who_has.get(k) or (None,):
+                keys.append(k)
+                holders.append(index.get(w, -1))
+                nbytes.append(dask_scheduler.nbytes.get(k, 0))
+                states.append(state)
+    names, codes = np.unique(np.array(states, dtype=str), return_inverse=True)
+    key = np.empty(len(keys), dtype=object)
+    for i, k in enumerate(keys): # not key[:] = keys, which broadcasts tuple keys into 2 dimensions
+        key[i] = k
+    return dict(key=key, worker=np.array(holders, dtype=np.int32), nbytes=np.maximum(np.array(nbytes, dtype=np.int64), 0),
+                state=codes.astype(np.int16).reshape(-1), workers=tuple(workers), states=tuple(names.tolist()))
+
+class DataTable(typing.NamedTuple):
+    '''One row per (key, worker holding it); keys held nowhere have worker -1'''
+    key: object      # object array of keys
+    worker: object   # int32 array of indices into workers
+    nbytes: object   # int64 array of bytes of the key
+    state: object    # int16 array of indices into states
+    workers: tuple   # worker addresses
+    states: tuple    # task state names
+
+    @property
+    def rows(self):
+        return len(self.key)
+
+    def where(self, mask):
+        '''Table of the rows selected by a boolean array'''
+        return self._replace(key=self.key[mask], worker=self.worker[mask], nbytes=self.nbytes[mask], state=self.state[mask])
+
+    def in_state(self, *states):
+        '''Table of the rows whose task is in one of the given states'''
+        import numpy as np
+        return self.where(np.isin(self.state, [self.states.index(s) for s in states if s in self.states]))
+
+    def worker_bytes(self):
+        '''Array of bytes held by each worker (in the order of workers)'''
+        import numpy as np
+        held = self.worker >= 0
+        return np.bincount(self.worker[held], weights=self.nbytes[held], minlength=len(self.workers)).astype(np.int64)
+
+    def distribution(self):
+        '''Dict of worker address (or None) -> list of keys, like task_distribution()'''
+        import numpy as np
+        order = np.argsort(self.worker, kind='stable')
+        codes, starts = np.unique(self.worker[order], return_index=True)
+        groups = np.split(self.key[order], starts[1:])
+        return {(None if c < 0 else self.workers[c]): g.tolist() for c, g in zip(codes.tolist(), groups)}
+
+    def to_pandas(self):
+        '''DataFrame with categorical worker and state columns'''
+        import pandas as pd
+        return pd.DataFrame(dict(key=self.key,
+            worker=pd.Categorical.from_codes(self.worker, self.workers),
+            nbytes=self.nbytes,
+            state=pd.Categorical.from_codes(self.state, self.states)))
+
+def data_table(client):
+    '''DataTable of all the tasks known to the scheduler of a client'''
+    return DataTable(**client.run_on_scheduler(data_columns))
+
+################################################################################
+
+class Skew(typing.NamedTuple):
+    '''Bytes held by each worker, and how unevenly: ratio is max / mean - 1 (0 when balanced)'''
+    bytes: dict
+    mean: float
+    max: float
+    ratio: float
+    cv: float   # coefficient of variation
+
+    def __str__(self):
+        return 'Skew(workers={}, mean={:.3g}B, max={:.3g}B, ratio={:.2f}, cv={:.2f})'.format(
+            len(self.bytes), self.mean, self.max, self.ratio, self.cv)
+
+def memory_skew(table):
+    '''Skew of the bytes in memory on each worker of a DataTable'''
+    held = table.in_state('memory').worker_bytes()
+    mean = float(held.mean()) if len(held) else 0.0
+    top = float(held.max()) if len(held) else 0.0
+    ratio = top / mean - 1 if mean else 0.0
+    cv = float(held.std()) / mean if mean else 0.0
+    return Skew(dict(zip(table.workers, held.tolist())), mean, top, ratio, cv)
+
+################################################################################
+
+class Balance(typing.NamedTuple):
+    before: Skew
+    after: Skew
+    actions: list
+
+def balance(client, threshold=0.25, *, replicate=None, n=None):
+    '''
+    Rebalance the data in memory if its Skew ratio is above `threshold`
+    `replicate` is a list of keys or futures to copy to `n` workers (default: all), e.g. inputs
+    which many tasks read, so that reading them does not concentrate work on their holders.
+    Returns a Balance with the skew before and after.
+    '''
+    before = memory_skew(data_table(client))
+    actions = []
+    if before.ratio > threshold:
+        log.info(fn.message('Rebalancing skewed cluster memory', skew=str(before), threshold=threshold))
+        client.rebalance()
+        actions.append('rebalance')
+    if replicate:
+        futures = [k if hasattr(k, 'key') else distributed.Future(k, client) for k in replicate]
+        client.replicate(futures, n=n)
+        actions.append('replicate')
+    after = memory_skew(data_table(client)) if actions else before
+    return Balance(before, after, actions)
+
+################################################################################
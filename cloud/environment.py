@@ -0,0 +1,148 @@
+'''
+Pack the client's Python environment once, so that workers can run in it without a baked image
+
+pack_environment() archives a conda environment prefix with conda-pack, so that it can be
+relocated on the workers, and names it by its sha256. Other prefixes (e.g. virtualenvs) are
+only archived as is if the caller says they are relocatable, and system prefixes such as /usr
+never are. Archives are cached locally by a fingerprint of the files in the prefix, so the
+environment is only packed again when it changes. Workers fetch and unpack it at boot (see
+templates.environment) and compare their module versions with environment_versions().
+
+The scheduler does not run in the packed environment but in its image's Python, so the
+versions of dask, distributed and what tasks send through the scheduler must match there.
+'''
+import os, sys, json, time, shutil, hashlib, logging, tarfile, tempfile, typing
+
+import fn
+
+log = logging.getLogger(__name__)
+
+CACHE = '~/.cache/dask-jetstream/environments'
+
+# Prefixes of system Pythons, which are not packed
+SYSTEM_PREFIXES = ('/', '/usr', '/usr/local', '/opt/local')
+
+################################################################################
+
+class Environment(typing.NamedTuple):
+    path: str   # archive (.tar.gz)
+    digest: str # sha256 of the archive
+    size: int   # bytes
+
+def file_digest(path):
+    '''sha256 hex digest of a file'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(2**22), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+def _skip(name):
+    return name == '__pycache__' or name.endswith('.pyc')
+
+def fingerprint(prefix):
+    '''Hash of the paths, sizes and modification times of the files in an environment'''
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(prefix):
+        dirs[:] = sorted(d for d in dirs if not _skip(d))
+        for name in sorted(files):
+            if not _skip(name):
+                try:
+                    s = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                digest.update('{}\0{}\0{}\n'.format(os.path.relpath(os.path.join(root, name), prefix), s.st_size, s.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+def _pack(prefix, output, conda):
+    if conda:
+        import conda_pack
+        conda_pack.pack(prefix=prefix, output=output, format='tar.gz', force=True)
+    else:
+        with tarfile.open(output, 'w:gz') as f:
+            f.add(prefix, arcname='.', filter=lambda t: None if _skip(os.path.basename(t.name)) else t)
+
+def _has_conda_pack():
+    try:
+        import conda_pack
+        return True
+    except ImportError:
+        return False
+
+def pack_environment(prefix=None, cache=CACHE, conda=None, relocatable=False):
+    '''
+    Return an Environment for an environment prefix (default: this Python's), packing it
+    into `cache` unless an archive of the same files is already there
+    conda is whether to use conda-pack (default: if it is installed and prefix is a conda
+    environment). Otherwise the prefix is archived as is, which is refused unless
+    `relocatable` is True; system prefixes such as /usr are always refused.
+    '''
+    prefix = os.path.realpath(sys.prefix if prefix is None else prefix)
+    if prefix in SYSTEM_PREFIXES:
+        raise ValueError('Not packing the system Python prefix {}: use a conda environment or virtualenv'.format(prefix))
+    if conda is None:
+        conda = os.path.isdir(os.path.join(prefix, 'conda-meta')) and _has_conda_pack()
+    if not conda and not relocatable:
+        raise ValueError('{} is not a conda environment packed with conda-pack; pass relocatable=True if it '
+                         'can be unpacked at another path as is'.format(prefix))
+    cache = os.path.expanduser(cache)
+    os.makedirs(cache, exist_ok=True)
+    index_path = os.path.join(cache, 'index.json')
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    key = '{}:{}'.format('conda-pack' if conda else 'tar', fingerprint(prefix)) # the two archives differ
+    digest = index.get(key)
+    if digest and os.path.isfile(os.path.join(cache, digest)):
+        path = os.path.join(cache, digest)
+        return Environment(path, digest, os.path.getsize(path))
+    start = time.time()
+    fd, partial = tempfile.mkstemp(dir=cache, suffix='.partial')
+    os.close(fd)
+    try:
+        _pack(prefix, partial, conda)
+        digest = file_digest(partial)
+        path = os.path.join(cache, digest)
+        os.replace(partial, path)
+    except BaseException:
+        os.remove(partial)
+        raise
+    index[key] = digest
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    size = os.path.getsize(path)
+    log.info(fn.message('Packed environment', prefix=prefix, digest=digest, size=size, conda=conda, seconds=time.time() - start))
+    return Environment(path, digest, size)
+
+def as_environment(environment):
+    '''An Environment from one, from True (pack this environment), or from an archive path'''
+    if environment is True:
+        return pack_environment()
+    if isinstance(environment, Environment):
+        return environment
+    path = os.path.expanduser(str(environment))
+    return Environment(path, file_digest(path), os.path.getsize(path))
+
+################################################################################
+
+def environment_versions(packages=None):
+    '''
+    Versions of the top-level modules imported on the client (see module_versions), or of
+    just `packages`, for workers to compare theirs with
+    '''
+    from . import module_versions
+    versions = {k: v for k, v in module_versions().items() if '.' not in k and not k.startswith('_')}
+    return versions if packages is None else {k: v for k, v in versions.items() if k in packages}
+
+def publish_environment(environment, directory):
+    '''Copy an Environment into a shared directory under its digest, unless it is already there'''
+    path = os.path.join(os.path.expanduser(directory), environment.digest)
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(environment.path, path + '.partial')
+        os.replace(path + '.partial', path)
+    return path
+
+################################################################################
@@ -2,7 +2,11 @@ import uuid, logging, time, typing
 from concurrent.futures import ThreadPoolExecutor
 import fn
 
-from .ostack import create_server, close_server, create_ip
+from .ostack import create_server, close_server, warm_lookups, limit_connection
+from .ippool import IPPools
+from .timeline import Timeline
+from .placement import Placement
+from .quota import preflight, combine, apply_quota
 
 log = logging.getLogger(__name__)
 
@@ -31,10 +35,11 @@ class FksInstance(typing.NamedTuple):
     def interface_ip(self):
         return self.server.interface_ip
 
-    def close(self):
+    def close(self, release=None):
+        '''Close the server and pass its IP to `release` (default: delete it)'''
         ip = self.interface_ip
         close_server(self.connection, self.server)
-        self.connection.delete_floating_ip(ip)
+        (self.connection.delete_floating_ip if release is None else release)(ip)
         return ip
 
     def __repr__(self):
@@ -50,17 +55,28 @@ class FksCluster:
     def all_active_servers(self):
         return [FksInstance(s, c) for c in self.connections for s in c.list_servers() if s.status == 'ACTIVE']
 
-    def __init__(self, connections, name, image, network, *, queue, threads=16):
+    def __init__(self, connections, name, image, network, *, queue, threads=16, ip_pools=None, quota=None):
+        '''
+        `ip_pools` is None, an integer IP reserve per connection, or an iterable of FloatingIPPool
+        `quota` is what scale_up does when the quota is too small: 'clamp', 'reject' or None (the
+        default) to not check (see apply_quota)
+        '''
         self.name = str(uuid.uuid4()) if name is None else name
-        self.connections = list(connections)
+        self.connections = [limit_connection(c) for c in connections]
         self.pool = ThreadPoolExecutor(threads)
+        self.ip_pools = IPPools(ip_pools)
+        self.timeline = Timeline() # API-side phases of each server, keyed by IP
+        self.placement = Placement(self.connections)
+        self.quota = quota
         self.image = image
         self.network = network
         self.queue = queue
+        for c in self.connections:
+            warm_lookups(c, images=[image], networks=[network])
         self.refresh()
 
     def _close(self, instance):
-        ip = instance.close()
+        ip = instance.close(self.ip_pools[instance.connection].release)
         try:
             del self.workers[next(i for i, w in enumerate(self.workers) if w.id == instance.id)]
         except StopIteration:
@@ -74,34 +90,57 @@ class FksCluster:
 
     def close(self):
         '''Stop all workers and the head nodes'''
-        return [self.pool.submit(self._close, i) for i in self.workers]
+        tasks = [self.pool.submit(self._close, i) for i in self.workers]
+        return tasks + [self.pool.submit(self._sweep, tasks)]
+
+    def _sweep(self, tasks):
+        [t.exception() for t in tasks]
+        return self.ip_pools.close()
 
     def _worker(self, conn, *, script, image, flavor):
-        ip = create_ip(conn)
-        assert not any(ip == i.interface_ip for i in self.workers)
+        '''Launch a worker on conn, or on the connections chosen by self.placement if conn is None'''
+        create = fn.partial(self._create, script=script, image=image, flavor=flavor)
+        return self.placement.launch(flavor, create, None if conn is None else [conn])[1]
+
+    def _create(self, conn, *, script, image, flavor):
+        pool = self.ip_pools[conn]
+        ip = pool.acquire()
         try:
+            assert not any(ip == i.interface_ip for i in self.workers)
+            self.timeline.start(ip)
+        except Exception:
+            pool.release(ip)
+            raise
+        try: # create_server releases the IP if it fails
             log.info('creating worker at {}'.format(ip))
             server = create_server(conn, name=self.name + '-worker-' + ip.replace('.', '-'),
-                image=image, flavor=flavor, ip=ip, network=self.network, user_data=script)
+                image=image, flavor=flavor, ip=ip, release=pool.release, network=self.network, mark=self.timeline.marker(ip), user_data=script)
             server.interface_ip  = ip
-            self.workers.append(server)
+            self.workers.append(FksInstance(server, conn))
             return ip
         except Exception as e:
             log.info('failed to create worker at {}: {}'.format(ip, e))
-            conn.delete_floating_ip(ip)
             raise
 
+    def _check_quota(self, conn, flavor, n):
+        '''How many of n workers to launch on conn (or all connections if None) according to self.quota'''
+        if self.quota is None or n <= 0:
+            return n
+        conns = self.connections if conn is None else [conn]
+        return apply_quota(combine([preflight(c, flavor, n, free_ips=len(self.ip_pools[c])) for c in conns]), self.quota)
+
     def add_worker(self, conn, *, flavor, script, image=None):
-        '''Add a single worker (asynchronous)'''
-        if conn not in self.connections:
-            self.connections.append(conn)
+        '''Add a single worker (asynchronous) on conn, or wherever self.placement puts it if conn is None'''
+        if conn is not None and conn not in self.connections:
+            self.connections.append(limit_connection(conn))
         image = self.image if image is None else image
         return self.pool.submit(self._worker, conn, script=script, image=image, flavor=flavor)
 
     def scale_up(self, conn, n, *, flavor, image=None, slots, sleep=30):
-        '''Add workers to get up to n total workers'''
+        '''Add workers to get up to n total workers, all on conn, or spread by self.placement if conn is None'''
         script = SCRIPT.format(queue=self.queue, sleep=sleep, slots=slots)
-        tasks = [self.add_worker(conn, flavor=flavor, script=script, image=image) for _ in range(len(self.workers), n)]
+        n = self._check_quota(conn, flavor, n - len(self.workers))
+        tasks = [self.add_worker(conn, flavor=flavor, script=script, image=image) for _ in range(n)]
         results = [t.result() for t in tasks]
         self.refresh()
         return results
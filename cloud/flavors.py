@@ -0,0 +1,145 @@
+'''
+Choose a mix of worker flavors for a set of task demands under a quota
+
+Each Demand is a group of tasks with the same THREADS and memory needs. A worker VM
+of a flavor runs min(vcpus // threads, ram // memory) tasks of a group at once. The
+makespan of a mix is estimated by a fractional assignment of each group's work to
+the flavors that run it most densely, and the optimizer adds one VM at a time,
+choosing the flavor that shortens the makespan most per unit of scarcest quota.
+'''
+import logging, typing
+
+from .cache import LOOKUPS
+from .quota import get_compute_limits, available
+
+log = logging.getLogger(__name__)
+
+################################################################################
+
+class Demand(typing.NamedTuple):
+    '''`count` tasks, each using `threads` cores and `memory` MB for `duration` seconds'''
+    count: int
+    threads: int = 1
+    memory: float = 0
+    duration: float = 1.0
+
+class Flavor(typing.NamedTuple):
+    name: str
+    vcpus: int
+    ram: float # MB
+
+class FlavorMix(typing.NamedTuple):
+    counts: dict     # flavor name -> number of VMs
+    makespan: float  # estimated seconds
+    usage: dict      # instances, cores and ram used by the mix
+
+    def __str__(self):
+        return 'FlavorMix({}, makespan={:.4g}s)'.format(', '.join('{} x {}'.format(n, f) for f, n in self.counts.items()), self.makespan)
+
+def flavor_catalog(conn, ttl=600):
+    '''All flavors of a connection as Flavor tuples'''
+    fetch = lambda: [Flavor(f.name, f.vcpus, f.ram) for f in conn.compute.flavors()]
+    return LOOKUPS.get(('flavors', conn), fetch, ttl=ttl)
+
+def available_quota(conn, ttl=30):
+    '''Remaining instances, cores and ram (MB) of a connection'''
+    limits = get_compute_limits(conn, ttl)
+    return dict(instances=available(limits.max_total_instances, limits.total_instances_used),
+                cores=available(limits.max_total_cores, limits.total_cores_used),
+                ram=available(limits.max_total_ram_size, limits.total_ram_used))
+
+################################################################################
+
+def slots(flavor, demand):
+    '''How many tasks of a demand one VM of a flavor runs at once'''
+    by_memory = flavor.ram // demand.memory if demand.memory else float('inf')
+    return int(min(flavor.vcpus // max(1, demand.threads), by_memory))
+
+def makespan(counts, flavors, demands, tol=1e-3):
+    '''
+    Estimated seconds for VMs (Flavor or flavor name -> count) to finish the demands, or inf if some demand fits none
+    Bisects on the makespan T: for each T, groups which fit the fewest flavors go first and take
+    VM-seconds from the flavors which run them most densely.
+    '''
+    flavors = {f.name: f for f in flavors}
+    flavor = lambda f: f if isinstance(f, Flavor) else flavors[f]
+    density = [{f: slots(flavor(f), d) for f, n in counts.items() if n and slots(flavor(f), d) > 0} for d in demands]
+    if any(d.count and not s for d, s in zip(demands, density)):
+        return float('inf')
+    order = sorted(range(len(demands)), key=lambda i: len(density[i]))
+
+    def feasible(T):
+        left = {f: n * T for f, n in counts.items()} # VM-seconds
+        for i in order:
+            work = demands[i].count * demands[i].duration # task-seconds
+            for f in sorted(density[i], key=density[i].get, reverse=True):
+                used = min(left[f], work / density[i][f])
+                left[f] -= used
+                work -= used * density[i][f]
+                if work <= 1e-9:
+                    break
+            if work > 1e-9:
+                return False
+        return True
+
+    lo = max([d.duration for d in demands if d.count] or [0])
+    hi = max(lo, 1.0)
+    while not feasible(hi):
+        hi *= 2
+    if feasible(lo):
+        return lo
+    while hi - lo > tol * hi:
+        mid = (lo + hi) / 2
+        lo, hi = (lo, mid) if feasible(mid) else (mid, hi)
+    return hi
+
+def optimize_mix(demands, flavors, quota, *, max_workers=None, min_gain=0.01):
+    '''
+    Propose how many VMs of each flavor to launch to minimize the makespan of `demands`
+    - `flavors`: Flavor tuples (see flavor_catalog)
+    - `quota`: remaining dict(instances=, cores=, ram=) (see available_quota)
+    - stops adding VMs when none fits in the quota, `max_workers` is reached, or the
+      best addition shortens the makespan by less than a fraction `min_gain`
+    '''
+    demands, flavors = [Demand(*d) if not isinstance(d, Demand) else d for d in demands], list(flavors)
+    counts = {f: 0 for f in flavors} # keyed by Flavor, since names need not be unique
+    used = dict(instances=0, cores=0, ram=0)
+    if not any(d.count > 0 for d in demands):
+        return FlavorMix({}, 0.0, used)
+    need = lambda f: dict(instances=1, cores=f.vcpus, ram=f.ram)
+    fits = lambda f: all(used[k] + v <= quota.get(k, float('inf')) for k, v in need(f).items())
+    cost = lambda f: max(v / quota[k] if quota.get(k, float('inf')) not in (0, float('inf')) else 0
+                         for k, v in need(f).items()) or 1e-9
+    runnable = lambda: sum(any(n and slots(f, d) for f, n in counts.items()) for d in demands)
+    current, covered = float('inf'), 0
+    while max_workers is None or used['instances'] < max_workers:
+        options = []
+        for f in flavors:
+            if fits(f):
+                counts[f] += 1
+                t, c = makespan(counts, flavors, demands), runnable()
+                counts[f] -= 1
+                if current == float('inf'): # until every demand can run, cover the most demands
+                    options.append(((c, -t, -cost(f)), t, c, f))
+                else:
+                    options.append((((current - t) / cost(f), -t, -cost(f)), t, c, f))
+        if not options:
+            break
+        _, t, c, f = max(options, key=lambda o: o[0])
+        if current == float('inf') and t == float('inf') and c <= covered:
+            break # some demand fits no flavor
+        if current < float('inf') and (t >= current or current - t < min_gain * current):
+            break
+        counts[f] += 1
+        for k, v in need(f).items():
+            used[k] += v
+        current, covered = t, c
+    counts = {f: n for f, n in counts.items() if n}
+    if not counts:
+        raise ValueError('No flavor fits the demands within the quota')
+    names = {}
+    for f, n in counts.items():
+        names[f.name] = names.get(f.name, 0) + n
+    return FlavorMix(names, makespan(counts, flavors, demands), used)
+
+################################################################################
@@ -1,4 +1,4 @@
-import asyncio, time, threading
+import asyncio, time, threading, queue
 from concurrent.futures import Future, ThreadPoolExecutor
 
 import fn
@@ -14,32 +14,56 @@ def result(future):
 
 ################################################################################
 
-def block(future, timeout=None, resolution=0.2, throw=True):
-    '''Block on a future until it is done'''
-    end = None if timeout is None else time.time() + timeout
-    while not future.done():
-        time.sleep(resolution)
-        if end is not None and end < time.time():
+def on_done(future, callback):
+    '''
+    Call callback(future) once the future is done
+    Works from any thread for both concurrent and asyncio futures
+    '''
+    if isinstance(future, asyncio.Future):
+        future.get_loop().call_soon_threadsafe(future.add_done_callback, callback)
+    else:
+        future.add_done_callback(callback)
+
+def block(future, timeout=None, resolution=None, throw=True):
+    '''Block on a future until it is done. `resolution` is unused and kept for compatibility'''
+    if not future.done():
+        event = threading.Event()
+        on_done(future, lambda _: event.set())
+        if not event.wait(timeout):
             return None
     try:
         return future.result()
     except Exception as e:
         if throw: raise e
 
+def as_completed(futures, timeout=None):
+    '''Yield futures as soon as each one is done. Raises TimeoutError if some are unfinished at the timeout'''
+    futures = set(futures)
+    done = queue.Queue()
+    for f in futures:
+        on_done(f, done.put)
+    end = None if timeout is None else time.time() + timeout
+    for i in range(len(futures)):
+        try:
+            yield done.get(timeout=None if end is None else max(0, end - time.time()))
+        except queue.Empty:
+            raise TimeoutError('{} of {} futures are unfinished'.format(len(futures) - i, len(futures)))
+
 ################################################################################
 
 class AsyncThread:
     def __init__(self):
         self.loop = None
+        self.started = threading.Event()
         self.pool = ThreadPoolExecutor()
         self.thread = threading.Thread(target=self.run)
         self.thread.start()
-        while self.loop is None:
-            time.sleep(0.1)
+        self.started.wait()
 
     def run(self):
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.started.set)
         self.loop.run_forever()
 
     def stop(self):
@@ -55,9 +79,20 @@ class AsyncThread:
         self.loop.call_soon_threadsafe(p)
         return future.result()
 
-    def wait(self, futures, timeout):
-        fut = self.put(asyncio.wait(list(futures), timeout=timeout))
-        return block(fut, timeout=timeout, throw=False)
+    def wait(self, futures, timeout=None):
+        '''Wait for tasks to finish and return the (done, pending) sets'''
+        futures = set(futures)
+        try:
+            for _ in as_completed(futures, timeout=timeout):
+                pass
+        except TimeoutError:
+            pass
+        done = {f for f in futures if f.done()}
+        return done, futures - done
+
+    def as_completed(self, futures, timeout=None):
+        '''Yield tasks as soon as each one is done'''
+        return as_completed(futures, timeout=timeout)
 
     def cancel(self, task):
         self.loop.call_soon_threadsafe(task.cancel)
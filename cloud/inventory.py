@@ -0,0 +1,182 @@
+'''
+Background snapshots of all servers and floating IPs on a connection
+
+One poller per connection lists servers and floating IPs once per interval, so
+looking up or waiting on N instances costs the same API traffic as one.
+'''
+import time, threading, logging
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import fn
+
+log = logging.getLogger(__name__)
+
+PENDING = object()
+
+################################################################################
+
+def server_addresses(server):
+    '''All fixed and floating addresses of an openstacksdk or novaclient server'''
+    nets = getattr(server, 'networks', None) # novaclient: {net: [addr, ...]}
+    if nets:
+        return [a for v in nets.values() for a in v]
+    nets = getattr(server, 'addresses', None) or {} # openstacksdk: {net: [{'addr': ...}, ...]}
+    return [a['addr'] for v in nets.values() for a in v]
+
+################################################################################
+
+class Inventory:
+    '''
+    Periodically refreshed index of servers (by id, name and address) and
+    floating IPs (by address and id) which resolves watchers after each poll
+    - `fetch_servers`: callable returning all servers
+    - `fetch_ips`: callable returning all floating IPs as mappings
+    '''
+    def __init__(self, fetch_servers, fetch_ips, interval=5):
+        self.fetch_servers = fetch_servers
+        self.fetch_ips = fetch_ips
+        self.interval = float(interval)
+        self.lock = threading.Condition()
+        self.servers, self.names, self.addresses, self.ips, self.ip_ids = {}, {}, {}, {}, {}
+        self.time = None
+        self.version = 0
+        self.watchers = [] # (predicate, Future)
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopped.clear()
+                self.thread = threading.Thread(target=self.run, name='inventory', daemon=True)
+                self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.clear()
+            try:
+                self.poll()
+            except Exception as e:
+                log.warning(fn.message('Failed to poll OpenStack inventory', exception=e))
+            self.wake.wait(self.interval)
+
+    def poll(self):
+        '''Take one snapshot of servers and IPs, then resolve any finished watchers'''
+        start = time.time()
+        servers, ips = list(self.fetch_servers()), list(self.fetch_ips())
+        with self.lock:
+            self.servers = {s.id: s for s in servers}
+            self.names = {s.name: s for s in servers}
+            self.addresses = {a: s for s in servers for a in server_addresses(s)}
+            self.ips = {i['floating_ip_address']: i for i in ips}
+            self.ip_ids = {i['id']: i for i in ips}
+            self.time = start # the snapshot may miss servers created after this
+            self.version += 1
+            watchers, self.watchers = self.watchers, []
+            self.lock.notify_all()
+        for predicate, future in watchers:
+            if future.done():
+                continue
+            try:
+                out = predicate(self)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            if out is PENDING:
+                with self.lock:
+                    self.watchers.append((predicate, future))
+            else:
+                future.set_result(out)
+
+    def refresh(self, timeout=60):
+        '''Wait until a snapshot newer than the current one has been taken'''
+        self.start()
+        with self.lock:
+            version = self.version
+            self.wake.set()
+            if not self.lock.wait_for(lambda: self.version > version, timeout):
+                raise TimeoutError('OpenStack inventory was not refreshed')
+
+    def _find(self, indices, key):
+        with self.lock:
+            return next((d[key] for d in indices() if key in d), None)
+
+    def _get(self, indices, key, refresh):
+        if self.time is None:
+            self.refresh()
+        out = self._find(indices, key)
+        if out is None and refresh:
+            self.refresh()
+            out = self._find(indices, key)
+        return out
+
+    def server(self, key, refresh=True):
+        '''Server by id, name or address, or None. Refresh once if missing from the snapshot'''
+        return self._get(lambda: (self.servers, self.names, self.addresses), key, refresh)
+
+    def ip(self, key, refresh=True):
+        '''Floating IP by address or id, or None. Refresh once if missing from the snapshot'''
+        return self._get(lambda: (self.ips, self.ip_ids), key, refresh)
+
+    def watch(self, predicate):
+        '''
+        Return a Future resolved with predicate(self) after the first poll where it is not PENDING
+        The future gets the exception if the predicate raises one
+        '''
+        future = Future()
+        with self.lock:
+            self.watchers.append((predicate, future))
+        self.start()
+        return future
+
+    def wait_for_status(self, server, statuses=('ACTIVE',), failures=('ERROR',)):
+        '''
+        Return a Future for the server reaching one of the statuses (MISSING for deleted servers)
+        It resolves to the server, or None if it is missing. Unless MISSING is one of the
+        statuses, a server missing from a snapshot taken after this call is a failure.
+        '''
+        server = getattr(server, 'id', server)
+        statuses = {s.upper() for s in statuses}
+        failures = {s.upper() for s in failures}
+        since = time.time()
+        def check(inventory):
+            s = inventory.servers.get(server)
+            status = 'MISSING' if s is None else s.status.upper()
+            if status in statuses:
+                return s
+            if status == 'MISSING' and inventory.time >= since:
+                raise RuntimeError('Server {} is missing'.format(server))
+            if status in failures:
+                raise RuntimeError('Server {} has status {}'.format(server, status))
+            return PENDING
+        return self.watch(check)
+
+    def wait_for_address(self, address, server=None):
+        '''Return a Future for the address being indexed, to the given server if any'''
+        server = getattr(server, 'id', server)
+        def check(inventory):
+            s = inventory.addresses.get(address)
+            return s if s is not None and server in (None, s.id) else PENDING
+        return self.watch(check)
+
+    def wait(self, server, statuses=('ACTIVE',), timeout=None, failures=('ERROR',)):
+        '''Block until the server reaches one of the statuses. Raises TimeoutError'''
+        future = self.wait_for_status(server, statuses, failures)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise TimeoutError('Server {} did not reach {} within {} seconds'.format(getattr(server, 'id', server), statuses, timeout))
+
+    def __str__(self):
+        return 'Inventory({} servers, {} IPs)'.format(len(self.servers), len(self.ips))
+
+    __repr__ = __str__
+
+################################################################################
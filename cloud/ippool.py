@@ -0,0 +1,151 @@
+'''
+Warm pool of floating IPs which are recycled instead of deleted
+'''
+import threading, logging, collections
+from concurrent.futures import ThreadPoolExecutor
+
+import fn
+
+from .ostack import create_ip, create_ips
+from .teardown import teardown
+
+log = logging.getLogger(__name__)
+
+################################################################################
+
+class FloatingIPPool(fn.ClosingContext):
+    '''
+    Reserve of pre-allocated floating IPs on one connection
+    - `reserve`: number of free IPs to keep allocated; the reserve is topped up
+      in the background whenever IPs are handed out
+    - `recycle`: if True, released IPs are detached and kept instead of deleted
+    - `maximum`: most free IPs to keep when recycling (None for no limit)
+    close() is the shutdown sweep: it deletes every free IP in the pool.
+    With reserve=0 and recycle=False the pool just creates and deletes IPs.
+    '''
+    def __init__(self, conn, reserve=0, *, recycle=True, maximum=None, threads=8):
+        self.conn = conn
+        self.reserve = int(reserve)
+        self.recycle = recycle
+        self.maximum = maximum
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads)
+        self.free = collections.deque(create_ips(conn, self.reserve))
+
+    def _replenish(self):
+        with self.lock:
+            n = max(0, self.reserve - len(self.free) - self.pending)
+            self.pending += n
+        for _ in range(n):
+            self.executor.submit(self._allocate)
+
+    def _allocate(self):
+        try:
+            ip = create_ip(self.conn)
+        except Exception as e:
+            log.warning(fn.message('Failed to replenish floating IP reserve', exception=e))
+            ip = None
+        with self.lock:
+            self.pending -= 1
+            if ip is not None:
+                self.free.append(ip)
+
+    def acquire_many(self, n):
+        '''Hand out n IPs, taking them from the reserve first and allocating the rest in bulk'''
+        with self.lock:
+            out = [self.free.popleft() for _ in range(min(n, len(self.free)))]
+        try:
+            out += create_ips(self.conn, n - len(out))
+        except Exception:
+            with self.lock:
+                self.free.extend(out)
+            raise
+        self._replenish()
+        return out
+
+    def acquire(self):
+        '''Hand out one IP, from the reserve if possible'''
+        return self.acquire_many(1)[0]
+
+    def release(self, ip):
+        '''Take back an IP, detaching it from its server, or delete it if not recycling or the reserve is full'''
+        with self.lock:
+            if ip in self.free:
+                return
+            keep = self.recycle and (self.maximum is None or len(self.free) < self.maximum)
+        if keep:
+            try:
+                # not the inventory snapshot, which may predate the IP being attached
+                fip = next(iter(self.conn.network.ips(floating_ip_address=ip)), None)
+                if fip is not None:
+                    if fip.port_id:
+                        self.conn.network.update_ip(fip.id, port_id=None)
+                    with self.lock:
+                        self.free.append(ip)
+                    return
+            except Exception as e:
+                log.warning(fn.message('Failed to recycle floating IP', ip=ip, exception=e))
+        self.conn.delete_floating_ip(ip)
+
+    def close(self):
+        '''Delete all free IPs and stop replenishing the reserve'''
+        self.reserve = 0
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            ips, self.free = list(self.free), collections.deque()
+        if ips:
+            report = teardown(self.conn, ips=ips, concurrency=self.threads, progress=None)
+            for ip, e in report.failed.items():
+                log.error('Could not delete IP {} because of exception {}'.format(ip, e))
+        return ips
+
+    def __len__(self):
+        return len(self.free)
+
+    def __str__(self):
+        return 'FloatingIPPool({} free, reserve={})'.format(len(self.free), self.reserve)
+
+    __repr__ = __str__
+
+################################################################################
+
+def as_ip_pool(conn, pool=None):
+    '''
+    Return a FloatingIPPool from
+    - None: a pool which just creates and deletes IPs
+    - an integer: a new recycling pool with that reserve
+    - a FloatingIPPool: itself
+    '''
+    if pool is None:
+        return FloatingIPPool(conn, recycle=False)
+    if isinstance(pool, int):
+        return FloatingIPPool(conn, pool)
+    return pool
+
+################################################################################
+
+class IPPools:
+    '''
+    FloatingIPPools for several connections, created on demand
+    `pools` is None, an integer reserve for each created pool, or an iterable of FloatingIPPool
+    '''
+    def __init__(self, pools=None):
+        self.reserve = pools if pools is None or isinstance(pools, int) else None
+        self.pools = {} if self.reserve is not None or pools is None else {p.conn: p for p in pools}
+        self.owned = set()
+        self.lock = threading.Lock()
+
+    def __getitem__(self, conn):
+        with self.lock:
+            if conn not in self.pools:
+                self.pools[conn] = as_ip_pool(conn, self.reserve)
+                self.owned.add(conn)
+            return self.pools[conn]
+
+    def close(self):
+        '''Sweep the pools created here, leaving any given pools to their owners'''
+        return [ip for c in self.owned for ip in self.pools[c].close()]
+
+################################################################################
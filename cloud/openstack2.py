@@ -1,15 +1,17 @@
 """
 Utilities for dealing with OpenStack
 """
-import json, time, itertools, logging
+import json, time, itertools, logging, threading
 from concurrent.futures import ThreadPoolExecutor
 
 from novaclient.exceptions import BadRequest, Conflict, NotFound
 from keystoneauth1.exceptions import RetriableConnectionFailure
-import os_client_config
 
 import fn
 from .future import async_exe
+from .cache import LOOKUPS
+from .inventory import Inventory
+from .backoff import RetryPolicy, breaker_name, limit_session
 
 log = logging.getLogger(__name__)
 
@@ -33,14 +35,11 @@ def lookup(where, key):
         key = key if isinstance(key, str) else key[-1]
     return key
 
-def close_openstack(pool=None, graceful=True):
-    '''Close all instances and IPs'''
-    work = Instance.list() + FloatingIP.list()
-    if not work:
-        return ()
-    if pool is None:
-        pool = ThreadPoolExecutor(len(work))
-    return tuple(pool.map(lambda i: i.close(graceful=graceful), work))
+def close_openstack(pool=None, graceful=True, concurrency=16):
+    '''Close all instances and then any remaining IPs, with at most `concurrency` at once'''
+    pool = ThreadPoolExecutor(concurrency) if pool is None else pool
+    out = tuple(pool.map(lambda i: i.close(graceful=graceful), Instance.list()))
+    return out + tuple(pool.map(lambda i: i.close(graceful=graceful), FloatingIP.list()))
 
 ################################################################################
 
@@ -52,40 +51,53 @@ def check_version():
     if not hasattr(Server, 'add_floating_ip'):
         raise ImportError('Use novaclient 9.1.1 or lower')
 
-check_version()
-
 ################################################################################
 
-_make_client = fn.lru_cache(4)(os_client_config.make_client)
+@fn.lru_cache(4)
+def _make_client(service):
+    '''Client of an OpenStack service, checking the novaclient version on first use'''
+    check_version()
+    import os_client_config
+    return os_client_config.make_client(service)
+
+def _limited(client):
+    '''Rate limit the keystoneauth session of a nova or neutron client (see backoff.limit_session)'''
+    for http in (getattr(client, 'client', None), getattr(client, 'httpclient', None)):
+        limit_session(getattr(http, 'session', None))
+    return client
 
 def as_nova(nova=None):
     '''Return a nova client from options or a nova client itself'''
     nova = 'compute' if nova is None else nova
-    return _make_client(nova) if isinstance(nova, str) else nova
+    return _limited(_make_client(nova) if isinstance(nova, str) else nova)
 
 def as_neutron(neutron=None):
     '''Return a neutron client from options or a neutron client itself'''
     neutron = 'network' if neutron is None else neutron
-    return _make_client(neutron) if isinstance(neutron, str) else neutron
+    return _limited(_make_client(neutron) if isinstance(neutron, str) else neutron)
+
+################################################################################
+
+INVENTORIES = {}
+_INVENTORY_LOCK = threading.Lock()
+
+def get_inventory(nova=None, neutron=None, interval=5):
+    '''Shared snapshot of the servers and floating IPs of a nova/neutron pair, polled in the background'''
+    nova, neutron = as_nova(nova), as_neutron(neutron)
+    with _INVENTORY_LOCK:
+        if (nova, neutron) not in INVENTORIES:
+            INVENTORIES[nova, neutron] = Inventory(nova.servers.list,
+                lambda: neutron.list_floatingips()['floatingips'], interval)
+        return INVENTORIES[nova, neutron]
 
 ################################################################################
 
 EXCEPTIONS = [BadRequest, ConnectionRefusedError, RetriableConnectionFailure, Conflict]
 
-def retry_openstack(function, timeout=3600, exceptions=None):
-    '''Reattempt OpenStack calls that give given exception types'''
-    exc = tuple(EXCEPTIONS if exceptions is None else exceptions)
-    @fn.wraps(function)
-    def retryable(*args, **kwargs):
-        start = time.time()
-        for i in itertools.count():
-            try:
-                return function(*args, **kwargs)
-            except exc as e:
-                log.info(fn.message(str(e)))
-                if time.time() > start + timeout: raise e
-            time.sleep(2 ** (i/2-1))
-    return retryable
+def retry_openstack(function, timeout=3600, exceptions=None, client=None):
+    '''Reattempt OpenStack calls that give given exception types, with full-jitter backoff and the circuit breaker of `client`'''
+    return RetryPolicy(EXCEPTIONS if exceptions is None else exceptions, deadline=timeout,
+        breaker=breaker_name(client))(function)
 
 ################################################################################
 
@@ -128,7 +140,8 @@ class Flavor(OS):
     def __init__(self, flavor, nova=None):
         if isinstance(flavor, str):
             assert flavor in FLAVORS
-            flavor = as_nova(nova).flavors.find(name=flavor)
+            nova = as_nova(nova)
+            flavor = LOOKUPS.get(('flavor', nova, flavor), lambda: nova.flavors.find(name=flavor))
         super().__init__(flavor, 'Flavor')
 
 ################################################################################
@@ -141,7 +154,8 @@ class Image(OS):
     def __init__(self, image='ubuntu', nova=None):
         if isinstance(image, str):
             image = lookup(IMAGES, image)
-            image = as_nova(nova).glance.find_image(image)
+            nova = as_nova(nova)
+            image = LOOKUPS.get(('image', nova, image), lambda: nova.glance.find_image(image))
         assert image is not None
         super().__init__(image, 'Image')
 
@@ -155,7 +169,9 @@ class FloatingIP(OS, fn.ClosingContext):
     def __init__(self, ip, neutron=None):
         self.neutron = as_neutron(neutron)
         if isinstance(ip, str):
-            ip = {i['floating_ip_address'] : i for i in self.neutron.list_floatingips()['floatingips']}[ip]
+            address, ip = ip, get_inventory(neutron=self.neutron).ip(ip)
+            if ip is None:
+                raise KeyError(address)
         super().__init__(ip, 'dict')
 
     @classmethod
@@ -177,7 +193,7 @@ class FloatingIP(OS, fn.ClosingContext):
 
     def close(self, graceful=True):
         with fn.ErrorContext(log, 'Failed to close FloatingIP'):
-            retry_openstack(self.neutron.delete_floatingip)(self.id)
+            retry_openstack(self.neutron.delete_floatingip, client=self.neutron)(self.id)
 
 for k, v in dict(address='floating_ip_address', id='id').items():
     setattr(FloatingIP, k, property(lambda self, v=v: self.os[v]))
@@ -228,7 +244,7 @@ class Instance(OS, fn.ClosingContext):
             else:
                 ip = await ip
         with fn.ErrorContext(log, 'Failed to associate IP with server'):
-            await async_exe(pool, retry_openstack(out.add_ip), ip)
+            await async_exe(pool, retry_openstack(out.add_ip, client=out.nova), ip)
         return out
 
     def attach_volume(self, volume, device=None):
@@ -255,24 +271,26 @@ class Instance(OS, fn.ClosingContext):
 
     def status(self):
         '''Search for current status'''
-        try:
-            self.os = next(i for i in self.nova.servers.list() if i.id == self.id)
-            return self.os.status.lower()
-        except StopIteration:
+        os = get_inventory(self.nova).server(self.id)
+        if os is None:
             return 'missing'
+        self.os = os
+        return os.status.lower()
 
     def find_ip(self, neutron=None):
         '''Search for ip if not cached'''
         try:
             if self._ip is None:
-                ips = {i['floating_ip_address'] : i for i in as_neutron(neutron).list_floatingips()['floatingips']}
-                self._ip = FloatingIP(next(ips[i] for n in self.os.networks.values() for i in n if i in ips))
+                inventory = get_inventory(self.nova, neutron)
+                os = inventory.server(self.id, refresh=False) or self.os
+                ips = (inventory.ip(i, refresh=False) for n in os.networks.values() for i in n)
+                self._ip = FloatingIP(next(i for i in ips if i is not None), neutron)
             return self._ip
         except StopIteration:
             raise BadRequest('IP not found')
 
     def ip(self, retry=True, neutron=None):
-        return retry_openstack(self.find_ip)(neutron) if retry else self.find_ip(neutron)
+        return retry_openstack(self.find_ip, client=self.nova)(neutron) if retry else self.find_ip(neutron)
 
     def address(self, retry=True, neutron=None):
         return self.ip(retry=retry, neutron=neutron).address
@@ -286,23 +304,26 @@ class Instance(OS, fn.ClosingContext):
         metadata['visibility'] = 'public' if public else 'private'
         return self.os.create_image(name, metadata=metadata)
 
-    def close(self, graceful=True, neutron=None):
+    def close(self, graceful=True, neutron=None, grace=30):
         '''should never throw unless interrupted
-        tries to shut down instance first
+        if graceful, tries to shut down instance first, waiting up to `grace` seconds
         openstack server remove floating ip ${OS_USERNAME}-api-U-1 your.ip.number.here
         openstack server delete ${OS_USERNAME}-api-U-1
         '''
-        try:
-            self.stop()
-            for i in range(30):
-                if not graceful or self.status() != 'active': break
-                time.sleep(1)
-        except Exception: # for instance, Conflict if already stopped
-            pass
-        ips = {i['floating_ip_address'] : i for i in as_neutron(neutron).list_floatingips()['floatingips']}
-        [FloatingIP(ips[ip]).close() for n in self.os.networks.values() for ip in n if ip in ips]
+        inventory = get_inventory(self.nova, neutron)
+        if graceful:
+            try:
+                self.stop()
+                inventory.wait(self.id, ('SHUTOFF', 'MISSING'), timeout=grace)
+            except Exception: # for instance, Conflict if already stopped
+                pass
+        with fn.ErrorContext(log, 'Failed to refresh OpenStack inventory'):
+            inventory.refresh() # the last poll may predate IPs attached since
+        os = inventory.server(self.id, refresh=False) or self.os
+        ips = (inventory.ip(ip, refresh=False) for n in os.networks.values() for ip in n)
+        [FloatingIP(ip, neutron).close() for ip in ips if ip is not None]
         with fn.ErrorContext(log, 'Failed to close Instance'):
-            retry_openstack(self.nova.servers.delete)(self.os)
+            retry_openstack(self.nova.servers.delete, client=self.nova)(self.os)
 
     def __str__(self):
         ip = ', ip={}'.format(self._ip) if self._ip else ''
@@ -338,12 +359,13 @@ class Network(OS):
 
     def __init__(self, net=None, nova=None):
         if net is None or isinstance(net, str):
-            net = as_nova(nova).neutron.find_network(NETWORKS.get(net, net))
+            net, nova = NETWORKS.get(net, net), as_nova(nova)
+            net = LOOKUPS.get(('network', nova, net), lambda: nova.neutron.find_network(net))
         super().__init__(net)
 
     @classmethod
     def create(cls, net, nova=None):
-        return cls(as_nova(nova).neutron.find_network(NETWORKS.get(net, net)))
+        return cls(net, nova)
 
 ################################################################################
 
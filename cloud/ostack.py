@@ -9,13 +9,16 @@ connection.compute.stop_server(server)
 connection.compute.start_server(server)
 connection.compute.suspend_server(server)
 """
-import time, itertools, logging, base64
+import time, itertools, logging, base64, re, threading
 from concurrent.futures import ThreadPoolExecutor
 
 from keystoneauth1.exceptions import RetriableConnectionFailure
 import openstack
 
 import fn
+from .cache import LOOKUPS
+from .backoff import RetryPolicy, breaker_name, limit_session
+from .inventory import Inventory
 
 log = logging.getLogger(__name__)
 
@@ -24,18 +27,24 @@ log = logging.getLogger(__name__)
 DEFAULT_OS_KEY = ''
 DEFAULT_OS_GROUPS = []
 DEFAULT_CONNECTION = None
+SERVER_TIMEOUT = 3600
 
 def connection(conn=None):
-    '''Return the default connection or else the given connection'''
+    '''Return the default connection or else the given connection, rate limited (see limit_connection)'''
     global DEFAULT_CONNECTION
     if conn is None:
         if DEFAULT_CONNECTION is None:
             DEFAULT_CONNECTION = openstack.connect()
-        return DEFAULT_CONNECTION
+        return limit_connection(DEFAULT_CONNECTION)
     if isinstance(conn, openstack.connection.Connection):
-        return conn
+        return limit_connection(conn)
     raise TypeError('Expected None or Connection object')
 
+def limit_connection(conn):
+    '''Send all requests of a connection through the process-wide per-service rate limits'''
+    limit_session(getattr(conn, 'session', None))
+    return conn
+
 def lookup(where, key):
     '''Disambiguates the key repeatedly, if a list takes the last element'''
     while key in where:
@@ -43,42 +52,42 @@ def lookup(where, key):
         key = key if isinstance(key, str) else key[-1]
     return key
 
-def close_openstack(conn, graceful=True):
-    '''Synchronously close all instances and IPs'''
-    ips = conn.list_floating_ips()
-    servers = conn.list_servers()
-    if not ips and not servers:
-        return []
+def close_openstack(conn=None, graceful=True, **kwargs):
+    '''
+    Synchronously close all instances and IPs, returning a TeardownReport
+    See Teardown for keywords such as `concurrency` and `progress`
+    '''
+    from .teardown import teardown
+    conn = connection(conn)
+    return teardown(conn, conn.list_servers(), [i['floating_ip_address'] for i in conn.list_floating_ips()],
+        graceful=graceful, **kwargs)
+
+################################################################################
 
-    tasks = []
-    with ThreadPoolExecutor(len(ips) + len(servers)) as pool:
-        print(f'deleting {len(servers)} servers')
-        for i in servers:
-            tasks.append(pool.submit(close_server, conn, i, graceful=graceful))
-        while any(not t.done() for t in tasks):
-            time.sleep(0.2)
-        conn.delete_unattached_floating_ips()
-        return [t.result() for t in tasks]
+INVENTORIES = {}
+_INVENTORY_LOCK = threading.Lock()
+
+def get_inventory(conn=None, interval=5):
+    '''Shared snapshot of the servers and floating IPs of a connection, polled in the background'''
+    conn = connection(conn)
+    with _INVENTORY_LOCK:
+        if conn not in INVENTORIES:
+            INVENTORIES[conn] = Inventory(conn.compute.servers, conn.list_floating_ips, interval)
+        return INVENTORIES[conn]
 
 ################################################################################
 
 EXCEPTIONS = [ConnectionRefusedError, RetriableConnectionFailure, openstack.exceptions.ResourceTimeout]
 
-def retry(function, timeout=3600, exceptions=None):
-    '''Reattempt OpenStack calls that give given exception types'''
-    exc = tuple(EXCEPTIONS if exceptions is None else exceptions)
-    @fn.wraps(function)
-    def retryable(*args, **kwargs):
-        start = time.time()
-        for i in itertools.count():
-            try:
-                return function(*args, **kwargs)
-            except exc as e:
-                log.info(fn.message(str(e)))
-                if time.time() > start + timeout:
-                    raise
-            time.sleep(2 ** (i/2-1))
-    return retryable
+def retry(function, timeout=3600, exceptions=None, conn=None):
+    '''
+    Reattempt OpenStack calls that give given exception types, with full-jitter backoff
+    The default connection errors count towards the circuit breaker of `conn` (see
+    backoff.breaker_name); other exceptions (e.g. AssertionError while polling) are just retried.
+    '''
+    if exceptions is None:
+        return RetryPolicy(EXCEPTIONS, deadline=timeout, breaker=breaker_name(conn))(function)
+    return RetryPolicy(exceptions, deadline=timeout, cap=10)(function)
 
 ################################################################################
 
@@ -94,26 +103,45 @@ def retry(function, timeout=3600, exceptions=None):
 ################################################################################
 
 def get_flavor(conn, flavor):
-    out = conn.compute.find_flavor(flavor)
-    assert out is not None, flavor
-    return out
+    def fetch():
+        out = conn.compute.find_flavor(flavor)
+        assert out is not None, flavor
+        return out
+    return LOOKUPS.get(('flavor', conn, flavor), fetch)
 
 ################################################################################
 
 def get_image(conn, image='ubuntu'):
     '''Find an image. Use config defaults'''
     assert image is not None
-    out = conn.compute.find_image(image)
-    assert out is not None
-    return out
+    def fetch():
+        out = conn.compute.find_image(image)
+        assert out is not None
+        return out
+    return LOOKUPS.get(('image', conn, image), fetch)
 
 ################################################################################
 
 def get_network(conn, net):
     assert net is None or isinstance(net, str)
-    out = connection(conn).get_network(net)
-    assert out is not None
-    return out
+    conn = connection(conn)
+    def fetch():
+        out = conn.get_network(net)
+        assert out is not None
+        return out
+    return LOOKUPS.get(('network', conn, net), fetch)
+
+################################################################################
+
+def warm_lookups(conn, *, flavors=(), images=(), networks=()):
+    '''Fetch flavors, images and networks into the lookup cache concurrently'''
+    work = [(get_flavor, f) for f in set(flavors) if f is not None] \
+         + [(get_image, i) for i in set(images) if i is not None] \
+         + [(get_network, n) for n in set(networks)]
+    if not work:
+        return []
+    with ThreadPoolExecutor(len(work)) as pool:
+        return list(pool.map(lambda w: w[0](conn, w[1]), work))
 
 ################################################################################
 
@@ -122,7 +150,24 @@ def get_server_ip(conn, server):
     return conn.get_server_public_ip(conn.get_server(server))
 
 def create_ip(conn):
-    return conn.create_floating_ip().floating_ip_address
+    return retry(conn.create_floating_ip, timeout=300, conn=conn)().floating_ip_address
+
+def create_ips(conn, n, threads=16):
+    '''Allocate n floating IPs concurrently. If any allocation fails, the others are released'''
+    if n <= 0:
+        return []
+    with ThreadPoolExecutor(min(n, threads)) as pool:
+        tasks = [pool.submit(create_ip, conn) for _ in range(n)]
+        errors = [t.exception() for t in tasks]
+    ips = [t.result() for t, e in zip(tasks, errors) if e is None]
+    if len(ips) < n:
+        for ip in ips:
+            try:
+                conn.delete_floating_ip(ip)
+            except Exception as e:
+                log.error('Could not delete IP {} because of exception {}'.format(ip, e))
+        raise next(e for e in errors if e is not None)
+    return ips
 
 def attach_ip(conn, server, ip: str):
     '''Attach an IP to a server'''
@@ -131,13 +176,23 @@ def attach_ip(conn, server, ip: str):
         assert s is not None
         return s
     server = retry(fetch, exceptions=(AssertionError,))()
-    _ = conn.add_ips_to_server(server, ips=[ip])
-    retry(lambda i: conn.get_server_public_ip(conn.get_server(i)))(server.id)
+    _ = retry(conn.add_ips_to_server, timeout=300, conn=conn)(server, ips=[ip])
+    get_inventory(conn).wait_for_address(ip, server).result(timeout=SERVER_TIMEOUT)
 
 def get_server(conn, name_or_id):
     return conn.compute.get_server(name_or_id)
 
-def submit_server(conn, name, image, flavor, network, security_groups=None, user_data=None, key_name=None, nics=None):
+def attach_volume(conn, server, volume):
+    '''Attach an existing volume (id) to a server'''
+    return conn.compute.create_volume_attachment(server, volume_id=getattr(volume, 'id', volume))
+
+def spill_volume(size):
+    '''Block device mapping for a blank volume of `size` GB which is deleted with its server'''
+    return [dict(boot_index=-1, source_type='blank', destination_type='volume',
+                 volume_size=int(size), delete_on_termination=True)]
+
+def _server_kwargs(conn, name, image, flavor, network, security_groups=None, user_data=None, key_name=None, nics=None,
+                   block_devices=None):
     net = get_network(conn, network).id
     if nics is None:
         nics = [{'net-id': net}]
@@ -147,18 +202,56 @@ def submit_server(conn, name, image, flavor, network, security_groups=None, user
         key_name = DEFAULT_OS_KEY
     if user_data:
         user_data = base64.b64encode(user_data.encode()).decode()
-    kwargs = dict(
+    out = dict(
         name=name, image_id=get_image(conn, image).id,
         flavor_id=get_flavor(conn, flavor).id,
         security_groups=security_groups, user_data=user_data or '',
         networks=[{"uuid": net}], key_name=key_name, nics=nics)
+    if block_devices:
+        out['block_device_mapping'] = list(block_devices)
+    return out
+
+def submit_server(conn, name, image, flavor, network, security_groups=None, user_data=None, key_name=None, nics=None,
+                  block_devices=None):
+    kwargs = _server_kwargs(conn, name=name, image=image, flavor=flavor, network=network,
+        security_groups=security_groups, user_data=user_data, key_name=key_name, nics=nics, block_devices=block_devices)
     try:
         log.info('Creating server with keywords %r' % kwargs)
-        return conn.compute.create_server(**kwargs)
+        # only failures to connect are retried, so a create that reached Nova is not repeated
+        return retry(conn.compute.create_server, timeout=300, conn=conn)(**kwargs)
     except Exception:
         log.error('Failed to create server with keywords %r' % kwargs)
         raise
 
+def submit_servers(conn, name, image, flavor, network, count, security_groups=None, user_data=None, key_name=None, nics=None,
+                   block_devices=None):
+    '''
+    Submit `count` identical servers in a single Nova multi-create request
+    Nova names them `{name}-1` through `{name}-{count}`; they are returned in that order.
+    All servers share the same `user_data`, and each gets its own `block_devices` (see spill_volume).
+    '''
+    if count == 1:
+        return [submit_server(conn, name=name, image=image, flavor=flavor, network=network,
+            security_groups=security_groups, user_data=user_data, key_name=key_name, nics=nics, block_devices=block_devices)]
+    kwargs = _server_kwargs(conn, name=name, image=image, flavor=flavor, network=network,
+        security_groups=security_groups, user_data=user_data, key_name=key_name, nics=nics, block_devices=block_devices)
+    try:
+        log.info('Creating %d servers with keywords %r' % (count, kwargs))
+        retry(conn.compute.create_server, timeout=300, conn=conn)(min_count=count, max_count=count, **kwargs)
+    except Exception:
+        log.error('Failed to create %d servers with keywords %r' % (count, kwargs))
+        raise
+    pattern = re.compile(r'^{}-(\d+)$'.format(re.escape(name)))
+    def fetch():
+        found = {}
+        for s in conn.compute.servers(name='^{}-'.format(re.escape(name))):
+            m = pattern.match(s.name)
+            if m:
+                found[int(m.group(1))] = s
+        assert len(found) == count, (name, len(found), count)
+        return [found[k] for k in sorted(found)]
+    return retry(fetch, timeout=300, exceptions=(AssertionError,))()
+
 def close_server(conn, server, graceful=True):
     '''
     Close a single instance
@@ -181,24 +274,46 @@ def close_server(conn, server, graceful=True):
 
 ################################################################################
 
-def create_server(conn, *, name, image, flavor, network, ip=None, security_groups=None, user_data=None, key_name=None, nics=None):
-    '''Create a server. If an IP is given, attach it to the server'''
-    server = submit_server(conn, name=name, image=image, flavor=flavor, network=network,
-        security_groups=security_groups, user_data=user_data, key_name=key_name, nics=nics)
+def activate_server(conn, server, ip=None, release=None, mark=None):
+    '''
+    Wait for a submitted server to become active. If an IP is given, attach it to the server
+    On failure the server is deleted and the IP is passed to `release` (default: deleted)
+    `mark`, if given, is called with 'active' and 'attached' as those phases finish (see Timeline)
+    '''
+    mark = mark or (lambda phase: None)
     try:
-        s = retry(conn.compute.wait_for_server)(server, wait=0.01)
+        s = get_inventory(conn).wait(server, timeout=SERVER_TIMEOUT)
+        mark('active')
         if ip is not None:
             attach_ip(conn, server, ip)
+            mark('attached')
         return s
     except Exception:
         try:
             close_server(conn, server, graceful=False)
             if ip is not None:
-                conn.delete_floating_ip(ip)
+                (conn.delete_floating_ip if release is None else release)(ip)
         except Exception as e:
             log.error('Could not close server or IP {} because of exception {}'.format(server.id, e))
         raise
 
+def create_server(conn, *, name, image, flavor, network, ip=None, release=None, security_groups=None, user_data=None, key_name=None, nics=None, mark=None,
+                  block_devices=None):
+    '''
+    Create a server. If an IP is given, attach it to the server, or pass it to `release` on failure
+    `mark`, if given, is called with 'submitted', 'active' and 'attached' as those phases finish
+    '''
+    try:
+        server = submit_server(conn, name=name, image=image, flavor=flavor, network=network,
+            security_groups=security_groups, user_data=user_data, key_name=key_name, nics=nics, block_devices=block_devices)
+    except Exception:
+        if ip is not None:
+            (conn.delete_floating_ip if release is None else release)(ip)
+        raise
+    if mark is not None:
+        mark('submitted')
+    return activate_server(conn, server, ip, release, mark)
+
 ################################################################################
 
 def create_image(conn, server, name, public=False, suspend=True, metadata=None):
@@ -0,0 +1,168 @@
+'''
+Spread server launches over several OpenStack connections (allocations or regions)
+
+Connections are scored by how many more servers of the flavor fit in their quota, their
+recent create-failure rate, their median launch latency and how many launches they
+already have in flight. A connection which fails `max_failures` launches in a row is
+skipped for `cooldown` seconds, and a failed launch moves on to the next best connection.
+'''
+import time, threading, logging, collections
+
+import fn
+
+from .quota import flavor_capacity
+
+log = logging.getLogger(__name__)
+
+################################################################################
+
+class PlacementError(RuntimeError):
+    pass
+
+class ConnectionStats:
+    '''Recent launch outcomes and latencies of one connection'''
+    def __init__(self, window=20):
+        self.outcomes = collections.deque(maxlen=window) # True for success
+        self.latencies = collections.deque(maxlen=window)
+        self.inflight = 0
+        self.streak = 0      # consecutive failures
+        self.cooldown = 0.0  # time.monotonic() until which the connection is skipped
+
+    def failure_rate(self):
+        '''Smoothed so that a single failure does not rule a connection out'''
+        return (self.outcomes.count(False) + 1) / (len(self.outcomes) + 2)
+
+    def latency(self, default):
+        '''Median recent launch latency'''
+        t = sorted(self.latencies)
+        return t[len(t) // 2] if t else default
+
+################################################################################
+
+class Placement:
+    '''
+    Chooses connections for launches. `connections` is kept by reference, so
+    connections appended to it later are considered too.
+    - `horizon`: remaining quota beyond which a connection is not preferred for having more
+    - `default_latency`: assumed launch latency of connections with no measurements
+    '''
+    def __init__(self, connections, *, window=20, max_failures=3, cooldown=300, horizon=50, default_latency=300):
+        self.connections = connections
+        self.window = window
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.horizon = horizon
+        self.default_latency = default_latency
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def _stats(self, conn):
+        if conn not in self.stats:
+            self.stats[conn] = ConnectionStats(self.window)
+        return self.stats[conn]
+
+    def capacity(self, conn, flavor):
+        '''Servers of a flavor which still fit in the quota of conn, less those in flight'''
+        try:
+            fits = flavor_capacity(conn, flavor)
+        except Exception as e:
+            log.warning(fn.message('Could not query compute limits', exception=e))
+            fits = float('inf')
+        with self.lock:
+            return fits - self._stats(conn).inflight
+
+    def score(self, conn, flavor):
+        '''Expected launch throughput of conn, or 0 if it is cooling down or full'''
+        capacity = self.capacity(conn, flavor)
+        with self.lock:
+            s = self._stats(conn)
+            if capacity < 1 or s.cooldown > time.monotonic():
+                return 0
+            fill = min(capacity, self.horizon) / self.horizon
+            return fill * (1 - s.failure_rate()) / (max(1, s.latency(self.default_latency)) * (1 + s.inflight))
+
+    def choose(self, flavor, connections=None, exclude=()):
+        '''
+        Reserve a launch on the best of `connections` (default: all). Raises PlacementError
+        Connections given explicitly are used even if they are cooling down or full.
+        '''
+        candidates = [c for c in (self.connections if connections is None else connections) if c not in exclude]
+        scores = [(self.score(c, flavor), i) for i, c in enumerate(candidates)]
+        best = max(scores, default=(0, None))
+        if not best[0]:
+            if connections is None or not candidates:
+                raise PlacementError('No connection has capacity for flavor {!r} ({} tried)'.format(flavor, len(exclude)))
+            best = (0, 0) # the caller asked for these connections, e.g. scale_up(conn, ...)
+        conn = candidates[best[1]]
+        with self.lock:
+            self._stats(conn).inflight += 1
+        return conn
+
+    def succeeded(self, conn, latency):
+        with self.lock:
+            s = self._stats(conn)
+            s.inflight -= 1
+            s.outcomes.append(True)
+            s.latencies.append(latency)
+            s.streak = 0
+
+    def failed(self, conn):
+        with self.lock:
+            s = self._stats(conn)
+            s.inflight -= 1
+            s.outcomes.append(False)
+            s.streak += 1
+            if s.streak >= self.max_failures:
+                log.warning(fn.message('Placement skipping failing connection', connection=conn, cooldown=self.cooldown))
+                s.cooldown, s.streak = time.monotonic() + self.cooldown, 0
+
+    def launch(self, flavor, function, connections=None):
+        '''
+        Call function(conn) on the best connection, moving on to the next best if it raises
+        Returns (conn, result), or raises the last exception once no connection is left
+        '''
+        tried, last = [], None
+        while True:
+            try:
+                conn = self.choose(flavor, connections, exclude=tried)
+            except PlacementError:
+                if last is None:
+                    raise
+                raise last
+            tried.append(conn)
+            start = time.monotonic()
+            try:
+                out = function(conn)
+            except Exception as e:
+                self.failed(conn)
+                log.warning(fn.message('Launch failed, trying another connection', exception=e))
+                last = e
+                continue
+            self.succeeded(conn, time.monotonic() - start)
+            return conn, out
+
+    def plan(self, n, flavor):
+        '''How many of n launches each connection would get now, as a list of (conn, count)'''
+        counts = collections.Counter()
+        reserved = []
+        try:
+            for _ in range(n):
+                conn = self.choose(flavor)
+                reserved.append(conn)
+                counts[conn] += 1
+        except PlacementError:
+            pass
+        finally:
+            with self.lock:
+                for c in reserved:
+                    self._stats(c).inflight -= 1
+        return [(c, counts[c]) for c in self.connections if counts[c]]
+
+    def report(self):
+        '''Recent failure rate, median latency, launches in flight and cooldown of each connection'''
+        now = time.monotonic()
+        with self.lock:
+            return [dict(connection=c, failure_rate=s.failure_rate(), latency=s.latency(None), inflight=s.inflight,
+                         cooldown=max(0, s.cooldown - now)) for c, s in ((c, self._stats(c)) for c in self.connections)]
+
+################################################################################
@@ -0,0 +1,131 @@
+'''
+Compute and network quota checks, so that oversized launches are clamped or rejected
+before any server is created
+'''
+import logging, typing
+
+import fn
+
+from .cache import LOOKUPS
+from .ostack import get_flavor
+
+log = logging.getLogger(__name__)
+
+################################################################################
+
+def get_compute_limits(conn, ttl=30):
+    '''Absolute compute limits and usage of a connection, cached for `ttl` seconds'''
+    return LOOKUPS.get(('limits', conn), conn.get_compute_limits, ttl=ttl)
+
+def get_network_quota(conn, ttl=30):
+    '''Network quota with usage of the connection's project, cached for `ttl` seconds'''
+    return LOOKUPS.get(('network-quota', conn), lambda: conn.network.get_quota(conn.current_project_id, details=True), ttl=ttl)
+
+def available(limit, used):
+    '''Amount left under a limit (negative or None for unlimited)'''
+    if limit is None or limit < 0:
+        return float('inf')
+    return max(0, limit - (used or 0))
+
+def _fits(amount, size):
+    return amount if amount == float('inf') else int(amount // max(1, size))
+
+################################################################################
+
+def flavor_capacity(conn, flavor, ttl=30):
+    '''How many more servers of a flavor fit in the instance, core and RAM quota of a connection'''
+    limits, f = get_compute_limits(conn, ttl), get_flavor(conn, flavor)
+    return min(_fits(available(limits.max_total_instances, limits.total_instances_used), 1),
+               _fits(available(limits.max_total_cores, limits.total_cores_used), f.vcpus),
+               _fits(available(limits.max_total_ram_size, limits.total_ram_used), f.ram))
+
+def floating_ip_capacity(conn, ttl=30):
+    '''How many more floating IPs the project of a connection may allocate'''
+    q = get_network_quota(conn, ttl).floating_ips
+    if not isinstance(q, dict): # quota without details
+        return available(q, len(conn.list_floating_ips()))
+    return available(q.get('limit'), q.get('used', 0) + q.get('reserved', 0))
+
+################################################################################
+
+class QuotaExceeded(RuntimeError):
+    def __init__(self, preflight):
+        super().__init__(str(preflight))
+        self.preflight = preflight
+
+class Preflight(typing.NamedTuple):
+    '''Whether `requested` servers of a flavor fit: resources maps a name to (needed, available)'''
+    flavor: str
+    requested: int
+    fits: int
+    resources: dict
+
+    def shortfall(self):
+        '''Resources which are short, mapped to how much more is needed'''
+        return {k: n - a for k, (n, a) in self.resources.items() if n > a}
+
+    def __str__(self):
+        short = ', '.join('{} short by {:g} (need {:g}, have {:g})'.format(k, n - a, n, a)
+                          for k, (n, a) in self.resources.items() if n > a)
+        return 'Requested {} x {} and {} fit{}'.format(self.requested, self.flavor, self.fits, ': ' + short if short else '')
+
+def preflight(conn, flavor, n, *, ips=None, free_ips=0, pending=None, ttl=30):
+    '''
+    Check how many of n servers of a flavor fit in the quota of conn
+    `ips` is the number of floating IPs they need (default n), of which `free_ips`
+    are already allocated (e.g. in a FloatingIPPool)
+    `pending` maps flavors to servers launched but not yet submitted, which the usage does not count yet
+    '''
+    limits, f = get_compute_limits(conn, ttl), get_flavor(conn, flavor)
+    ips = n if ips is None else ips
+    per = dict(instances=1, cores=f.vcpus, ram=f.ram)
+    used = dict(instances=limits.total_instances_used or 0, cores=limits.total_cores_used or 0,
+                ram=limits.total_ram_used or 0)
+    for other, count in (pending or {}).items():
+        o = get_flavor(conn, other)
+        for k, size in dict(instances=1, cores=o.vcpus, ram=o.ram).items():
+            used[k] += count * size
+    left = dict(instances=available(limits.max_total_instances, used['instances']),
+                cores=available(limits.max_total_cores, used['cores']),
+                ram=available(limits.max_total_ram_size, used['ram']))
+    fits = min(_fits(left[k], per[k]) for k in per)
+    resources = {k: (n * per[k], left[k]) for k in per}
+    if ips > free_ips:
+        try:
+            left['floating_ips'] = floating_ip_capacity(conn, ttl) + free_ips
+            resources['floating_ips'] = (ips, left['floating_ips'])
+            fits = min(fits, int(n * min(1, left['floating_ips'] / ips)))
+        except Exception as e:
+            log.warning(fn.message('Could not query network quota', exception=e))
+    return Preflight(getattr(f, 'name', flavor), n, int(min(fits, n)), resources)
+
+def combine(reports):
+    '''Preflight of the same request spread over several connections, with their availability summed'''
+    first = reports[0]
+    needed = {k: n for r in reports for k, (n, a) in r.resources.items()}
+    # a resource a report did not check (e.g. floating_ips, where the pool has enough) is not short there
+    resources = {k: (n, sum(r.resources.get(k, (n, n))[1] for r in reports)) for k, n in needed.items()}
+    return Preflight(first.flavor, first.requested, min(first.requested, sum(r.fits for r in reports)), resources)
+
+def apply_quota(report, policy='clamp'):
+    '''
+    Return how many servers of a Preflight to launch according to `policy`:
+    'clamp' to as many as fit (logging a warning), or 'reject' to raise QuotaExceeded unless all fit
+    '''
+    assert policy in ('clamp', 'reject'), policy
+    if report.fits < report.requested:
+        if policy == 'reject' or report.fits == 0:
+            raise QuotaExceeded(report)
+        log.warning(fn.message('Clamping launch to quota', report=str(report)))
+    return report.fits
+
+def check_quota(conn, flavor, n, *, policy='clamp', **kwargs):
+    '''
+    Return how many of n servers to launch on conn according to `policy` (see apply_quota),
+    or n if policy is None. Keywords are passed to preflight()
+    '''
+    if policy is None or n <= 0:
+        return n
+    return apply_quota(preflight(conn, flavor, n, **kwargs), policy)
+
+################################################################################
@@ -0,0 +1,57 @@
+'''
+Dask resources advertised by workers, and helpers to request them for tasks
+
+Each worker process advertises its share of the VM (see templates.worker):
+- THREADS: worker threads
+- CORES: physical cores
+- MEMORY: bytes of RAM
+- SCRATCH: free bytes in the worker's local directory
+- VOLUME:<mount>: free bytes on each mounted volume, except those whose mount point has
+  whitespace, commas or '=', which dask-worker --resources cannot express
+plus any custom resources given for its pool (e.g. GPU=1).
+'''
+import dask
+from dask.utils import parse_bytes
+
+################################################################################
+
+VOLUME = 'VOLUME:'
+
+def _bytes(x):
+    return parse_bytes(x) if isinstance(x, str) else x
+
+def task_resources(threads=1, memory=None, scratch=None, cores=None, volumes=None, **custom):
+    '''
+    Resources for client.submit(..., resources=...) or compute/persist
+    memory and scratch are bytes or strings like '4GB'; volumes maps a mount point to bytes
+    '''
+    out = {} if threads is None else dict(THREADS=threads)
+    if cores is not None:
+        out['CORES'] = cores
+    if memory is not None:
+        out['MEMORY'] = _bytes(memory)
+    if scratch is not None:
+        out['SCRATCH'] = _bytes(scratch)
+    out.update((VOLUME + k, _bytes(v)) for k, v in (volumes or {}).items())
+    out.update(custom)
+    return out
+
+def demand_resources(demand):
+    '''Resources for the tasks of a flavors.Demand (whose memory is in MB)'''
+    return task_resources(threads=demand.threads, memory=int(demand.memory * 2**20) if demand.memory else None)
+
+def annotate(**kwargs):
+    '''Context manager giving the tasks created inside it these task_resources()'''
+    return dask.annotate(resources=task_resources(**kwargs))
+
+################################################################################
+
+def worker_resources(client):
+    '''Resources advertised by each worker, as a dict of address -> dict'''
+    return {a: w.get('resources', {}) for a, w in client.scheduler_info()['workers'].items()}
+
+def matching_workers(client, resources):
+    '''Addresses of the workers which advertise enough of every requested resource'''
+    return [a for a, r in worker_resources(client).items() if all(r.get(k, 0) >= v for k, v in resources.items())]
+
+################################################################################
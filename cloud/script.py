@@ -1,24 +1,27 @@
-import asyncio, sys, functools, logging, string, boto3, fn, dask, distributed
+import asyncio, sys, functools, hashlib, logging, string, boto3, fn, dask, distributed
 
-from . import templates, cloudwatch
+from . import templates, cloudwatch, telemetry
+from .backoff import RetryPolicy
 
 log = logging.getLogger(__name__)
 
 ################################################################################
 
 def retry(function, timeouts, exceptions=()):
+    '''
+    Retry a coroutine function once per timeout in `timeouts`, each attempt being allowed that long
+    Attempts are made through a RetryPolicy, so they are spaced out with full jitter (see backoff)
+    '''
+    timeouts = list(timeouts)
+    assert timeouts, 'retry needs at least one timeout'
+    policy = RetryPolicy((TimeoutError,) + tuple(exceptions), deadline=None, attempts=len(timeouts), base=1, cap=max(timeouts))
     @functools.wraps(function)
     async def retry_function(*args, **kwargs):
-        x = StopIteration
-        for i, t in enumerate(timeouts):
-            try:
-                return await asyncio.wait_for(function(*args, **kwargs), timeout=t)
-            except (asyncio.TimeoutError, TimeoutError) as e:
-                x = log.info(fn.message('Timed out while trying function', exception=e, attempt=i, allowed=len(timeouts)))
-            except exceptions as e:
-                x = log.info(fn.message('Exception encountered while retrying function', exception=e, attempt=i))
-                await asyncio.sleep(t)
-        raise x
+        allowed = iter(timeouts)
+        @functools.wraps(function)
+        async def attempt():
+            return await asyncio.wait_for(function(*args, **kwargs), timeout=next(allowed))
+        return await policy.call_async(attempt)
     return retry_function
 
 ################################################################################
@@ -39,10 +42,48 @@ async def mount_volume(conn, volume_id, mount='/mnt/volume', user='$USER'):
     await conn.run(cmd, check=True)
     return dev
 
+def spill_script(spill, thresholds=(0.6, 0.7, 0.8), measure=256 * 2**20):
+    '''
+    Returns code for a worker script which mounts a disk and spills to it (see templates.spill)
+    spill is 'ephemeral' for the flavor's ephemeral disk (mounted at /mnt), 'volume' for
+    the first unmounted attached volume, or a Cinder volume id (both mounted at /mnt/spill).
+    thresholds are the memory fractions (target, spill, pause) of each worker. There is no
+    terminate fraction because workers run without a nanny, which is what would enforce it.
+    measure is how many bytes to write and read back to measure the throughput (0 to skip).
+    '''
+    volume = {'ephemeral': None, 'volume': ''}.get(spill, spill)
+    mount = '/mnt' if spill == 'ephemeral' else '/mnt/spill'
+    assert len(thresholds) == 3, 'thresholds are (target, spill, pause): workers have no nanny to terminate them'
+    target, spill_, pause = thresholds
+    return templates.disk.substitute() + templates.spill.substitute(volume=repr(volume), mount=repr(mount),
+        target=target, spill=spill_, pause=pause, size=int(measure))
+
 ################################################################################
 
-def configure():
-    '''Returns an executable string setting the dask config to a copy of the local one'''
+def _difference(config, defaults, prefix=''):
+    out = {}
+    for k, v in config.items():
+        if isinstance(v, dict) and isinstance(defaults.get(k), dict):
+            out.update(_difference(v, defaults[k], prefix + k + '.'))
+        elif k not in defaults or defaults[k] != v:
+            out[prefix + k] = v
+    return out
+
+def config_diff():
+    '''
+    Returns the entries of the local dask config which differ from the package defaults
+    Keys are dotted so that dask.config.set only overwrites those entries.
+    '''
+    dask.config.refresh()
+    return _difference(dask.config.config, dask.config.merge(*dask.config.defaults))
+
+def configure(diff=False):
+    '''
+    Returns an executable string setting the dask config to a copy of the local one
+    If diff, only the entries which differ from the package defaults are copied.
+    '''
+    if diff:
+        return templates.config.substitute(config=repr(config_diff()))
     dask.config.refresh()
     return templates.config.substitute(config=repr(dask.config.config))
 
@@ -56,10 +97,32 @@ def preload_cloudwatch(session, group, stream=None, interval=60):
         raise ValueError('No AWS credentials found')
     with open(cloudwatch.__file__) as f:
         mod = f.read()
-    return configure() + mod + templates.cloudwatch.substitute(group=repr(group), stream=repr(stream),
+    return configure(diff=True) + mod + templates.cloudwatch.substitute(group=repr(group), stream=repr(stream),
         interval=interval, region=session.region_name,
         access=repr(cred.access_key), secret=repr(cred.secret_key))
 
+def preload_telemetry(interval=10, flush=60, *, namespace=None, session=None, dimensions=None, per_worker=True,
+                      csv=None, parquet=None):
+    '''
+    Preload for scheduler and worker scripts which collects worker telemetry on the scheduler
+    every `interval` seconds and writes it every `flush` seconds (see cloud.telemetry) to
+    CloudWatch metrics in `namespace`, a CSV file and/or a directory of Parquet files
+    on the scheduler. Without any of these, rows are only kept for collect_telemetry().
+    '''
+    code = ''
+    if namespace is not None:
+        session = boto3.Session() if session is None else session
+        if session.get_credentials() is None:
+            raise ValueError('No AWS credentials found')
+        with open(cloudwatch.__file__) as f:
+            code += f.read()
+        session = cloudwatch.AwsSession(session).__getstate__()
+    with open(telemetry.__file__) as f:
+        code += f.read()
+    return code + templates.telemetry.substitute(namespace=repr(namespace), session=repr(session),
+        dimensions=repr(dimensions), per_worker=bool(per_worker), csv=repr(csv), parquet=repr(parquet),
+        interval=float(interval), flush=float(flush))
+
 ################################################################################
 
 def shebang(python=None):
@@ -69,31 +132,108 @@ def shebang(python=None):
     else:
         return '#!{}\n'.format(python)
 
+def environment_script(digest, sources, token=None):
+    '''
+    Returns code (which must come right after the shebang) making a script rerun itself in the
+    packed environment with the given digest, fetched from the first of `sources` which has it
+    (see templates.environment and cloud.environment), authenticating to a payload store with `token`
+    '''
+    return templates.environment.substitute(digest=repr(digest), sources=repr(list(sources)),
+        token=repr(None if token is None else str(token)))
+
 ################################################################################
 
-def scheduler_script(host, port, volume=None, python=None, preload=''):
+def scheduler_script(host, port, volume=None, python=None, preload='', payload_port=None, payload_token=None,
+                     payload_limit=32 * 2**30):
     '''
     Returns a Python executable script with shebang included
     The script will write a dask.yml in the home directory (perhaps in /root).
+    If a volume id is given, the volume (which must be attached) is mounted at /mnt/volume
+    and holds the scheduler's local directory.
+    If payload_port is given, the scheduler also serves worker payloads on it (see payload_store),
+    storing those of up to `payload_limit` bytes PUT with `payload_token`, which every request needs.
     '''
     if volume is None:
-        visit = None
-        path = ''
+        mount = path = ''
     else:
-        visit = fn.partial(mount_volume, volume_id=volume, mount='/mnt/volume')
+        mount = templates.disk.substitute() + templates.scheduler_volume.substitute(volume=repr(volume), mount=repr('/mnt/volume'))
         path = '/mnt/volume/dask-scheduler'
-    return shebang(python) + configure() + templates.scheduler.substitute(preload=preload or '', host=host, port=port, path=repr(path))
+    if payload_port is not None:
+        assert payload_token, 'The payload store needs a token to authenticate uploads'
+        preload = templates.payload_store.substitute(port=int(payload_port), root=repr('~/payloads'),
+            token=repr(str(payload_token)), limit=int(payload_limit)) + (preload or '')
+    return shebang(python) + configure() + mount + templates.scheduler.substitute(preload=preload or '', host=host, port=port, path=repr(path))
 
 ################################################################################
 
-def worker_script(worker, scheduler, *, python=None, preload='', interfaces=('eth0', 'en0', 'ens3')):
+def spill_info():
+    '''The spill directory and measured throughput (MB/s) of a worker, or None (run this on the remote)'''
+    import dask
+    return dask.config.get('cloud', {}).get('spill')
+
+def _spill(spill, thresholds):
+    if spill is None:
+        return ''
+    return spill_script(spill) if thresholds is None else spill_script(spill, thresholds)
+
+def worker_script(worker, scheduler, *, python=None, preload='', interfaces=('eth0', 'en0', 'ens3'), persist=False,
+                  nprocs=1, nthreads=None, name=None, resources=None, spill=None, thresholds=None,
+                  environment=None, sources=(), token=None, versions=None, check='warn'):
     '''
     worker and scheduler are pairs of (IP, port)
+    If the worker IP is None, the floating IP is looked up on the instance at boot.
     The script will write a dask.yml in the home directory (perhaps in /root).
     dask-worker {SCHEDULERIP}:8786 --nthreads 0 --nprocs 1 --listen-address tcp://{WORKERETH}:8001 --contact-address tcp://{WORKERIP}:8001
     interfaces is a list of possible IP interfaces that should be tried in order
+    If persist, the script also runs on every later boot, e.g. after unshelving.
+    nprocs worker processes listen on ports port, port+1, ... with nthreads threads
+    each (default: the cores divided evenly between them).
+    If name is given, each worker is named {name}-{IP}-{port}.
+    resources is a dict of custom dask resources per worker process, added to the detected
+    THREADS, CORES, MEMORY, SCRATCH and VOLUME:<mount> ones (see cloud.resources).
+    If spill is given, workers spill to that disk past the memory thresholds (see spill_script).
+    If environment is given, the script runs in that packed environment from `sources` (see
+    environment_script), fetched from a payload store with `token`. versions is a dict of module versions which the worker's are compared
+    to before it starts, and check is what to do if they differ: 'warn' or 'raise'.
+    '''
+    host, port = worker
+    shost, sport = scheduler
+    prelude = '' if environment is None else environment_script(environment, sources, token)
+    return shebang(python) + prelude + configure() + templates.worker.substitute(preload=repr(preload or ''),
+        interfaces=repr(interfaces), host=repr(host), port=port, shost=repr(shost), sport=sport, persist=bool(persist),
+        nprocs=int(nprocs), nthreads=repr(nthreads), name=repr(name), resources=repr(dict(resources or {})),
+        spill=_spill(spill, thresholds), versions=repr(versions), check=repr(check))
+
+################################################################################
+
+def worker_payload(*, preload='', interfaces=('eth0', 'en0', 'ens3'), persist=False, nprocs=1, nthreads=None, name=None,
+                   resources=None, spill=None, thresholds=None, versions=None, check='warn'):
+    '''
+    Returns the part of a worker script which is the same for every worker of a cluster:
+    the dask config (as a difference from the defaults), preload modules and worker launcher.
+    The addresses are read from the HOST, PORT, SHOST and SPORT globals set by bootstrap_script.
+    '''
+    return configure(diff=True) + templates.worker.substitute(preload=repr(preload or ''), interfaces=repr(interfaces),
+        host='HOST', port='PORT', shost='SHOST', sport='SPORT', persist=bool(persist),
+        nprocs=int(nprocs), nthreads=repr(nthreads), name=repr(name), resources=repr(dict(resources or {})),
+        spill=_spill(spill, thresholds), versions=repr(versions), check=repr(check))
+
+def payload_digest(payload):
+    '''Content address (sha256 hex digest) of a payload'''
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def bootstrap_script(worker, scheduler, digest, sources, *, python=None, environment=None, token=None):
+    '''
+    Returns a small worker script which fetches the payload with the given digest from the first
+    of `sources` which has it, checks its hash and runs it. Sources are URLs of a payload store
+    (e.g. 'http://{SCHEDULERIP}:8789', which needs its `token`) or directories on a shared volume.
+    worker and scheduler are pairs of (IP, port) as in worker_script.
+    If environment is given, the payload runs in that packed environment from the same sources.
     '''
     host, port = worker
     shost, sport = scheduler
-    return shebang(python) + configure() + templates.worker.substitute(preload=preload or '',
-        interfaces=repr(interfaces), host=host, port=port, shost=shost, sport=sport)
+    prelude = '' if environment is None else environment_script(environment, sources, token)
+    return shebang(python) + prelude + templates.bootstrap.substitute(host=repr(host), port=int(port), shost=repr(shost),
+        sport=int(sport), digest=repr(digest), sources=repr(list(sources)), token=repr(None if token is None else str(token)))
+
+################################################################################
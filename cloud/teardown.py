@@ -0,0 +1,124 @@
+'''
+Bounded-concurrency teardown of servers and floating IPs
+
+Servers are (optionally) stopped, then deleted, with at most `concurrency` API calls in
+flight. Their IPs are released in one pass afterwards, and the inventory is used to wait
+for the deletions and to report anything which leaked.
+'''
+import time, logging, typing
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+import fn
+
+from .ostack import get_inventory
+
+log = logging.getLogger(__name__)
+
+################################################################################
+
+class TeardownReport(typing.NamedTuple):
+    servers: list        # ids of servers which were deleted
+    ips: list            # addresses of IPs which were released or deleted
+    failed: dict         # server id or IP address -> exception
+    leaked_servers: list # ids of servers still present at the end
+    leaked_ips: list     # addresses of deleted IPs still present at the end
+    seconds: float
+
+    @property
+    def clean(self):
+        return not (self.failed or self.leaked_servers or self.leaked_ips)
+
+    def __str__(self):
+        return 'TeardownReport({} servers, {} IPs, {} failed, {} leaked servers, {} leaked IPs, {:.1f}s)'.format(
+            len(self.servers), len(self.ips), len(self.failed), len(self.leaked_servers), len(self.leaked_ips), self.seconds)
+
+################################################################################
+
+def log_progress(phase, done, total):
+    '''Default progress callback: log every 10% of each phase'''
+    if done == total or done % max(1, total // 10) == 0:
+        log.info('Teardown {}: {}/{}'.format(phase, done, total))
+
+################################################################################
+
+class Teardown:
+    '''
+    Deletes servers and floating IPs on one connection
+    - `concurrency`: most API calls in flight at once
+    - `graceful`: stop the servers first, waiting up to `grace` seconds in total for SHUTOFF
+    - `timeout`: seconds to wait for deleted servers to disappear before reporting them as leaked
+    - `progress`: callable of (phase, done, total), for phases 'stop', 'delete' and 'release'
+    '''
+    def __init__(self, conn, *, concurrency=16, graceful=True, grace=30, timeout=300, progress=log_progress):
+        self.conn = conn
+        self.concurrency = int(concurrency)
+        self.graceful = graceful
+        self.grace = grace
+        self.timeout = timeout
+        self.progress = progress or (lambda phase, done, total: None)
+
+    def _map(self, pool, phase, function, items, failed):
+        '''Call function on each item, reporting progress, and return the items which succeeded'''
+        tasks = {pool.submit(function, i): i for i in items}
+        out = []
+        for n, t in enumerate(as_completed(tasks), 1):
+            e = t.exception()
+            if e is None:
+                out.append(tasks[t])
+            else:
+                log.warning(fn.message('Teardown failed', phase=phase, item=tasks[t], exception=e))
+                failed[tasks[t]] = e
+            self.progress(phase, n, len(tasks))
+        return out
+
+    def _stop(self, server):
+        s = get_inventory(self.conn).server(server, refresh=False)
+        if s is not None and s.status.upper() not in ('SHUTOFF', 'ERROR'):
+            self.conn.compute.stop_server(server)
+
+    def _delete_server(self, server):
+        self.conn.compute.delete_server(server, ignore_missing=True)
+
+    def _delete_ip(self, ip):
+        fip = get_inventory(self.conn).ip(ip, refresh=False)
+        if fip is not None:
+            self.conn.network.delete_ip(fip['id'], ignore_missing=True)
+
+    def run(self, servers=(), ips=(), release=None):
+        '''
+        Delete the servers (objects or ids), then release the IPs (addresses) with `release`,
+        or delete them if it is None. Returns a TeardownReport.
+        '''
+        start = time.time()
+        servers = list(dict.fromkeys(getattr(s, 'id', s) for s in servers))
+        ips = list(dict.fromkeys(ips))
+        inventory = get_inventory(self.conn)
+        inventory.refresh()
+        failed = {}
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            if self.graceful and servers:
+                stopped = self._map(pool, 'stop', self._stop, servers, {}) # deletion goes ahead regardless
+                waits = [inventory.wait_for_status(s, ('SHUTOFF', 'MISSING'), ('ERROR',)) for s in stopped]
+                wait(waits, timeout=self.grace)
+                for w in waits:
+                    w.cancel()
+            deleted = self._map(pool, 'delete', self._delete_server, servers, failed)
+            released = self._map(pool, 'release', self._delete_ip if release is None else release, ips, failed)
+        gone = [inventory.wait_for_status(s, ('MISSING', 'DELETED'), ()) for s in deleted]
+        done, pending = wait(gone, timeout=self.timeout)
+        for w in pending:
+            w.cancel()
+        inventory.refresh()
+        leaked_servers = [s for s in servers if getattr(inventory.server(s, refresh=False), 'status', 'DELETED').upper() != 'DELETED']
+        leaked_ips = [] if release is not None else [i for i in released if inventory.ip(i, refresh=False) is not None]
+        report = TeardownReport(deleted, released, failed, leaked_servers, leaked_ips, time.time() - start)
+        (log.info if report.clean else log.warning)(str(report))
+        return report
+
+################################################################################
+
+def teardown(conn, servers=(), ips=(), release=None, **kwargs):
+    '''Delete servers and release IPs on conn. See Teardown for keywords'''
+    return Teardown(conn, **kwargs).run(servers, ips, release)
+
+################################################################################
@@ -0,0 +1,273 @@
+'''
+Cluster-wide resource telemetry: CPU, memory, network and disk of every worker
+
+Workers add a 'telemetry' metric (see Sampler) to the heartbeats they already send to the
+scheduler, where a Telemetry collector reads the latest ones every `interval` seconds,
+adds a cluster-wide row, and writes the rows in batches to its sinks: CloudWatchMetrics,
+CSVSink or ParquetSink. Like cloudwatch.py, this module is inlined into worker and
+scheduler scripts (see script.preload_telemetry), so it stays self-contained.
+'''
+import os, sys, csv, time, queue, atexit, logging, datetime, threading, collections
+
+import psutil, distributed
+from tornado.ioloop import PeriodicCallback
+
+try:
+    from .cloudwatch import AwsSession, retry_log
+except ImportError: # inlined into a script after cloudwatch.py
+    pass
+
+log = logging.getLogger(__name__)
+
+################################################################################
+
+# Sampled fields and their CloudWatch units
+UNITS = dict(cpu='Percent', memory='Bytes', memory_percent='Percent', net_sent='Bytes/Second',
+             net_recv='Bytes/Second', disk_read='Bytes/Second', disk_write='Bytes/Second')
+
+FIELDS = ('time', 'worker') + tuple(UNITS)
+
+class Sampler:
+    '''CPU and memory use of this machine, and its network and disk bytes/s since the last sample'''
+    def __init__(self):
+        psutil.cpu_percent(None)
+        self.last = self._counters()
+
+    @staticmethod
+    def _counters():
+        net, disk = psutil.net_io_counters(), psutil.disk_io_counters()
+        return (time.time(), net.bytes_sent, net.bytes_recv,
+                getattr(disk, 'read_bytes', 0), getattr(disk, 'write_bytes', 0))
+
+    def sample(self):
+        now, last = self._counters(), self.last
+        self.last = now
+        dt = max(now[0] - last[0], 1e-6)
+        mem = psutil.virtual_memory()
+        out = dict(cpu=psutil.cpu_percent(None), memory=mem.total - mem.available, memory_percent=mem.percent)
+        out.update(zip(('net_sent', 'net_recv', 'disk_read', 'disk_write'), ((a - b) / dt for a, b in zip(now[1:], last[1:]))))
+        return out
+
+SAMPLER = None
+
+def worker_metric(worker=None):
+    '''Heartbeat metric of a worker: a Sampler sample of its machine'''
+    global SAMPLER
+    if SAMPLER is None:
+        SAMPLER = Sampler()
+    return SAMPLER.sample()
+
+def install_worker_metric():
+    '''Add worker_metric to the heartbeats of the workers later created in this process'''
+    metrics = getattr(distributed.worker, 'DEFAULT_METRICS', None)
+    if metrics is None:
+        log.warning('This version of distributed does not support custom worker metrics')
+    else:
+        metrics['telemetry'] = worker_metric
+
+################################################################################
+
+class CloudWatchMetrics:
+    '''
+    Sink putting rows to CloudWatch metrics in `namespace`, dimensioned by worker address
+    (the cluster-wide rows have worker 'cluster'), in requests of up to `max_count` values
+    With per_worker=False only the cluster-wide rows are sent.
+    '''
+    def __init__(self, namespace, session=None, dimensions=None, per_worker=True, max_count=1000, deadline=600):
+        self.namespace = str(namespace)
+        self.session = AwsSession(session)
+        self.dimensions = [dict(Name=k, Value=str(v)) for k, v in (dimensions or {}).items()]
+        self.per_worker = per_worker
+        self.max_count = int(max_count)
+        self.deadline = deadline
+        self.client = None
+
+    def datums(self, rows):
+        for r in rows:
+            if self.per_worker or r['worker'] == 'cluster':
+                stamp = datetime.datetime.fromtimestamp(r['time'], datetime.timezone.utc)
+                dims = [dict(Name='Worker', Value=r['worker'])] + self.dimensions
+                for k, unit in UNITS.items():
+                    if r.get(k) is not None:
+                        yield dict(MetricName=k, Dimensions=dims, Timestamp=stamp, Value=float(r[k]), Unit=unit)
+
+    def write(self, rows):
+        if self.client is None:
+            self.client = self.session.boto.client('cloudwatch')
+        data = list(self.datums(rows))
+        for i in range(0, len(data), self.max_count):
+            retry_log(self.client.put_metric_data, deadline=self.deadline,
+                Namespace=self.namespace, MetricData=data[i:i + self.max_count])
+
+class CSVSink:
+    '''Sink appending rows to a CSV file, with a header if it is new'''
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def write(self, rows):
+        new = not os.path.exists(self.path)
+        with open(self.path, 'a', newline='') as f:
+            w = csv.DictWriter(f, FIELDS, extrasaction='ignore')
+            if new:
+                w.writeheader()
+            w.writerows(rows)
+
+class ParquetSink:
+    '''Sink writing each batch of rows to a new Parquet file in a directory (needs pandas and pyarrow)'''
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.count = 0
+
+    def write(self, rows):
+        import pandas as pd
+        os.makedirs(self.directory, exist_ok=True)
+        self.count += 1
+        name = 'telemetry-%d-%05d.parquet' % (int(rows[0]['time']), self.count)
+        pd.DataFrame(rows, columns=FIELDS).to_parquet(os.path.join(self.directory, name))
+
+################################################################################
+
+class Telemetry:
+    '''
+    Scheduler-side collector of worker telemetry
+    Every `interval` seconds the latest sample of each worker, and a cluster-wide row of
+    their sums over VMs (mean for percentages), are kept in `rows` (the last `history` of
+    them) and queued for the sinks, which a background thread writes in batches of up to
+    `batch` rows at least every `flush` seconds, and at exit. Sink errors are logged and the
+    batch is dropped.
+    '''
+    def __init__(self, sinks=(), interval=10, flush=60, batch=1000, history=10000):
+        self.sinks = list(sinks)
+        self.interval = float(interval)
+        self.flush = float(flush)
+        self.batch = int(batch)
+        self.rows = collections.deque(maxlen=history)
+        self.pending = queue.Queue()
+        self.thread = None
+        self.callback = None
+
+    @staticmethod
+    def _metrics(scheduler):
+        '''Latest heartbeat metrics of each worker'''
+        for address, ws in list(scheduler.workers.items()):
+            metrics = getattr(ws, 'metrics', None)
+            if metrics is None: # older schedulers keep them in worker_info
+                metrics = scheduler.worker_info.get(address, {}).get('metrics', {})
+            yield address, metrics
+
+    @staticmethod
+    def host(worker):
+        '''Host of a worker address, e.g. 10.0.0.5 of tcp://10.0.0.5:40123'''
+        return worker.split('://')[-1].rsplit(':', 1)[0]
+
+    @classmethod
+    def aggregate(cls, rows, now):
+        '''
+        Cluster-wide row of some worker rows
+        Samples are of the whole machine, so the workers of one VM (nprocs > 1) count once,
+        with the mean of their samples.
+        '''
+        hosts = {}
+        for r in rows:
+            hosts.setdefault(cls.host(r['worker']), []).append(r)
+        out = dict(time=now, worker='cluster')
+        for k in UNITS:
+            values = []
+            for same in hosts.values():
+                v = [r[k] for r in same if r.get(k) is not None]
+                if v:
+                    values.append(sum(v) / len(v))
+            out[k] = (sum(values) / len(values) if k.endswith(('cpu', 'percent')) else sum(values)) if values else None
+        return out
+
+    def collect(self, scheduler):
+        now = time.time()
+        rows = [dict(m['telemetry'], time=now, worker=a) for a, m in self._metrics(scheduler) if m.get('telemetry')]
+        if rows:
+            rows.append(self.aggregate(rows, now))
+        self.rows.extend(rows)
+        if self.sinks:
+            for r in rows:
+                self.pending.put(r)
+
+    def _write(self, rows):
+        for sink in self.sinks:
+            try:
+                sink.write(rows)
+            except Exception as e:
+                log.warning('Telemetry sink {} failed on {} rows: {}'.format(type(sink).__name__, len(rows), e))
+
+    def _writer(self):
+        rows, deadline = [], time.time() + self.flush
+        while True:
+            try:
+                row = self.pending.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                row = None
+            if row is not None:
+                rows.append(row)
+            if row is StopIteration or len(rows) >= self.batch or time.time() >= deadline:
+                rows = [r for r in rows if r is not StopIteration]
+                if rows:
+                    self._write(rows)
+                rows, deadline = [], time.time() + self.flush
+            if row is StopIteration:
+                return
+
+    def attach(self, scheduler):
+        '''Start collecting on a scheduler's event loop, and write what is pending at exit'''
+        self.callback = PeriodicCallback(lambda: self.collect(scheduler), self.interval * 1000)
+        scheduler.periodic_callbacks['telemetry'] = self.callback
+        scheduler.telemetry = self
+        scheduler.loop.add_callback(self.callback.start)
+        if self.sinks and self.thread is None:
+            self.thread = threading.Thread(target=self._writer, name='telemetry', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+        return self
+
+    def close(self):
+        '''Stop collecting and write what is pending'''
+        if self.callback is not None:
+            self.callback.stop()
+        if self.thread is not None:
+            self.pending.put(StopIteration)
+            self.thread.join()
+            self.thread = None
+            atexit.unregister(self.close)
+
+################################################################################
+
+def watch_scheduler(telemetry, poll=1):
+    '''Attach telemetry to the first Scheduler created in this process, from a daemon thread'''
+    def watch():
+        while True:
+            for s in list(getattr(distributed.Scheduler, '_instances', ())):
+                telemetry.attach(s)
+                return
+            time.sleep(poll)
+    threading.Thread(target=watch, name='telemetry-watch', daemon=True).start()
+
+def install_telemetry(telemetry):
+    '''
+    Install telemetry in a worker or scheduler script (see script.preload_telemetry): workers
+    report samples in their heartbeats and a scheduler collects them with `telemetry`
+    '''
+    install_worker_metric()
+    if 'distributed.cli.dask_scheduler' in sys.modules:
+        watch_scheduler(telemetry)
+    return telemetry
+
+def telemetry_rows(dask_scheduler=None, since=0):
+    '''Rows collected by the scheduler's Telemetry after time `since` (run this with client.run_on_scheduler)'''
+    telemetry = getattr(dask_scheduler, 'telemetry', None)
+    return [] if telemetry is None else [r for r in list(telemetry.rows) if r['time'] > since]
+
+def collect_telemetry(client, since=0, sink=None):
+    '''Rows collected on the scheduler of a client after time `since`, also written to `sink` if given'''
+    rows = client.run_on_scheduler(telemetry_rows, since=since)
+    if sink is not None and rows:
+        sink.write(rows)
+    return rows
+
+################################################################################
@@ -12,6 +12,21 @@ if __name__ == '__main__':
 
 ################################################################################
 
+# Follows the inlined cloud/telemetry.py (and cloud/cloudwatch.py if there is a namespace)
+telemetry = Template(r'''
+if __name__ == '__main__':
+    sinks = []
+    if $namespace:
+        sinks.append(CloudWatchMetrics($namespace, session=$session, dimensions=$dimensions, per_worker=$per_worker))
+    if $csv:
+        sinks.append(CSVSink($csv))
+    if $parquet:
+        sinks.append(ParquetSink($parquet))
+    install_telemetry(Telemetry(sinks, interval=$interval, flush=$flush))
+''')
+
+################################################################################
+
 config = Template(r'''
 import dask
 if __name__ == '__main__':
@@ -20,14 +35,98 @@ if __name__ == '__main__':
 
 ################################################################################
 
+# Mounting of an attached disk from within a boot script, as mount_volume does over SSH
+# volume is a Cinder volume id, '' for the first attached volume which is not mounted
+# (e.g. a blank one created with the server), or None for the flavor's ephemeral disk
+# A disk without a filesystem (e.g. a new volume) is formatted first
+disk = Template(r'''
+import os, glob, time, subprocess
+
+def find_disk(volume, timeout=600):
+    end = time.time() + timeout
+    while True:
+        if volume is None:
+            found = glob.glob('/dev/disk/by-label/ephemeral0')
+        else:
+            found = glob.glob('/dev/disk/by-id/*%s*' % volume[:20] if volume else '/dev/disk/by-id/virtio-*')
+            if not volume:
+                with open('/proc/mounts') as f:
+                    mounted = {os.path.realpath(l.split()[0]) for l in f}
+                found = [d for d in found if not any(m.startswith(os.path.realpath(d)) for m in mounted)]
+        if found:
+            # Sometimes part is added i.e. id-part1 etc. and it seems like that is the one we want
+            return max(found, key=len)
+        if time.time() > end:
+            raise TimeoutError('No disk found for volume %r' % volume)
+        time.sleep(2)
+
+def mount_disk(volume, mount, user=None):
+    if not os.path.ismount(mount):
+        dev = find_disk(volume)
+        if subprocess.run(['blkid', dev], stdout=subprocess.DEVNULL).returncode:
+            subprocess.run(['mkfs.ext4', '-q', dev], check=True)
+        subprocess.run(['mkdir', '-p', mount], check=True)
+        subprocess.run(['mount', dev, mount], check=True)
+    if user:
+        subprocess.run(['chown', '-R', user, mount], check=True)
+        subprocess.run(['chmod', '-R', 'g+rw', mount], check=True)
+    return mount
+''')
+
+# Puts the worker's local directory on a mounted disk, sets the memory fractions at which
+# dask spills to it and pauses, and measures its sequential throughput in MB/s
+spill = Template(r'''
+def spill_throughput(path, size=$size, block=4 * 2**20):
+    name = os.path.join(path, 'throughput-%d' % os.getpid())
+    data = os.urandom(block)
+    try:
+        start = time.time()
+        with open(name, 'wb') as f:
+            for _ in range(max(1, size // block)):
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        write = time.time() - start
+        with open(name, 'rb') as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            start = time.time()
+            while f.read(block):
+                pass
+        read = time.time() - start
+    finally:
+        os.remove(name)
+    mb = max(1, size // block) * block / 2**20
+    return dict(write=round(mb / max(write, 1e-6), 1), read=round(mb / max(read, 1e-6), 1))
+
+if __name__ == '__main__':
+    SPILL = dict(path=os.path.join(mount_disk($volume, $mount, getpass.getuser()), 'dask-worker-space'))
+    os.makedirs(SPILL['path'], exist_ok=True)
+    dask.config.set({'temporary-directory': SPILL['path'],
+        'distributed.worker.memory.target': $target, 'distributed.worker.memory.spill': $spill,
+        'distributed.worker.memory.pause': $pause})
+    if $size:
+        SPILL.update(spill_throughput(SPILL['path']))
+    logging.getLogger('distributed.worker').info('Spilling to disk ' + str(SPILL))
+''')
+
+# Mounts the scheduler's volume and makes its local directory there
+scheduler_volume = Template(r'''
+if __name__ == '__main__':
+    os.makedirs(os.path.join(mount_disk($volume, $mount), 'dask-scheduler'), exist_ok=True)
+''')
+
+################################################################################
+
 scheduler = Template(r'''
-import os, sys, yaml, getpass, pathlib, dask, distributed, logging, resource
+import os, sys, time, yaml, getpass, pathlib, psutil, dask, distributed, logging, resource
 from distributed.cli.dask_scheduler import go
 
 if __name__ == '__main__':
+    started = time.time()
     os.chdir(pathlib.Path.home())
     resource.setrlimit(resource.RLIMIT_NOFILE, (131072, 131072))
-    info = dict(ip='$host', pid=os.getpid(), pwd=os.getcwd(), user=getpass.getuser(), port=$port, path=$path)
+    info = dict(ip='$host', pid=os.getpid(), pwd=os.getcwd(), user=getpass.getuser(), port=$port, path=$path,
+                booted=psutil.boot_time(), started=started)
     dask.config.set(cloud=info)
     with pathlib.Path('~/dask.yml').expanduser().open('w') as f:
         yaml.dump(dask.config.config, f)
@@ -45,36 +144,416 @@ if __name__ == '__main__':
 ################################################################################
 
 # A wrapper around dask-worker to provide some more flexibility
-# Processes must be set to 1 because of limitation on listen address
+# dask-worker --nprocs can't give each process its own listen and contact address,
+# so the script forks one single-process dask-worker per port in port, port+1, ...
+# and splits the cores between them
+# If no host is given (e.g. a batch of servers sharing one user data), the
+# floating IP is read from the metadata service once it has been attached
+# If persist is set, the script installs itself to run on every boot (for shelved workers)
+# If name is set, workers are named {name}-{host}-{port}, e.g. to tell pools apart
+# Each process advertises its share of the VM as dask resources (see cloud.resources),
+# plus the custom resources given, which override detected ones of the same name
+# If spill is given (see templates.spill), it runs before the worker config is recorded
+# If versions are given, the worker's are compared with them before it starts (see check)
 worker = Template(r'''
-import os, sys, psutil, yaml, getpass, pathlib, multiprocessing, dask, distributed, logging, resource
+import os, sys, time, shutil, psutil, yaml, getpass, pathlib, multiprocessing, dask, distributed, logging, resource, urllib.request
 from distributed.cli.dask_worker import go
-from distributed.utils import get_ip_interface
+from distributed.utils import get_ip, get_ip_interface
+
+def public_ip(url='http://169.254.169.254/latest/meta-data/public-ipv4', timeout=1800):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            ip = urllib.request.urlopen(url, timeout=5).read().decode().strip()
+            if ip:
+                return ip
+        except OSError:
+            pass
+        time.sleep(2)
+    ip = get_ip()
+    logging.getLogger('distributed.worker').warning('No public IP in metadata, using interface IP ' + ip)
+    return ip
 
 if __name__ == '__main__':
+    started = time.time()
     os.chdir(pathlib.Path.home())
     resource.setrlimit(resource.RLIMIT_NOFILE, (131072, 131072))
-    info = dict(ip='$host', pid=os.getpid(), pwd=os.getcwd(), user=getpass.getuser(), port=$port)
+    host = $host or public_ip()
+    per_boot = pathlib.Path('/var/lib/cloud/scripts/per-boot/dask-worker')
+    if $persist and pathlib.Path(sys.argv[0]).resolve() != per_boot and per_boot.parent.is_dir():
+        shutil.copy(sys.argv[0], str(per_boot))
+        per_boot.chmod(0o755)
+    SPILL = None
+
+$spill
+
+if __name__ == '__main__':
+    info = dict(ip=host, pid=os.getpid(), pwd=os.getcwd(), user=getpass.getuser(), port=$port,
+                booted=psutil.boot_time(), started=started, spill=SPILL)
     dask.config.set(cloud=info)
     with pathlib.Path('~/dask.yml').expanduser().open('w') as f:
         yaml.dump(dask.config.config, f)
 
-$preload
+# Run by run_worker in each worker process, since forked processes do not inherit the
+# threads it may start (e.g. those of a CloudWatchHandler)
+PRELOAD = $preload
 
-if __name__ == '__main__':
-    allowed = tuple(psutil.net_if_addrs().keys())
-    ip = next(get_ip_interface(i) for i in $interfaces if i in allowed)
+def check_versions(expected, check):
+    import importlib
+    ver = lambda v: getattr(v, 'version', None) or getattr(v, '__version__', None)
+    differ, missing = {}, []
+    for name, version in expected.items():
+        try:
+            found = ver(importlib.import_module(name))
+        except Exception:
+            missing.append(name)
+            continue
+        if isinstance(found, str) and found != version:
+            differ[name] = (version, found)
+    log = logging.getLogger('distributed.worker')
+    if missing:
+        log.warning('Worker is missing modules of the client: ' + ', '.join(missing))
+    if differ:
+        msg = 'Worker module versions differ from the client (client, worker): ' + str(differ)
+        if check == 'raise':
+            raise RuntimeError(msg)
+        log.warning(msg)
+
+def worker_resources(nthreads, nprocs, custom):
+    out = dict(THREADS=nthreads, CORES=max(1, (psutil.cpu_count(logical=False) or 1) // nprocs),
+               MEMORY=psutil.virtual_memory().total // nprocs)
+    scratch = dask.config.get('temporary-directory', None) or os.getcwd()
+    out['SCRATCH'] = shutil.disk_usage(scratch).free // nprocs
+    for p in psutil.disk_partitions():
+        if p.mountpoint in ('/', '/boot') or p.mountpoint.startswith(('/boot/', '/snap/')):
+            continue
+        if any(c.isspace() or c in ',=' for c in p.mountpoint): # would split the --resources argument
+            logging.getLogger('distributed.worker').warning('Not advertising volume ' + repr(p.mountpoint))
+            continue
+        out['VOLUME:' + p.mountpoint] = shutil.disk_usage(p.mountpoint).free // nprocs
+    out.update(custom)
+    return out
 
+def run_worker(port):
+    if PRELOAD:
+        exec(compile(PRELOAD, '<preload>', 'exec'), dict(__name__='__main__'))
     sys.argv = ['dask-worker']
-    sys.argv += ['%s:%d' % ('$shost', $sport)]
-    sys.argv += ['--listen-address', 'tcp://%s:%d' % (ip, $port)]
-    sys.argv += ['--contact-address', 'tcp://%s:%d' % ('$host', $port)]
+    sys.argv += ['%s:%d' % ($shost, $sport)]
+    sys.argv += ['--listen-address', 'tcp://%s:%d' % (ip, port)]
+    sys.argv += ['--contact-address', 'tcp://%s:%d' % (host, port)]
+    if $name: sys.argv += ['--name', '%s-%s-%d' % ($name, host, port)]
     sys.argv += ['--nprocs', '1']
-    sys.argv += ['--nthreads', str(multiprocessing.cpu_count())]
+    sys.argv += ['--nthreads', str(nthreads)]
     sys.argv += ['--no-bokeh']
     sys.argv += ['--no-nanny'] # can't spawn processes with nanny
     sys.argv += ['--reconnect']
-    sys.argv += ['--resources', 'THREADS=%d' % multiprocessing.cpu_count()]
+    if SPILL: sys.argv += ['--local-directory', SPILL['path']]
+    resources = worker_resources(nthreads, nprocs, $resources)
+    sys.argv += ['--resources', ' '.join('%s=%s' % kv for kv in resources.items())]
     logging.getLogger('distributed.worker').info('Executing go with arguments ' + str(sys.argv))
     go()
+
+if __name__ == '__main__':
+    allowed = tuple(psutil.net_if_addrs().keys())
+    ip = next(get_ip_interface(i) for i in $interfaces if i in allowed)
+    nprocs = $nprocs
+    nthreads = $nthreads or max(1, multiprocessing.cpu_count() // nprocs)
+    if $versions:
+        check_versions($versions, $check)
+
+    if nprocs == 1:
+        run_worker($port)
+    else:
+        context = multiprocessing.get_context('fork')
+        procs = [context.Process(target=run_worker, args=($port + i,)) for i in range(nprocs)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+''')
+
+################################################################################
+
+# Content-addressed store for worker bootstrap payloads and packed environments, served
+# from the scheduler on its private address. Every request needs the cluster's token.
+# GET /<sha256> returns a payload (or the byte range in a Range header), HEAD gives its
+# size, and PUT /<sha256> with at most `limit` bytes stores one, streamed to disk, if its hash matches
+payload_store = Template(r'''
+import os, re, hmac, socket, hashlib, pathlib, threading, http.server
+
+def private_address():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.connect(('10.255.255.255', 1)) # sends nothing, just picks the interface of the default route
+        return s.getsockname()[0]
+
+def serve_payloads(port, root, token, limit, block=2**20):
+    root = pathlib.Path(root).expanduser()
+    root.mkdir(parents=True, exist_ok=True)
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def reply(self, code, data=b''):
+            self.send_response(code)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        def authorized(self):
+            if hmac.compare_digest(self.headers.get('Authorization', ''), 'Bearer ' + token):
+                return True
+            self.reply(403)
+            return False
+        def head(self):
+            if not self.authorized():
+                return None
+            path = root / pathlib.PurePosixPath(self.path).name
+            if not path.is_file():
+                self.reply(404)
+                return None
+            size = path.stat().st_size
+            start, stop = 0, size
+            match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if match:
+                start, stop = int(match.group(1)), min(size, int(match.group(2) or size - 1) + 1)
+            self.send_response(206 if match else 200)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(max(0, stop - start)))
+            if match:
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1, size))
+            self.end_headers()
+            return path, start, stop
+        def do_HEAD(self):
+            self.head()
+        def do_GET(self):
+            found = self.head()
+            if found is None:
+                return
+            path, start, stop = found
+            with path.open('rb') as f:
+                f.seek(start)
+                while start < stop:
+                    data = f.read(min(block, stop - start))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    start += len(data)
+        def do_PUT(self):
+            name = pathlib.PurePosixPath(self.path).name
+            if not self.authorized():
+                return
+            if not re.fullmatch('[0-9a-f]{64}', name):
+                return self.reply(404)
+            size = self.headers.get('Content-Length', '')
+            if not size.isdigit():
+                return self.reply(411)
+            if int(size) > limit:
+                return self.reply(413)
+            left, digest = int(size), hashlib.sha256()
+            partial = root / (name + '.%d.partial' % threading.get_ident())
+            with partial.open('wb') as f:
+                while left > 0:
+                    data = self.rfile.read(min(block, left))
+                    if not data:
+                        break
+                    digest.update(data)
+                    f.write(data)
+                    left -= len(data)
+            if left or digest.hexdigest() != name:
+                partial.unlink()
+                return self.reply(400)
+            os.replace(str(partial), str(root / name))
+            self.reply(201)
+        def log_message(self, *args):
+            pass
+    server = http.server.ThreadingHTTPServer((private_address(), port), Handler)
+    threading.Thread(target=server.serve_forever, name='payloads', daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    serve_payloads($port, $root, $token, $limit)
+''')
+
+################################################################################
+
+# Runs a script in a packed environment (see cloud.environment): it is fetched by its sha256
+# from the scheduler's payload store (http sources, in parallel byte ranges) or a shared
+# volume (directory sources), checked, and unpacked once to a local cache. Requests to the
+# store carry its token. The script then
+# runs itself again with the environment's python. Only the standard library is used here.
+environment = Template(r'''
+import os, sys, time, shutil, hashlib, tarfile, threading, subprocess, urllib.request
+
+def download_environment(url, path, token=None, threads=8, chunk=64 * 2**20):
+    auth = {} if token is None else {'Authorization': 'Bearer ' + token}
+    size = int(urllib.request.urlopen(urllib.request.Request(url, method='HEAD', headers=auth), timeout=60).headers['Content-Length'])
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    ranges = [(i, min(size, i + chunk)) for i in range(0, size, chunk)]
+    errors, lock = [], threading.Lock()
+    def work(fd):
+        while True:
+            with lock:
+                if not ranges or errors:
+                    return
+                start, stop = ranges.pop()
+            try:
+                request = urllib.request.Request(url, headers=dict(auth, Range='bytes=%d-%d' % (start, stop - 1)))
+                with urllib.request.urlopen(request, timeout=300) as r:
+                    while start < stop:
+                        data = r.read(min(2**20, stop - start))
+                        if not data:
+                            raise IOError('Short read from ' + url)
+                        os.pwrite(fd, data, start)
+                        start += len(data)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        pool = [threading.Thread(target=work, args=(fd,)) for _ in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+    finally:
+        os.close(fd)
+    if errors:
+        raise errors[0]
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(2**22), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+def unpack_environment(archive, target):
+    partial = target + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    if shutil.which('pigz'):
+        subprocess.run(['tar', '-I', 'pigz', '-xf', archive, '-C', partial], check=True)
+    else:
+        with tarfile.open(archive) as f:
+            f.extractall(partial)
+    if os.path.exists(os.path.join(partial, 'bin', 'conda-unpack')):
+        subprocess.run([os.path.join(partial, 'bin', 'python'), os.path.join(partial, 'bin', 'conda-unpack')], check=True)
+    os.rename(partial, target)
+
+def fetch_environment(digest, sources, token=None, cache='/var/cache/dask-environments', timeout=1800):
+    target = os.path.join(cache, digest)
+    if os.path.isdir(target):
+        return target
+    os.makedirs(cache, exist_ok=True)
+    end = time.time() + timeout
+    while True:
+        for source in sources:
+            archive = os.path.join(cache, digest + '.tar.gz')
+            try:
+                if '://' in source:
+                    download_environment(source.rstrip('/') + '/' + digest, archive, token)
+                else:
+                    archive = os.path.join(source, digest)
+            except OSError:
+                continue
+            if os.path.isfile(archive) and file_digest(archive) == digest:
+                unpack_environment(archive, target)
+                if archive.startswith(cache):
+                    os.remove(archive)
+                return target
+        if time.time() > end:
+            raise TimeoutError('Could not fetch environment ' + digest)
+        time.sleep(2)
+
+if __name__ == '__main__':
+    ENVIRONMENT = fetch_environment($digest, $sources, $token)
+    if os.path.realpath(sys.prefix) != os.path.realpath(ENVIRONMENT):
+        python = os.path.join(ENVIRONMENT, 'bin', 'python')
+        os.execv(python, [python] + sys.argv)
 ''')
+
+################################################################################
+
+# Builder script for an image (see cloud.bake): installs packages as root, compiles the
+# bytecode of every site-packages directory, imports heavy modules once so their caches
+# are built (skipping those not installed), prints one BAKE-STATUS line of JSON to the
+# console and powers off
+bake = Template(r'''
+import os, sys, json, time, shutil, subprocess
+
+def run_step(steps, name, commands, **kwargs):
+    start = time.time()
+    for c in commands:
+        print('BAKE-STEP ' + name + ': ' + str(c), flush=True)
+        subprocess.run(c, check=True, **kwargs)
+    steps[name] = round(time.time() - start, 1)
+
+if __name__ == '__main__':
+    python, steps, imports = $python, {}, {}
+    conda = os.path.join(os.path.dirname(shutil.which(python) or python), 'conda')
+    try:
+        if $apt:
+            env = dict(os.environ, DEBIAN_FRONTEND='noninteractive')
+            run_step(steps, 'apt', [['apt-get', 'update'], ['apt-get', 'install', '-y'] + $apt], env=env)
+        if $conda:
+            channels = [a for c in $channels for a in ('-c', c)]
+            run_step(steps, 'conda', [[conda if os.path.exists(conda) else 'conda', 'install', '-y'] + channels + $conda])
+        if $pip:
+            run_step(steps, 'pip', [[python, '-m', 'pip', 'install', '-U'] + $pip])
+        if $commands:
+            run_step(steps, 'commands', $commands, shell=True)
+        run_step(steps, 'compile', [[python, '-c', 'import compileall, site\n'
+            'for d in site.getsitepackages(): compileall.compile_dir(d, quiet=1, workers=0)']])
+        for m in $prewarm:
+            found = subprocess.run([python, '-c', 'import importlib.util, sys\n'
+                'sys.exit(importlib.util.find_spec(sys.argv[1]) is None)', m]).returncode == 0
+            if not found:
+                print('BAKE-STEP prewarm: skipping ' + m + ', which is not installed', flush=True)
+                imports[m] = None
+                continue
+            start = time.time()
+            subprocess.run([python, '-c', 'import ' + m], check=True)
+            imports[m] = round(time.time() - start, 2)
+        status = dict(ok=True, steps=steps, imports=imports)
+    except Exception as e:
+        status = dict(ok=False, error=str(e), steps=steps, imports=imports)
+    print('BAKE-STATUS ' + json.dumps(status), flush=True)
+    try: # in case script output does not reach the console log
+        with open('/dev/console', 'w') as f:
+            f.write('BAKE-STATUS ' + json.dumps(status) + '\n')
+    except OSError:
+        pass
+    subprocess.run(['cloud-init', 'clean', '--logs'])
+    subprocess.run(['poweroff'])
+''')
+
+################################################################################
+
+# Per-worker user data when the bulk of the script is shared: only the addresses
+# are inlined, and the payload is fetched by its sha256 from the scheduler's
+# payload store (http sources, with its token) or a shared volume (directory sources), checked, and run
+bootstrap = Template(r'''
+import time, hashlib, pathlib, urllib.request
+
+HOST, PORT, SHOST, SPORT = $host, $port, $shost, $sport
+
+def fetch_payload(digest, sources, token=None, timeout=1800):
+    auth = {} if token is None else {'Authorization': 'Bearer ' + token}
+    end = time.time() + timeout
+    while True:
+        for source in sources:
+            try:
+                if '://' in source:
+                    request = urllib.request.Request(source.rstrip('/') + '/' + digest, headers=auth)
+                    data = urllib.request.urlopen(request, timeout=30).read()
+                else:
+                    data = (pathlib.Path(source) / digest).read_bytes()
+            except OSError:
+                continue
+            if hashlib.sha256(data).hexdigest() == digest:
+                return data.decode()
+        if time.time() > end:
+            raise TimeoutError('Could not fetch payload ' + digest)
+        time.sleep(2)
+
+exec(compile(fetch_payload($digest, $sources, $token), 'payload-' + $digest[:12], 'exec'))
+''')
+
+################################################################################
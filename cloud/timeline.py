@@ -0,0 +1,127 @@
+'''
+Per-instance provisioning timelines, to see which phase of a scale-up dominates
+
+Phases, usually in this order (though e.g. a guest may boot before its IP is attached):
+- requested: the cluster asked for the instance
+- submitted: the create request was accepted by the API
+- active: the server reached ACTIVE
+- attached: its floating IP was attached
+- booted: the guest kernel booted (in-guest mark)
+- started: the worker or scheduler script started (in-guest mark)
+- registered: the dask worker was seen registered with the scheduler
+In-guest marks use the guest's clock, so they are only as good as its time sync.
+'''
+import time, threading
+
+import fn
+
+PHASES = ('requested', 'submitted', 'active', 'attached', 'booted', 'started', 'registered')
+
+################################################################################
+
+def percentile(values, q):
+    '''Nearest-rank percentile (q in 0-100) of some values, or None if there are none'''
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))] if values else None
+
+def guest_marks():
+    '''The in-guest marks and IP recorded by a worker or scheduler script (run this on the remote)'''
+    import dask
+    info = dask.config.get('cloud', {})
+    return {k: info[k] for k in ('ip', 'booted', 'started') if k in info}
+
+################################################################################
+
+class Timeline:
+    '''
+    Thread-safe record of when each instance reached each phase, keyed by IP
+    An instance's timeline begins with start(key); a later start() with the same key
+    (e.g. a recycled IP) begins a new row and keeps the old one.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = []    # (key, {phase: time})
+        self.current = {} # key -> {phase: time}
+
+    def start(self, key, t=None):
+        '''Begin a new timeline for key with its `requested` mark'''
+        marks = {'requested': time.time() if t is None else t}
+        with self.lock:
+            self.rows.append((key, marks))
+            self.current[key] = marks
+
+    def mark(self, key, phase, t=None, overwrite=False):
+        '''Record that key reached phase, keeping the first mark unless overwrite'''
+        assert phase in PHASES, phase
+        t = time.time() if t is None else t
+        with self.lock:
+            marks = self.current.get(key)
+            if marks is None:
+                marks = self.current[key] = {}
+                self.rows.append((key, marks))
+            if overwrite or phase not in marks:
+                marks[phase] = t
+
+    def marks(self, key):
+        '''Copy of the marks of key's current timeline'''
+        with self.lock:
+            return dict(self.current.get(key, {}))
+
+    def marker(self, key):
+        '''Callable of (phase) marking key, e.g. for create_server(mark=...)'''
+        return fn.partial(self.mark, key)
+
+    def update(self, key, marks):
+        '''Record several marks for key, keeping the earliest of each'''
+        for phase, t in marks.items():
+            if phase in PHASES:
+                with self.lock:
+                    current = self.current.get(key, {}).get(phase)
+                self.mark(key, phase, t, overwrite=current is not None and t < current)
+
+    def steps(self, marks):
+        '''Seconds spent reaching each phase from the phase recorded just before it in time'''
+        order = sorted((t, PHASES.index(p), p) for p, t in marks.items() if p in PHASES)
+        return {p: t - last for (last, _, _), (t, _, p) in zip(order, order[1:])}
+
+    def table(self):
+        '''One row per instance: its key, the seconds spent on each phase, and the total so far'''
+        with self.lock:
+            rows = [(k, dict(m)) for k, m in self.rows]
+        out = []
+        for key, marks in rows:
+            row = dict(key=key, **self.steps(marks))
+            if len(marks) > 1:
+                row['total'] = max(marks.values()) - min(marks.values())
+            out.append(row)
+        return out
+
+    def summary(self, percentiles=(50, 90, 99)):
+        '''For each phase (and the total), the count, mean and percentiles of seconds spent on it'''
+        table = self.table()
+        out = {}
+        for phase in PHASES[1:] + ('total',):
+            values = [r[phase] for r in table if phase in r]
+            if values:
+                out[phase] = dict(count=len(values), mean=sum(values) / len(values),
+                    **{'p%g' % q: percentile(values, q) for q in percentiles})
+        return out
+
+    def format(self, percentiles=(50, 90, 99)):
+        '''Text table of the summary'''
+        summary = self.summary(percentiles)
+        columns = ['count', 'mean'] + ['p%g' % q for q in percentiles]
+        lines = ['{:>12}'.format('phase') + ''.join('{:>10}'.format(c) for c in columns)]
+        for phase, row in summary.items():
+            lines.append('{:>12}'.format(phase) + ''.join('{:>10.4g}'.format(row[c]) for c in columns))
+        return '\n'.join(lines)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __str__(self):
+        return 'Timeline({} instances)'.format(len(self.rows))
+
+    __repr__ = __str__
+
+################################################################################
@@ -0,0 +1,121 @@
+'''
+Benchmark cloud.cloudwatch.CloudWatchHandler against an in-process stand-in for CloudWatch Logs
+
+For each combination of interval, max_count and max_size this reports the emit-side
+overhead per record, the end-to-end delivery latency (record creation to acceptance
+by the fake service) and, with --memory, the peak Python memory while logging. The fake service can
+inject latency, ThrottlingException and InvalidSequenceTokenException errors.
+
+    python bench_cloudwatch.py --records 50000 --interval 0.5 5 --max-count 1000 10000 --throttle 0.05
+'''
+import argparse, itertools, logging, random, threading, time, tracemalloc, warnings
+
+from botocore.exceptions import ClientError
+
+from cloud.cloudwatch import CloudWatchHandler, CloudWatchWarning
+
+###############################################################################
+
+class FakeLogs:
+    '''Thread-safe stand-in for a boto3 CloudWatch Logs client'''
+    def __init__(self, latency=0.0, throttle=0.0, token_errors=0.0, seed=0):
+        self.latency = float(latency)
+        self.throttle = float(throttle)
+        self.token_errors = float(token_errors)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.token = 0
+        self.calls = self.errors = 0
+        self.delays = [] # milliseconds from record creation to acceptance
+
+    def _error(self, code, message):
+        with self.lock:
+            self.errors += 1
+        return ClientError({'Error': {'Code': code, 'Message': message}}, 'PutLogEvents')
+
+    def create_log_stream(self, **kwargs):
+        return {}
+
+    def put_log_events(self, *, logGroupName, logStreamName, logEvents, sequenceToken=None):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            roll = self.random.random()
+        if roll < self.throttle:
+            raise self._error('ThrottlingException', 'Rate exceeded')
+        if roll < self.throttle + self.token_errors:
+            raise self._error('InvalidSequenceTokenException',
+                'The given sequenceToken is invalid. The next expected sequenceToken is: %d' % self.token)
+        now = time.time() * 1000
+        with self.lock:
+            self.token += 1
+            self.delays.extend(now - e['timestamp'] for e in logEvents)
+            return {'nextSequenceToken': str(self.token)}
+
+class FakeSession:
+    '''Looks like an AwsSession to CloudWatchHandler'''
+    def __init__(self, client):
+        self.boto = self
+        self.client_ = client
+
+    def client(self, name):
+        return self.client_
+
+###############################################################################
+
+def percentile(values, q):
+    return sorted(values)[min(len(values) - 1, int(q * len(values)))] if values else float('nan')
+
+def run(records, payload, fake, memory=False, **kwargs):
+    '''Log `records` messages through a fresh handler and measure it. Tracing memory slows emit()'''
+    if memory:
+        tracemalloc.start()
+    handler = CloudWatchHandler('bench', stream='bench', session=FakeSession(fake), level=logging.INFO, **kwargs)
+    logger = logging.getLogger('bench-{}'.format(id(handler)))
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    message = 'x' * payload
+    start = time.perf_counter()
+    for i in range(records):
+        logger.info('record %d %s', i, message)
+    emit = time.perf_counter() - start
+    handler.close()
+    peak = tracemalloc.get_traced_memory()[1] if memory else float('nan')
+    tracemalloc.stop()
+    logger.removeHandler(handler)
+    return dict(emit_us=1e6 * emit / records, p50_ms=percentile(fake.delays, 0.5),
+        p99_ms=percentile(fake.delays, 0.99), peak_mb=peak / 1024**2, calls=fake.calls,
+        errors=fake.errors, **handler.stats())
+
+###############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--payload', type=int, default=100, help='characters per message')
+    parser.add_argument('--interval', type=float, nargs='+', default=[0.5, 5])
+    parser.add_argument('--max-count', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--max-size', type=int, nargs='+', default=[256 * 1024, 1024**2])
+    parser.add_argument('--capacity', type=int, default=100000)
+    parser.add_argument('--policy', choices=CloudWatchHandler.POLICIES, default='oldest')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per put_log_events call')
+    parser.add_argument('--throttle', type=float, default=0.0, help='probability of ThrottlingException')
+    parser.add_argument('--token-errors', type=float, default=0.0, help='probability of InvalidSequenceTokenException')
+    parser.add_argument('--memory', action='store_true', help='trace peak memory (inflates emit_us)')
+    args = parser.parse_args()
+    warnings.simplefilter('ignore', CloudWatchWarning)
+
+    columns = 'interval max_count max_size emit_us p50_ms p99_ms peak_mb calls errors sent dropped'.split()
+    print(' '.join('{:>10}'.format(c) for c in columns))
+    for interval, max_count, max_size in itertools.product(args.interval, args.max_count, args.max_size):
+        fake = FakeLogs(latency=args.latency, throttle=args.throttle, token_errors=args.token_errors)
+        out = run(args.records, args.payload, fake, interval=interval, max_count=max_count,
+            max_size=max_size, capacity=args.capacity, policy=args.policy, memory=args.memory)
+        out.update(interval=interval, max_count=max_count, max_size=max_size)
+        print(' '.join('{:>10.4g}'.format(out[c]) for c in columns))
+
+if __name__ == '__main__':
+    main()
+
+###############################################################################
@@ -0,0 +1,61 @@
+'''
+Time `import cloud` and first access of its names, each in fresh interpreters
+
+`from cloud import *` loads every submodule, which is what `import cloud` used to cost
+before the submodules were loaded lazily. The heavy column lists which of openstack,
+boto3, dask and distributed each statement loaded.
+
+    python bench_import.py --repeat 10
+'''
+import argparse, os, sys, json, statistics, subprocess
+
+###############################################################################
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ('openstack', 'boto3', 'dask', 'distributed')
+
+STATEMENTS = {
+    'import': 'import cloud',
+    'timeline': 'import cloud; cloud.Timeline',
+    'telemetry': 'import cloud; cloud.Telemetry',
+    'cluster': 'import cloud; cloud.JetStreamCluster',
+    'everything': 'from cloud import *',
+}
+
+_RUN = '''
+import sys, time, json
+start = time.perf_counter()
+{}
+seconds = time.perf_counter() - start
+print(json.dumps(dict(seconds=seconds, modules=len(sys.modules), heavy=[m for m in {!r} if m in sys.modules])))
+'''
+
+def measure(statement, repeat):
+    '''Median seconds, module count and heavy modules loaded by a statement in a new interpreter'''
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', _RUN.format(statement, HEAVY)], cwd=ROOT,
+                             check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(out.splitlines()[-1]))
+    return statistics.median(r['seconds'] for r in runs), runs[-1]['modules'], runs[-1]['heavy']
+
+###############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='interpreters per statement')
+    parser.add_argument('statements', nargs='*', default=list(STATEMENTS), help='of: ' + ', '.join(STATEMENTS))
+    args = parser.parse_args()
+
+    print('{:>12} {:>10} {:>8}  {}'.format('statement', 'ms', 'modules', 'heavy'))
+    for name in args.statements:
+        try:
+            seconds, modules, heavy = measure(STATEMENTS[name], args.repeat)
+        except subprocess.CalledProcessError as e:
+            print('{:>12} failed: {}'.format(name, e.stderr.strip().splitlines()[-1]))
+            continue
+        print('{:>12} {:>10.1f} {:>8}  {}'.format(name, 1000 * seconds, modules, ','.join(heavy) or '-'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''
+Compare dask task throughput for worker layouts on one machine (a stand-in for one VM)
+
+Each layout is P worker processes x T threads with P * T = cores, from threads only
+(1 x cores) to processes only (cores x 1). GIL-bound Python tasks only scale with
+processes, while tasks which release the GIL (here, sleeping) also scale with threads.
+
+    python bench_worker_layout.py --cores 8 --tasks 2000 --size 100000
+'''
+import argparse, time, multiprocessing, distributed
+
+###############################################################################
+
+def python_task(n):
+    '''GIL-bound work'''
+    total = 0
+    for i in range(n):
+        total += i * i % 7
+    return total
+
+def release_task(n):
+    '''Work which releases the GIL'''
+    time.sleep(n * 1e-7)
+    return n
+
+TASKS = dict(python=python_task, release=release_task)
+
+###############################################################################
+
+def layouts(cores):
+    '''(processes, threads) pairs which use all the cores'''
+    return [(p, cores // p) for p in range(1, cores + 1) if cores % p == 0]
+
+def throughput(nprocs, nthreads, function, tasks, size):
+    '''Tasks per second for one layout, after a warm-up round'''
+    with distributed.LocalCluster(n_workers=nprocs, threads_per_worker=nthreads, processes=True,
+                                  dashboard_address=None) as cluster, distributed.Client(cluster) as client:
+        client.wait_for_workers(nprocs)
+        client.gather(client.map(function, [1] * nprocs * nthreads, pure=False))
+        start = time.perf_counter()
+        client.gather(client.map(function, [size] * tasks, pure=False))
+        return tasks / (time.perf_counter() - start)
+
+###############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cores', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=100000, help='loop length per task')
+    parser.add_argument('--kind', choices=sorted(TASKS), nargs='+', default=sorted(TASKS))
+    args = parser.parse_args()
+
+    print('{:>8} {:>10} {:>8} {:>12} {:>8}'.format('kind', 'processes', 'threads', 'tasks/s', 'speedup'))
+    for kind in args.kind:
+        base = None
+        for nprocs, nthreads in layouts(args.cores):
+            rate = throughput(nprocs, nthreads, TASKS[kind], args.tasks, args.size)
+            base = base or rate
+            print('{:>8} {:>10} {:>8} {:>12.1f} {:>8.2f}'.format(kind, nprocs, nthreads, rate, rate / base))
+
+if __name__ == '__main__':
+    main()
+
+###############################################################################
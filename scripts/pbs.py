@@ -1,70 +1,16 @@
 '''PBS submission from a process on the cluster'''
 import fn, sys, os, pathlib, datetime, tempfile, subprocess, shutil
 
-###############################################################################
-
-if shutil.which('sbatch') is None:
-    _CMD, _EXT = 'qsub', '{}.pbs'
-    _SCRIPT = """#!/bin/bash
-#PBS -S /bin/bash
-#PBS -V
-{timeout.ln}{nppn.ln}{memory.ln}{queue.ln}{path.ln}{output.ln}{error.ln}{name.ln}
-source ~/.bash_profile
-{python} remote.py {submit_time}
-
-"""
-    _COMMANDS = {
-        'name':     '#PBS -N {}',
-        'output':   '#PBS -o {}',
-        'queue':    '#PBS -q {}',
-        'timeout':  '#PBS -l walltime={}',
-        'nppn':     '#PBS -l nodes={}:ppn={}',
-        'memory':   '#PBS -l mem={}',
-        'path':     '#PBS -d {}',
-        'error':    '#PBS -e {}',
-    }
-else:
-    _CMD, _EXT = 'sbatch', '{}.sh'
-    _SCRIPT = """#!/bin/bash
-#SBATCH --export=ALL
-{name.ln}{output.ln}{queue.ln}{nodes.ln}{cpus.ln}{timeout.ln}{gpus.ln}{account.ln}{memory.ln}
-source ~/.bash_profile
-{python} remote.py {submit_time}
-
-"""
-    _COMMANDS = {
-        'name':      '#SBATCH --job-name="{}"',
-        'output':    '#SBATCH --output="{}"',
-        'error':     '#SBATCH --error="{}"',
-        'queue':     '#SBATCH --partition={}',
-        'timeout':   '#SBATCH --time={}',
-        'nodes':     '#SBATCH --nodes={}',
-        'cpus':      '#SBATCH --ntasks-per-node={}',
-        'gpus':      '#SBATCH --gres=gpu:{}',
-        'gpu-flags': '#SBATCH --gres-flags={}',
-        'path':      '#SBATCH --workdir={}',
-        'account':   '#SBATCH --account={}',
-        'memory':    '#PBS -l mem={}',
-    }
+from cloud.batch import Line, detect, submission_script as _submission_script
 
 ###############################################################################
 
-class Line:
-    def __init__(self, value, ln):
-        self.value = value
-        if value is None:
-            self.ln = ''
-        elif isinstance(value, (tuple, list)):
-            self.ln = ln.format(*value) + '\n'
-        else:
-            self.ln = ln.format(value) + '\n'
-
-    def __str__(self):
-        return str(self.value)
+_SYSTEM = detect()
+_CMD, _EXT = _SYSTEM.submit[0], _SYSTEM.ext
+_COMMANDS = _SYSTEM.commands
 
 def submission_script(script_inputs):
-    kwargs = {k: Line(script_inputs.get(k), v) for (k, v) in _COMMANDS.items()}
-    return _SCRIPT.format(python=sys.executable, submit_time=fn.unix_time(), **kwargs)
+    return _submission_script(script_inputs, system=_SYSTEM)
 
 ###############################################################################
 
@@ -0,0 +1,196 @@
+'''
+BatchCluster against fake sbatch, squeue and scancel (and qsub, qstat, qdel) on PATH
+
+The fakes keep the queue in a JSON file of task id -> state code, which the tests edit
+to move tasks between states.
+'''
+import os, sys, json, stat, subprocess
+
+import pytest
+
+from cloud.batch import BatchCluster, SLURM, PBS, detect
+
+################################################################################
+
+SBATCH = r'''
+import sys, json, os, re
+db = json.load(open(os.environ['FAKE_QUEUE']))
+lo, hi = map(int, re.search(r'--array=(\d+)-(\d+)', open(sys.argv[-1]).read()).groups())
+job = 100 + db['jobs']
+db['jobs'] += 1
+db['tasks'].update(('%d_%d' % (job, i), 'PD') for i in range(lo, hi + 1))
+json.dump(db, open(os.environ['FAKE_QUEUE'], 'w'))
+print('%d;cluster' % job)
+'''
+
+SQUEUE = r'''
+import sys, json, os
+db = json.load(open(os.environ['FAKE_QUEUE']))
+db['calls'].append(sys.argv[1:])
+json.dump(db, open(os.environ['FAKE_QUEUE'], 'w'))
+for task, state in db['tasks'].items():
+    print(task, state)
+'''
+
+SCANCEL = r'''
+import sys, json, os
+db = json.load(open(os.environ['FAKE_QUEUE']))
+for task in sys.argv[1:]:
+    db['tasks'].pop(task, None)
+db['cancelled'].extend(sys.argv[1:])
+json.dump(db, open(os.environ['FAKE_QUEUE'], 'w'))
+'''
+
+QSUB = r'''
+import sys, json, os, re
+db = json.load(open(os.environ['FAKE_QUEUE']))
+lo, hi = map(int, re.search(r'-t (\d+)-(\d+)', open(sys.argv[-1]).read()).groups())
+job = 100 + db['jobs']
+db['jobs'] += 1
+db['tasks'].update(('%d[%d]' % (job, i), 'Q') for i in range(lo, hi + 1))
+json.dump(db, open(os.environ['FAKE_QUEUE'], 'w'))
+print('%d[].server' % job)
+'''
+
+QSTAT = r'''
+import sys, json, os
+db = json.load(open(os.environ['FAKE_QUEUE']))
+print('Job ID          Name     User   Time Use S Queue')
+print('--------------- -------- ------ -------- - -----')
+for task, state in db['tasks'].items():
+    print(task + '.server', 'sweep', 'me', '0', state, 'batch')
+'''
+
+class Queue:
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def set(self, **states):
+        db = self.read()
+        for task, state in states.items():
+            if state is None:
+                db['tasks'].pop(task, None)
+            else:
+                db['tasks'][task] = state
+        with open(self.path, 'w') as f:
+            json.dump(db, f)
+
+def install(directory, **programs):
+    os.makedirs(directory, exist_ok=True)
+    for name, source in programs.items():
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write('#!{}\n{}'.format(sys.executable, source))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    install(str(tmp_path / 'bin'), sbatch=SBATCH, squeue=SQUEUE, scancel=SCANCEL, qsub=QSUB, qstat=QSTAT, qdel=SCANCEL)
+    path = str(tmp_path / 'queue.json')
+    with open(path, 'w') as f:
+        json.dump(dict(jobs=0, tasks={}, calls=[], cancelled=[]), f)
+    monkeypatch.setenv('FAKE_QUEUE', path)
+    monkeypatch.setenv('PATH', str(tmp_path / 'bin') + os.pathsep + os.environ['PATH'])
+    return Queue(path)
+
+@pytest.fixture
+def cluster(queue, tmp_path):
+    with BatchCluster('sweep', system='slurm', directory=str(tmp_path / 'jobs'),
+                      scheduler='tcp://10.0.0.1:8786', interval=3600) as c:
+        yield c
+
+################################################################################
+
+def test_detect(queue):
+    assert detect() is SLURM
+    assert detect('pbs') is PBS
+    assert detect('slurm').with_commands(status='/opt/squeue').status[0] == '/opt/squeue'
+
+def test_submit(cluster, queue):
+    assert cluster.submit(3) == '100'
+    assert cluster.workers == {'100_0': 'pending', '100_1': 'pending', '100_2': 'pending'}
+    script = open(os.path.join(cluster.directory, 'sweep-1.sh')).read()
+    assert '#SBATCH --array=0-2' in script
+    assert '--name "sweep-${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}"' in script
+    assert set(queue.read()['tasks']) == {'100_0', '100_1', '100_2'}
+
+def test_poll_states(cluster, queue):
+    cluster.submit(2)
+    queue.set(**{'100_0': 'R'})
+    assert cluster.poll() == {'100_0': 'running', '100_1': 'pending'}
+    assert cluster.counts() == dict(pending=1, running=1)
+    assert len(queue.read()['calls']) == 1 # one status call for all tasks
+    assert '--user=' in queue.read()['calls'][0][-1]
+
+def test_poll_removes_finished(cluster, queue):
+    cluster.submit(2)
+    queue.set(**{'100_0': 'R', '100_1': 'R'})
+    cluster.poll()
+    queue.set(**{'100_0': None, '100_1': 'CD'})
+    assert cluster.poll() == {}
+    assert cluster.jobs == {}
+
+def test_unlisted_tasks_wait_for_grace(cluster, queue):
+    cluster.submit(1)
+    queue.set(**{'100_0': None}) # not listed yet
+    assert cluster.poll() == {'100_0': 'pending'}
+    cluster.grace = -1
+    assert cluster.poll() == {}
+
+def test_scale(cluster, queue):
+    assert cluster.scale_up(2) == '100'
+    assert cluster.scale_up(2) is None
+    assert cluster.scale(4) == '101'
+    queue.set(**{'100_0': 'R', '100_1': 'R', '101_0': 'R'})
+    cluster.poll()
+    # pending before running, then newer before older
+    assert cluster.scale(2) == ['101_1', '101_0']
+    assert cluster.workers == {'100_0': 'running', '100_1': 'running'}
+    assert queue.read()['cancelled'] == ['101_1', '101_0']
+
+def test_scale_down(cluster, queue):
+    cluster.submit(3)
+    assert sorted(cluster.scale_down(['sweep-100_1', '100_2', 'sweep-999_0'])) == ['100_1', '100_2']
+    assert cluster.workers == {'100_0': 'pending'}
+    assert set(queue.read()['tasks']) == {'100_0'}
+
+def test_scale_down_addresses(cluster, queue, monkeypatch):
+    class Client:
+        def __enter__(self): return self
+        def __exit__(self, *exc): pass
+        def scheduler_info(self):
+            return {'workers': {'tcp://10.0.0.2:1': {'name': 'sweep-100_1'}, 'tcp://10.0.0.3:1': {'name': 'other-100_0'}}}
+    monkeypatch.setattr(cluster, 'client', lambda **kwargs: Client())
+    cluster.submit(2)
+    # a worker of another cluster on the same scheduler is not mistaken for task 100_0
+    assert cluster.scale_down(['tcp://10.0.0.2:1', 'tcp://10.0.0.3:1']) == ['100_1']
+    assert cluster.workers == {'100_0': 'pending'}
+
+def test_close(queue, tmp_path):
+    c = BatchCluster('sweep', system='slurm', directory=str(tmp_path / 'jobs'), scheduler='tcp://10.0.0.1:8786', interval=3600)
+    c.submit(2)
+    c.close()
+    assert c.workers == {}
+    assert queue.read()['tasks'] == {}
+    assert c.closed.is_set()
+
+def test_pbs(queue, tmp_path):
+    with BatchCluster('sweep', system='pbs', directory=str(tmp_path / 'jobs'),
+                      scheduler='tcp://10.0.0.1:8786', interval=3600) as c:
+        assert c.submit(2) == '100'
+        queue.set(**{'100[0]': 'R'})
+        assert c.poll() == {'100[0]': 'running', '100[1]': 'pending'}
+        script = open(os.path.join(c.directory, 'sweep-1.pbs')).read()
+        assert '#PBS -t 0-1' in script
+        # the task id is quoted so that bash does not glob 100[0] into this file
+        open(str(tmp_path / 'sweep-1000'), 'w').close()
+        out = subprocess.run(['bash', '-c', 'PBS_JOBID=100[0].server; echo "sweep-${PBS_JOBID%%.*}"'],
+                             capture_output=True, text=True, cwd=str(tmp_path)).stdout
+        assert out.strip() == 'sweep-100[0]'
+        assert '--name "sweep-${PBS_JOBID%%.*}"' in script
+
+################################################################################
@@ -0,0 +1,46 @@
+'''
+The lazily loaded names of the cloud package against the names its submodules define
+'''
+import os, ast, sys, types, subprocess
+
+import pytest
+
+import cloud
+
+################################################################################
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def defined(module):
+    '''Public names a submodule defines at its top level, read from its source without importing it'''
+    with open(os.path.join(ROOT, 'cloud', module + '.py')) as f:
+        tree = ast.parse(f.read())
+    names = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.append(node.name)
+        elif isinstance(node, ast.Assign):
+            names += [t.id for t in node.targets if isinstance(t, ast.Name)]
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            names.append(node.target.id)
+    return {n for n in names if not n.startswith('_')} - {'log'} # each module's logger
+
+@pytest.mark.parametrize('module', sorted(cloud._SUBMODULES))
+def test_names_match_submodules(module):
+    assert set(cloud._SUBMODULES[module]) == defined(module)
+
+def test_unknown_name():
+    with pytest.raises(AttributeError):
+        cloud.no_such_name
+
+def test_submodules_stay_modules():
+    import cloud.timeline as timeline
+    assert isinstance(timeline, types.ModuleType) and cloud.timeline is timeline
+    assert cloud.Timeline is timeline.Timeline
+
+def test_import_is_lazy():
+    out = subprocess.run([sys.executable, '-c', 'import cloud, sys; print(sorted(m for m in sys.modules if m.startswith("cloud.")))'],
+                         cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert out.strip() == '[]'
+
+################################################################################